@@ -85,11 +85,13 @@ custodia_clients = [
 
 custodia_consumers = [
     'Forwarder = custodia.forwarder:Forwarder',
+    'Metrics = custodia.metrics:Metrics',
     'Secrets = custodia.secrets:Secrets',
     'Root = custodia.root:Root',
 ]
 
 custodia_stores = [
+    'CachedOverlay = custodia.store.cached:CachedOverlay',
     'EncryptedOverlay = custodia.store.encgen:EncryptedOverlay',
     'EncryptedStore = custodia.store.enclite:EncryptedStore',
     'IPAVault = custodia.ipa.vault:IPAVault',
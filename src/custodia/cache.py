@@ -0,0 +1,193 @@
+# Copyright (C) 2026  Custodia Project Contributors - see LICENSE file
+"""Cross-process shared memory cache
+
+Custodia handles requests in forked processes, an ordinary in-process
+cache dies with the child. SharedCache keeps its entries in an anonymous
+shared memory mapping, that is created before the server forks. All
+children and pre-forked workers read and write the same entries.
+
+The request metrics (custodia.metrics) and the change counters of
+long-poll requests (custodia.watch) live in shared memory for the same
+reason, they are allocated while the plugins are loaded. Locks of shared
+memory are taken with a timeout, a child that is killed while it holds
+a lock must not block everybody else.
+"""
+from __future__ import absolute_import
+
+import hashlib
+import mmap
+import multiprocessing
+import struct
+import time
+
+from custodia import log
+
+logger = log.getLogger(__name__)
+
+
+class SharedCache(object):
+    """Set-associative LRU cache in shared memory
+
+    The mapping is divided into sets of 'ways' slots of 'slot_size'
+    bytes. A key is hashed to a set and stored in the least recently
+    used or first expired slot of the set. Entries expire after 'ttl'
+    seconds. Values larger than 'slot_size' are not cached.
+
+    A process that reads a value from a slow backend must take a
+    generation() ticket before it reads, and hand the ticket to put().
+    The value is only stored when no key of the set has been invalidated
+    in the meantime, so a stale value never replaces a newer write.
+    """
+    # digest, expiry, last use, value length
+    header = struct.Struct('=16sddI4x')
+    # seconds to wait for a set lock
+    lock_timeout = 1.0
+
+    def __init__(self, slots=1024, slot_size=8192, ttl=60.0, ways=8,
+                 locks=16):
+        if slots < 1 or slot_size < 1 or ways < 1:
+            raise ValueError('Invalid cache geometry')
+        self.ways = min(ways, slots)
+        self.sets = slots // self.ways
+        self.slot_size = slot_size
+        self.ttl = ttl
+        self._stride = self.header.size + slot_size
+        self._mem = mmap.mmap(-1, self.sets * self.ways * self._stride)
+        self._generations = multiprocessing.RawArray('Q', self.sets)
+        # set to 1 when a lock is stuck, the cache is bypassed from then on
+        self._disabled = multiprocessing.RawValue('b', 0)
+        self._locks = [multiprocessing.Lock()
+                       for _ in range(min(locks, self.sets))]
+
+    @property
+    def enabled(self):
+        return not self._disabled.value
+
+    def _locate(self, key):
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        digest = hashlib.sha256(key).digest()[:16]
+        index = int(hashlib.sha256(digest).hexdigest()[:8], 16) % self.sets
+        return digest, index
+
+    def _acquire(self, index):
+        lock = self._locks[index % len(self._locks)]
+        if lock.acquire(timeout=self.lock_timeout):
+            return lock
+        logger.error('Shared cache lock is stuck, disabling the cache')
+        self._disabled.value = 1
+        return None
+
+    def _slots(self, index):
+        offset = index * self.ways * self._stride
+        for way in range(self.ways):
+            yield offset + way * self._stride
+
+    def _find(self, index, digest):
+        for pos in self._slots(index):
+            if self._mem[pos:pos + 16] == digest:
+                return pos
+        return None
+
+    def get(self, key):
+        """Return the cached value as bytes or None
+        """
+        if self._disabled.value:
+            return None
+        digest, index = self._locate(key)
+        lock = self._acquire(index)
+        if lock is None:
+            return None
+        try:
+            pos = self._find(index, digest)
+            if pos is None:
+                return None
+            _, expires, _, length = self.header.unpack_from(self._mem, pos)
+            now = time.monotonic()
+            if expires <= now:
+                self._mem[pos:pos + 16] = b'\0' * 16
+                return None
+            self.header.pack_into(self._mem, pos, digest, expires, now,
+                                  length)
+            start = pos + self.header.size
+            return self._mem[start:start + length]
+        finally:
+            lock.release()
+
+    def generation(self, key):
+        """Ticket for put(), take it before the value is read
+        """
+        _, index = self._locate(key)
+        return self._generations[index]
+
+    def put(self, key, value, generation=None, ttl=None):
+        """Store a value (bytes) unless the set has been invalidated since
+        generation() returned 'generation'.
+
+        A 'ttl' shorter than the one of the cache limits the lifetime of
+        the entry.
+        """
+        if self._disabled.value or len(value) > self.slot_size:
+            return False
+        if ttl is None or ttl > self.ttl:
+            ttl = self.ttl
+        elif ttl <= 0:
+            return False
+        digest, index = self._locate(key)
+        lock = self._acquire(index)
+        if lock is None:
+            return False
+        try:
+            if (generation is not None
+                    and generation != self._generations[index]):
+                return False
+            now = time.monotonic()
+            pos = self._find(index, digest)
+            if pos is None:
+                # first expired or least recently used slot
+                victim = victim_used = None
+                for slot in self._slots(index):
+                    _, expires, used, _ = self.header.unpack_from(
+                        self._mem, slot)
+                    if expires <= now:
+                        victim = slot
+                        break
+                    if victim is None or used < victim_used:
+                        victim, victim_used = slot, used
+                pos = victim
+            self.header.pack_into(self._mem, pos, digest, now + ttl,
+                                  now, len(value))
+            start = pos + self.header.size
+            self._mem[start:start + len(value)] = value
+            return True
+        finally:
+            lock.release()
+
+    def invalidate(self, key):
+        """Remove a key, pending put() calls for its set are rejected
+        """
+        digest, index = self._locate(key)
+        lock = self._acquire(index)
+        if lock is None:
+            # the cache has been disabled
+            return
+        try:
+            self._generations[index] += 1
+            pos = self._find(index, digest)
+            if pos is not None:
+                self._mem[pos:pos + 16] = b'\0' * 16
+        finally:
+            lock.release()
+
+    def clear(self):
+        for index in range(self.sets):
+            lock = self._acquire(index)
+            if lock is None:
+                return
+            try:
+                self._generations[index] += 1
+                for pos in self._slots(index):
+                    self._mem[pos:pos + self.header.size] = (
+                        b'\0' * self.header.size)
+            finally:
+                lock.release()
@@ -18,6 +18,12 @@ class Forwarder(HTTPConsumer):
     forward_headers = PluginOption('json', '{}', None)
     prefix_remote_user = PluginOption(bool, True, None)
     timeout = PluginOption(float, 10.0, 'Connection timeout in seconds')
+    # pass request bodies through without buffering them
+    stream_body = True
+    # metadata headers of the remote reply, that are passed on
+    reply_headers = ('ETag', 'Last-Modified', 'X-Custodia-Cursor',
+                     'X-Custodia-Expires', 'X-Custodia-Size',
+                     'X-Custodia-Version')
 
     def __init__(self, config, section):
         super(Forwarder, self).__init__(config, section)
@@ -52,6 +58,9 @@ class Forwarder(HTTPConsumer):
         if reply.status_code < 200 or reply.status_code > 299:
             raise HTTPError(reply.status_code)
         response['code'] = reply.status_code
+        for header in self.reply_headers:
+            if header in reply.headers:
+                response['headers'][header] = reply.headers[header]
         if reply.content:
             response['output'] = reply.content
 
@@ -67,6 +76,12 @@ class Forwarder(HTTPConsumer):
                       params=request.get('query', None),
                       headers=self._headers(request))
 
+    def HEAD(self, request, response):
+        self._request(self.client.head, request, response,
+                      self._path(request),
+                      params=request.get('query', None),
+                      headers=self._headers(request))
+
     def PUT(self, request, response):
         self._request(self.client.put, request, response,
                       self._path(request),
@@ -0,0 +1,233 @@
+# Copyright (C) 2026  Custodia Project Contributors - see LICENSE file
+"""asyncio server engine
+
+Connections are accepted and read by an asyncio event loop. Once a
+complete request has been received, it is handed to a bounded thread pool
+where the regular HTTPRequestHandler code parses it and runs the
+pipeline(). Idle and slow connections therefore only cost a coroutine,
+while plugins and stores may keep doing blocking I/O.
+"""
+from __future__ import absolute_import
+
+import asyncio
+import io
+import signal
+import socket
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from custodia import log
+from custodia.httpd.server import HTTPRequestHandler, MAX_REQUEST_SIZE
+from custodia.httpd.server import STREAM_CHUNK_SIZE
+
+logger = log.getLogger(__name__)
+
+MAX_LINE = 65536
+MAX_HEADERS = 100
+
+
+class LoopWriter(object):
+    """Write-only file object, that sends through the event loop
+
+    Executor threads write responses here. Writes are collected up to
+    STREAM_CHUNK_SIZE bytes, a full buffer is handed to the event loop
+    and the thread waits until the stream is drained. Large and streamed
+    bodies only hold one chunk in memory.
+    """
+
+    def __init__(self, writer, loop):
+        self.writer = writer
+        self.loop = loop
+        self.buffer = bytearray()
+
+    async def _send(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= STREAM_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self):
+        if not self.buffer:
+            return
+        data = bytes(self.buffer)
+        del self.buffer[:]
+        future = asyncio.run_coroutine_threadsafe(self._send(data), self.loop)
+        future.result()
+
+
+class AsyncHTTPRequestHandler(HTTPRequestHandler):
+    """Per-connection handler for the asyncio engine
+
+    The handler reads requests from an asyncio stream and buffers them
+    in memory. HTTPRequestHandler.handle_one_request() then processes the
+    buffered request in an executor thread and writes its response to a
+    LoopWriter, which streams it through the event loop.
+    """
+    # the event loop owns the socket, there is nothing to sendfile() to
+    use_sendfile = False
+
+    def __init__(self, reader, writer, server, executor):
+        # pylint: disable=super-init-not-called
+        self._init_state()
+        self.reader = reader
+        self.writer = writer
+        self.server = server
+        self.executor = executor
+        self.request = self.connection = writer.get_extra_info('socket')
+        self.client_address = writer.get_extra_info('peername')
+        if writer.get_extra_info('ssl_object') is not None:
+            self._cert = writer.get_extra_info('peercert')
+        if server.keepalive_timeout:
+            self.protocol_version = "HTTP/1.1"
+        self.rfile = None
+        self.wfile = None
+
+    def _read_requestline(self):
+        self.raw_requestline = self.rfile.readline(MAX_LINE + 1)
+        return True
+
+    async def _readline(self):
+        try:
+            return await self.reader.readline()
+        except ValueError:
+            # line exceeds the stream limit
+            return None
+
+    async def _read_request(self):
+        """Read a complete request
+
+        Returns the raw request or None when the connection is done.
+        Oversized request lines, headers or bodies are passed on, so
+        handle_one_request() can send the appropriate error.
+        """
+        if self.requests_handled and self.server.keepalive_timeout:
+            try:
+                line = await asyncio.wait_for(
+                    self._readline(), self.server.keepalive_timeout)
+            except asyncio.TimeoutError:
+                logger.debug("Closing idle connection")
+                return None
+        else:
+            line = await self._readline()
+        if line is None:
+            return b'\0' * (MAX_LINE + 1)
+        if not line:
+            return None
+
+        chunks = [line]
+        length = 0
+        for _ in range(MAX_HEADERS + 1):
+            line = await self._readline()
+            if line is None:
+                # parse_request() refuses the oversized header line with
+                # 431, the rest of the request is not read
+                chunks.append(b'\0' * (MAX_LINE + 1))
+                return b''.join(chunks)
+            if not line:
+                return None
+            chunks.append(line)
+            if line in (b'\r\n', b'\n'):
+                break
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'content-length':
+                try:
+                    length = int(value.strip())
+                except ValueError:
+                    length = 0
+        else:
+            # too many headers, parse_request() refuses the request
+            return b''.join(chunks)
+
+        if 0 < length <= MAX_REQUEST_SIZE:
+            try:
+                chunks.append(await self.reader.readexactly(length))
+            except asyncio.IncompleteReadError:
+                return None
+        return b''.join(chunks)
+
+    def _handle_buffered(self, data):
+        self.rfile = io.BytesIO(data)
+        self.close_connection = True
+        try:
+            self.handle_one_request()
+            self.wfile.flush()
+        except (ConnectionError, socket.error) as e:
+            logger.debug("Connection error: %r", e)
+            self.close_connection = True
+        except Exception:  # pylint: disable=broad-except
+            self.log_error("Request failed", exc_info=True)
+            self.close_connection = True
+
+    async def handle_connection(self):
+        loop = asyncio.get_event_loop()
+        self.wfile = LoopWriter(self.writer, loop)
+        try:
+            while True:
+                data = await self._read_request()
+                if data is None:
+                    break
+                await loop.run_in_executor(
+                    self.executor, self._handle_buffered, data)
+                if self.close_connection:
+                    break
+        except (ConnectionError, socket.error) as e:
+            logger.debug("Connection error: %r", e)
+        finally:
+            self.writer.close()
+
+
+class AsyncHTTPServer(object):
+    """Serve the listening sockets of ForkingHTTPServers with asyncio
+
+    The ForkingHTTPServer instances only provide the bound sockets, the
+    configuration and (for TLS) the SSLContext. TLS handshakes are done by
+    the event loop.
+    """
+    handler = AsyncHTTPRequestHandler
+
+    def __init__(self, servers, threads):
+        self.servers = servers
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.loop = None
+
+    def _start_server(self, httpd):
+        async def client_connected(reader, writer):
+            handler = self.handler(reader, writer, httpd, self.executor)
+            await handler.handle_connection()
+
+        sock = httpd.socket
+        # the event loop expects a non-blocking socket
+        sock.setblocking(False)
+        if sock.family == socket.AF_UNIX:
+            return asyncio.start_unix_server(
+                client_connected, sock=sock, limit=MAX_LINE + 1)
+        kwargs = {}
+        context = getattr(httpd, '_context', None)
+        if context is not None:
+            kwargs['ssl'] = context
+            if sys.version_info >= (3, 7):
+                kwargs['ssl_handshake_timeout'] = httpd.handshake_timeout
+        return asyncio.start_server(
+            client_connected, sock=sock, limit=MAX_LINE + 1, **kwargs)
+
+    def serve_forever(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            self.loop.add_signal_handler(signum, self.loop.stop)
+        servers = [self.loop.run_until_complete(self._start_server(httpd))
+                   for httpd in self.servers]
+        try:
+            self.loop.run_forever()
+        finally:
+            for server in servers:
+                server.close()
+                self.loop.run_until_complete(server.wait_closed())
+            # executor threads send their responses through the loop
+            self.loop.run_until_complete(self.loop.run_in_executor(
+                None, self.executor.shutdown, True))
+            self.loop.close()
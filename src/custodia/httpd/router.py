@@ -0,0 +1,101 @@
+# Copyright (C) 2026  Custodia Project Contributors - see LICENSE file
+from __future__ import absolute_import
+
+from custodia.plugin import HTTPError, SUPPORTED_COMMANDS
+
+
+class _Node(object):
+    __slots__ = ('children', 'consumer', 'base', 'handlers', 'is_sub')
+
+    def __init__(self):
+        self.children = {}
+        # configured consumer, that handles the request
+        self.consumer = None
+        # consumer or sub-consumer, that provides the handler methods
+        self.base = None
+        self.handlers = None
+        self.is_sub = False
+
+    def set_target(self, consumer, base, is_sub):
+        self.consumer = consumer
+        self.base = base
+        self.is_sub = is_sub
+        self.handlers = {}
+        for command in SUPPORTED_COMMANDS:
+            self.handlers[command] = getattr(base, command, None)
+        if self.handlers['HEAD'] is None:
+            # HEAD is GET without the body, the server drops the output
+            self.handlers['HEAD'] = self.handlers['GET']
+
+
+class Router(object):
+    """Routing trie for consumers
+
+    The trie is compiled once from the path chains in config['consumers']
+    and the (nested) 'subs' of the consumers. route() resolves a request
+    path with a single walk down the trie. The consumer with the longest
+    matching path chain is selected, below it sub-consumers are followed
+    as long as they match. The remaining path components become the
+    'trail' of the request.
+    """
+
+    def __init__(self, consumers):
+        self.root = _Node()
+        for path_chain, consumer in consumers.items():
+            node = self._insert(path_chain)
+            node.set_target(consumer, consumer, False)
+        # Sub-consumers are added after all configured consumers, a
+        # configured consumer always wins over a sub-consumer. Deeper
+        # consumers come last, their subs replace the subs of consumers
+        # further up the tree.
+        for path_chain in sorted(consumers, key=len):
+            consumer = consumers[path_chain]
+            self._add_subs(self._insert(path_chain), consumer, consumer)
+
+    def _insert(self, path_chain):
+        node = self.root
+        for comp in path_chain:
+            child = node.children.get(comp)
+            if child is None:
+                child = node.children[comp] = _Node()
+            node = child
+        return node
+
+    def _add_subs(self, node, consumer, base):
+        for name, sub in getattr(base, 'subs', {}).items():
+            child = node.children.get(name)
+            if child is None:
+                child = node.children[name] = _Node()
+            elif child.consumer is not None and not child.is_sub:
+                continue
+            child.set_target(consumer, sub, True)
+            self._add_subs(child, consumer, sub)
+
+    def route(self, path_chain, command):
+        """Find consumer, handler and trail for a request
+
+        Raises HTTPError 404 when no consumer matches the path, 501 for
+        unsupported commands and 405 when the consumer does not implement
+        the command.
+        """
+        node = self.root
+        match = None
+        depth = 0
+        for i, comp in enumerate(path_chain):
+            node = node.children.get(comp)
+            if node is None:
+                break
+            if node.consumer is not None:
+                match = node
+                depth = i + 1
+        if match is None:
+            raise HTTPError(404)
+        if command not in SUPPORTED_COMMANDS:
+            raise HTTPError(501)
+        handler = match.handlers[command]
+        if handler is None:
+            raise HTTPError(405)
+        trail = list(path_chain[depth:])
+        if not trail and not match.is_sub:
+            trail = None
+        return match.consumer, handler, trail
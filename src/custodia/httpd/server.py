@@ -3,18 +3,25 @@ from __future__ import absolute_import
 
 import atexit
 import errno
+import io
 import os
+import resource
+import selectors
 import shutil
+import signal
 import socket
 import ssl
+import stat
 import struct
 import sys
 import warnings
 
 import six
 
-from custodia import log
+from custodia import log, metrics
 from custodia.compat import parse_qs, unquote, urlparse
+from custodia.httpd.router import Router
+from custodia.httpd.supervisor import Supervisor
 from custodia.plugin import HTTPError
 
 # pylint: disable=import-error,no-name-in-module
@@ -50,6 +57,54 @@ SO_PEERCRED = getattr(socket, 'SO_PEERCRED', 17)
 SO_PEERSEC = getattr(socket, 'SO_PEERSEC', 31)
 SELINUX_CONTEXT_LEN = 256
 MAX_REQUEST_SIZE = 10 * 1024 * 1024  # For now limit body to 10MiB
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def _is_regular_file(fileobj):
+    try:
+        return stat.S_ISREG(os.fstat(fileobj.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return False
+
+
+class RequestBody(object):
+    """File-like request body with a known length
+
+    Consumers with 'stream_body' set receive the body as a RequestBody
+    and read it in chunks instead of getting a bytes object. Reads never
+    go beyond the end of the body.
+    """
+
+    def __init__(self, rfile, length):
+        self._rfile = rfile
+        self.length = length
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        if not size:
+            return b''
+        data = self._rfile.read(size)
+        if len(data) < size:
+            # client closed the connection
+            self.remaining = 0
+            raise socket.error('Truncated request body')
+        self.remaining -= size
+        return data
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+    def __len__(self):
+        return self.length
+
+    def __repr__(self):
+        return '<RequestBody length={}>'.format(self.length)
 
 
 class ForkingHTTPServer(ForkingTCPServer):
@@ -61,10 +116,29 @@ class ForkingHTTPServer(ForkingTCPServer):
 
     When a request is received it is parsed by the handler_class provided
     at server initialization.
+
+    Pre-forked workers set 'forking' to False, in that case requests are
+    handled in the worker process itself.
+
+    With a non-zero 'server_keepalive_timeout' connections are persistent
+    (HTTP/1.1 keep-alive). An idle connection is closed after the timeout
+    and every connection is closed after 'server_keepalive_requests'
+    requests.
+
+    With 'server_reuseport' the TCP address is only bound with
+    SO_REUSEPORT but not activated. Every pre-forked worker then calls
+    reuse_port_rebind() to listen on a private socket of its own and the
+    kernel distributes new connections among the workers. A worker, that
+    exits, handles the connections queued on its socket with drain().
     """
     server_string = "Custodia/0.1"
     allow_reuse_address = True
+    reuse_port = False
     socket_file = None
+    forking = True
+    requests_handled = 0
+    keepalive_timeout = 0
+    keepalive_requests = 100
 
     def __init__(self, server_address, handler_class, config,
                  bind_and_activate=True):
@@ -79,6 +153,11 @@ class ForkingHTTPServer(ForkingTCPServer):
         else:
             self.socket = socket.socket(self.address_family,
                                         self.socket_type)
+            if (config.get('server_reuseport', False)
+                    and self.address_family != socket.AF_UNIX):
+                if not hasattr(socket, 'SO_REUSEPORT'):
+                    raise ValueError('SO_REUSEPORT is not supported')
+                self.reuse_port = True
 
         # copied from TCPServer
         if bind_and_activate:
@@ -97,8 +176,74 @@ class ForkingHTTPServer(ForkingTCPServer):
         self.config = config
         if 'server_string' in self.config:
             self.server_string = self.config['server_string']
+        self.keepalive_timeout = float(
+            config.get('server_keepalive_timeout', self.keepalive_timeout))
+        self.keepalive_requests = int(
+            config.get('server_keepalive_requests', self.keepalive_requests))
+        self.router = Router(config['consumers'])
         self.auditlog = log.auditlog
 
+    def server_bind(self):
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        ForkingTCPServer.server_bind(self)
+
+    def server_activate(self):
+        if self.reuse_port:
+            # The address is merely reserved. A bound socket, that does
+            # not listen, is not part of the SO_REUSEPORT group and never
+            # gets any connection.
+            return
+        ForkingTCPServer.server_activate(self)
+
+    def reuse_port_rebind(self):
+        """Replace the reserved socket by a private listening socket
+        """
+        self.socket.close()
+        self.socket = socket.socket(self.address_family, self.socket_type)
+        try:
+            self.server_bind()
+            ForkingTCPServer.server_activate(self)
+        except BaseException:
+            self.server_close()
+            raise
+
+    def drain(self):
+        """Handle the connections queued on a private listening socket
+
+        The backlog of a SO_REUSEPORT socket is not handed over to the
+        other workers, closing the socket resets queued connections. At
+        most 'request_queue_size' connections are handled, new ones may
+        keep arriving until the socket is closed.
+        """
+        if not self.reuse_port:
+            return
+        with selectors.DefaultSelector() as selector:
+            selector.register(self, selectors.EVENT_READ)
+            for _ in range(self.request_queue_size):
+                if not selector.select(0):
+                    break
+                self._handle_request_noblock()
+
+    def get_request(self):
+        conn, client_addr = self.socket.accept()
+        # pre-forked workers poll a non-blocking listening socket
+        conn.setblocking(True)
+        return conn, client_addr
+
+    def finish_request(self, request, client_address):
+        if self.forking:
+            # forked child, don't keep the listening socket open while
+            # serving a persistent connection
+            self.socket.close()
+        ForkingTCPServer.finish_request(self, request, client_address)
+
+    def process_request(self, request, client_address):
+        if self.forking:
+            return ForkingTCPServer.process_request(
+                self, request, client_address)
+        return BaseServer.process_request(self, request, client_address)
+
 
 class ForkingUnixHTTPServer(ForkingHTTPServer):
     address_family = socket.AF_UNIX
@@ -121,10 +266,25 @@ class ForkingUnixHTTPServer(ForkingHTTPServer):
 
 
 class ForkingTLSServer(ForkingHTTPServer):
+    """
+    A forking HTTPS server.
+
+    The parent only accepts connections. The TLS handshake is performed
+    by the process that serves the connection, limited by
+    'tls_handshake_timeout', so a slow client cannot stall the accept loop.
+
+    The SSLContext is created once before any process is forked. All
+    workers share its session ticket keys, a client can resume its TLS
+    session no matter which process serves its next connection.
+    """
+    handshake_timeout = 10.0
+
     def __init__(self, server_address, handler_class, config, context=None,
                  bind_and_activate=True):
         ForkingHTTPServer.__init__(self, server_address, handler_class, config,
                                    bind_and_activate=bind_and_activate)
+        self.handshake_timeout = float(
+            config.get('tls_handshake_timeout', self.handshake_timeout))
         if context is None:
             try:
                 self._context = self._mkcontext()
@@ -159,16 +319,32 @@ class ForkingTLSServer(ForkingHTTPServer):
             cafile=cafile,
             capath=capath)
         context.verify_mode = verifymode
+        if self.config.get('tls_session_tickets', True):
+            context.options &= ~ssl.Options.OP_NO_TICKET
+        else:
+            context.options |= ssl.Options.OP_NO_TICKET
         logger.info(
             "Loading cert chain '%s' (keyfile: '%s')", certfile, keyfile)
         context.load_cert_chain(certfile, keyfile)
         return context
 
     def get_request(self):
-        conn, client_addr = self.socket.accept()
-        sslconn = self._context.wrap_socket(conn, server_side=True)
+        conn, client_addr = ForkingHTTPServer.get_request(self)
+        sslconn = self._context.wrap_socket(conn, server_side=True,
+                                            do_handshake_on_connect=False)
         return sslconn, client_addr
 
+    def finish_request(self, request, client_address):
+        request.settimeout(self.handshake_timeout)
+        try:
+            request.do_handshake()
+        except (ssl.SSLError, socket.error) as e:
+            logger.info("TLS handshake with %s failed: %s",
+                        client_address, e)
+            return
+        request.settimeout(None)
+        ForkingHTTPServer.finish_request(self, request, client_address)
+
 
 class HTTPRequestHandler(BaseHTTPRequestHandler):
 
@@ -196,16 +372,29 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
     If no 'code' is present the request is assumed to be successful and a
     '200 OK' status code will be sent back to the client.
 
-    The 'output' parameter can be a string or a file like object.
+    The 'output' parameter can be a string, a file like object or an
+    iterator over byte strings. Regular files are sent with sendfile().
+
+    The request 'body' is read into a byte string before the consumer is
+    invoked, unless the consumer sets 'stream_body'. Such a consumer gets
+    a file like RequestBody instead.
 
     The 'headers' objct must be a dictionary where keys are headers names.
 
-    By default we assume HTTP1.0
+    By default we assume HTTP1.0 and close the connection after each
+    response. When the server has a keep-alive timeout, the handler speaks
+    HTTP/1.1 and serves multiple requests per connection. Peer credentials,
+    login uid and client certificate are looked up once per connection.
     """
 
     protocol_version = "HTTP/1.0"
+    use_sendfile = True
 
     def __init__(self, request, client_address, server):
+        self._init_state()
+        BaseHTTPRequestHandler.__init__(self, request, client_address, server)
+
+    def _init_state(self):
         self.requestline = ''
         self.request_version = ''
         self.command = ''
@@ -217,8 +406,14 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         self.url = None
         self.body = None
         self.loginuid = None
+        self.requests_handled = 0  # on this connection
         self._creds = False
-        BaseHTTPRequestHandler.__init__(self, request, client_address, server)
+        self._cert = False
+
+    def setup(self):
+        if self.server.keepalive_timeout:
+            self.protocol_version = "HTTP/1.1"
+        BaseHTTPRequestHandler.setup(self)
 
     def version_string(self):
         return self.server.server_string
@@ -273,9 +468,13 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
 
     @property
     def peer_cert(self):
+        if self._cert is not False:
+            return self._cert
         if not hasattr(self.request, 'getpeercert'):
-            return None
-        return self.request.getpeercert()
+            self._cert = None
+        else:
+            self._cert = self.request.getpeercert()
+        return self._cert
 
     def parse_request(self):
         if not BaseHTTPRequestHandler.parse_request(self):
@@ -283,8 +482,10 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
 
         # grab the loginuid from `/proc` as soon as possible
         creds = self.peer_creds
-        if creds is not None:
+        if creds is not None and not self.requests_handled:
             self.loginuid = self._get_loginuid(creds['pid'])
+        self.requests_handled += 1
+        self.server.requests_handled += 1
 
         # after basic parsing also use urlparse to retrieve individual
         # elements of a request.
@@ -311,13 +512,19 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         return tuple(path_chain)
 
     def parse_body(self):
+        if 'transfer-encoding' in self.headers:
+            # chunked bodies are not decoded, the end of the body is
+            # unknown and nothing else can be read from the connection
+            self.close_connection = 1
+            raise HTTPError(501)
         length = int(self.headers.get('content-length', 0))
         if length > MAX_REQUEST_SIZE:
             raise HTTPError(413)
         if length == 0:
             self.body = None
         else:
-            self.body = self.rfile.read(length)
+            # read by pipeline() once the consumer is known
+            self.body = RequestBody(self.rfile, length)
 
     def handle_one_request(self):
         if self.request.family == socket.AF_UNIX:
@@ -327,7 +534,9 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
             if not self.server.config:
                 self.close_connection = 1
                 return
-            self.raw_requestline = self.rfile.readline(65537)
+            if not self._read_requestline():
+                self.close_connection = 1
+                return
             if not self.raw_requestline:
                 self.close_connection = 1
                 return
@@ -383,26 +592,92 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
                 self.wfile.flush()
                 return
 
-            self.send_response(response.get('code', 200))
-            for header, value in six.iteritems(response.get('headers', {})):
+            code = response.get('code', 200)
+            headers = response.get('headers', {})
+            output = response.get('output', None)
+            self.send_response(code)
+            for header, value in six.iteritems(headers):
                 self.send_header(header, value)
+            if not self.close_connection:
+                self._send_keepalive_headers(code, headers, output)
             self.end_headers()
 
-            output = response.get('output', None)
-            if hasattr(output, 'read'):
-                shutil.copyfileobj(output, self.wfile)
-                output.close()
-            elif output is not None:
-                self.wfile.write(output)
-            else:
-                self.close_connection = 1
+            if self.command == 'HEAD':
+                # the headers describe the body, that is never sent
+                if hasattr(output, 'close'):
+                    output.close()
+                output = None
+            self._write_output(output)
             self.wfile.flush()
+            if isinstance(self.body, RequestBody) and self.body.remaining:
+                # unread request body, the connection can't be reused
+                self.close_connection = 1
             return
         except socket.timeout as e:
             self.log_error("Request timed out: %r", e)
             self.close_connection = 1
             return
 
+    def send_response(self, code, message=None):
+        metrics.get_registry().count_request(code)
+        BaseHTTPRequestHandler.send_response(self, code, message)
+
+    def _write_output(self, output):
+        """Send the response body
+
+        'output' is bytes, a file-like object or an iterator over bytes.
+        Regular files are sent with zero-copy sendfile() when the handler
+        writes to the socket directly.
+        """
+        if output is None:
+            return
+        if isinstance(output, six.binary_type):
+            self.wfile.write(output)
+            return
+        try:
+            if hasattr(output, 'read'):
+                if self.use_sendfile and _is_regular_file(output):
+                    self.wfile.flush()
+                    self.connection.sendfile(output)
+                else:
+                    shutil.copyfileobj(output, self.wfile, STREAM_CHUNK_SIZE)
+            else:
+                for chunk in output:
+                    self.wfile.write(chunk)
+        finally:
+            if hasattr(output, 'close'):
+                output.close()
+
+    def _read_requestline(self):
+        """Read the request line, returns False on keep-alive idle timeout
+        """
+        if not self.requests_handled:
+            self.raw_requestline = self.rfile.readline(65537)
+            return True
+        # wait for the next request on a persistent connection
+        self.connection.settimeout(self.server.keepalive_timeout)
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except socket.timeout:
+            logger.debug("Closing idle connection")
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+        return True
+
+    def _send_keepalive_headers(self, code, headers, output):
+        if self.requests_handled >= self.server.keepalive_requests:
+            self.send_header('Connection', 'close')
+        elif output is None:
+            # responses without a body must not leave the client waiting
+            # for the connection to be closed
+            if (code not in {204, 304} and self.command != 'HEAD'
+                    and 'Content-Length' not in headers):
+                self.send_header('Content-Length', '0')
+        elif 'Content-Length' not in headers:
+            # no chunked encoding, end of body is signaled by closing
+            self.send_header('Connection', 'close')
+
     # pylint: disable=arguments-differ
     def log_error(self, fmtstr, *args, **kwargs):
         logger.error(fmtstr, *args, **kwargs)
@@ -430,25 +705,41 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
         handles the provided path walking up the path component by
         component until a consumer is found.
 
-        Paths are walked up from the leaf to the root, so if two consumers
-        hang on the same tree, the one closer to the leaf will be used. If
-        there is a trailing path when the conumer is selected then it will
-        be stored in the request dicstionary named 'trail'. The 'trail' is
-        an ordered list of the path components below the consumer entry
-        point.
+        The path is looked up in the server's routing trie, so if two
+        consumers hang on the same tree, the one closer to the leaf will be
+        used. If there is a trailing path when the conumer is selected then
+        it will be stored in the request dicstionary named 'trail'. The
+        'trail' is an ordered list of the path components below the
+        consumer entry point.
         """
         path_chain = request['path_chain']
         if not path_chain or path_chain[0] != '':
             # no path or not an absolute path
             raise HTTPError(400)
 
+        # Select consumer, routing errors are reported after authorization
+        try:
+            route = self.server.router.route(path_chain, request['command'])
+        except HTTPError as e:
+            route = e
+        stream_body = False
+        if not isinstance(route, HTTPError):
+            # the handler may belong to a sub-consumer
+            base = getattr(route[1], '__self__', route[0])
+            stream_body = getattr(base, 'stream_body', False)
+        body = request.get('body')
+        if isinstance(body, RequestBody) and not stream_body:
+            request['body'] = body.read()
+
         # auth framework here
         authers = config.get('authenticators')
         if authers is None:
             raise HTTPError(403)
+        stats = metrics.get_registry()
         valid_once = False
         for auth in authers:
-            valid = authers[auth].handle(request)
+            with stats.timed('authenticator', auth):
+                valid = authers[auth].handle(request)
             if valid is False:
                 raise HTTPError(403)
             elif valid is True:
@@ -465,7 +756,8 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
             raise HTTPError(403)
         authz_ok = None
         for authz in authzers:
-            valid = authzers[authz].handle(request)
+            with stats.timed('authorizer', authz):
+                valid = authzers[authz].handle(request)
             if valid is True:
                 authz_ok = True
             elif valid is False:
@@ -478,29 +770,79 @@ class HTTPRequestHandler(BaseHTTPRequestHandler):
                                             path_chain)
             raise HTTPError(403)
 
-        # Select consumer
-        trail = []
-        while path_chain:
-            if path_chain in config['consumers']:
-                con = config['consumers'][path_chain]
-                if len(trail) != 0:
-                    request['trail'] = trail
-                return con.handle(request)
-            trail.insert(0, path_chain[-1])
-            path_chain = path_chain[:-1]
-
-        raise HTTPError(404)
+        if isinstance(route, HTTPError):
+            raise route
+        con, handler, trail = route
+        if trail is not None:
+            request['trail'] = trail
+        # resolved by the router, consumers don't look it up again
+        request['handler'] = handler
+        with stats.timed('consumer', metrics.consumer_name(con)):
+            return con.handle(request)
 
 
 class HTTPServer(object):
+    """Custodia HTTP server
+
+    'srvurl' is a single URL or several URLs separated by commas or spaces,
+    e.g. a local Unix socket and a TLS socket. All listeners are served
+    by one process (or pool of processes) with a single dispatch loop and
+    share the same plugin instances.
+
+    By default every connection is handled in a freshly forked process.
+    When 'server_workers' is set, a fixed pool of long-lived worker
+    processes is forked after the plugins have been loaded instead. The
+    workers accept connections on the shared listening sockets and handle
+    them in-process. With 'server_reuseport' every worker listens on TCP
+    addresses with a socket of its own instead. A worker is recycled after
+    it has handled 'server_worker_max_requests' requests or once its peak
+    RSS exceeds 'server_worker_max_memory' MiB.
+
+    With 'server_engine = asyncio' connections are served by an asyncio
+    event loop in a single process instead, see custodia.httpd.aioserver.
+    """
     handler = HTTPRequestHandler
+    engines = ('fork', 'asyncio')
+    poll_interval = 0.5
 
     def __init__(self, srvurl, config):
-        url = urlparse(srvurl)
-        serverclass, address = self._get_serverclass(url)
-        if sd is not None:
-            address = self._get_systemd_socket(address)
-        self.httpd = serverclass(address, self.handler, config)
+        if isinstance(srvurl, six.string_types):
+            srvurl = self._split_urls(srvurl)
+        if not srvurl:
+            raise ValueError('No server URL')
+        fds = list(sd.listen_fds()) if sd is not None else []
+        self.servers = []
+        for u in srvurl:
+            url = urlparse(u)
+            serverclass, address = self._get_serverclass(url)
+            if fds:
+                address = self._get_systemd_socket(address, fds)
+            self.servers.append(serverclass(address, self.handler, config))
+        if fds:
+            raise ValueError('Unused listening sockets', fds)
+        # first listener, backwards compatibility
+        self.httpd = self.servers[0]
+        self.workers = int(config.get('server_workers', 0))
+        self.worker_max_requests = int(
+            config.get('server_worker_max_requests', 0))
+        self.worker_max_memory = int(
+            config.get('server_worker_max_memory', 0))
+        self.engine = config.get('server_engine', 'fork')
+        self.threads = int(config.get('server_threads', 8))
+        if self.engine not in self.engines:
+            raise ValueError('Unknown server engine: %s' % self.engine)
+        if self.engine != 'fork' and self.workers:
+            raise ValueError('server_workers requires the fork engine')
+        if config.get('server_reuseport', False) and not self.workers:
+            raise ValueError('server_reuseport requires server_workers')
+        self._stop_worker = False
+
+    def _split_urls(self, value):
+        if ',' in value:
+            values = value.split(',')
+        else:
+            values = value.split()
+        return list(v.strip() for v in values if v.strip())
 
     def _get_serverclass(self, url):
         if url.scheme == 'http+unix':
@@ -524,46 +866,115 @@ class HTTPServer(object):
             raise ValueError('Unknown URL Scheme: %s' % url.scheme)
         return serverclass, address
 
-    def _get_systemd_socket(self, address):
-        fds = sd.listen_fds()
-        if not fds:
-            return address
-        elif len(fds) > 1:
-            raise ValueError('Too many listening sockets', fds)
-
-        if isinstance(address, tuple):
-            port = address[1]
-            # systemd uses IPv6
-            if not sd.is_socket_inet(fds[0], family=socket.AF_INET6,
-                                     type=socket.SOCK_STREAM,
-                                     listening=True, port=port):
-                raise ValueError(
-                    "FD {} is not TCP IPv6 socket on port {}".format(
-                        fds[0], port
-                    )
-                )
-            logger.info('Using systemd socket activation on port %i', port)
-            sock = socket.fromfd(fds[0], socket.AF_INET6, socket.SOCK_STREAM)
-        else:
-            if not sd.is_socket_unix(fds[0], socket.SOCK_STREAM,
-                                     listening=True, path=address):
-                raise ValueError(
-                    "FD {} is not Unix stream socket on path {}".format(
-                        fds[0], address
-                    )
-                )
-            logger.info('Using systemd socket activation on path %s', address)
-            sock = socket.fromfd(fds[0], socket.AF_UNIX, socket.SOCK_STREAM)
+    def _get_systemd_socket(self, address, fds):
+        """Find the activated socket for address
 
-        if sys.version_info[0] < 3:
-            # Python 2.7's socket.fromfd() returns _socket.socket
-            sock = socket.socket(_sock=sock)
-        return sock
+        The matching file descriptor is removed from 'fds'. Addresses
+        without a matching socket are returned as they are and bound by
+        the server itself.
+        """
+        for fd in fds:
+            if isinstance(address, tuple):
+                port = address[1]
+                # systemd uses IPv6
+                if not sd.is_socket_inet(fd, family=socket.AF_INET6,
+                                         type=socket.SOCK_STREAM,
+                                         listening=True, port=port):
+                    continue
+                logger.info('Using systemd socket activation on port %i',
+                            port)
+                sock = socket.fromfd(fd, socket.AF_INET6, socket.SOCK_STREAM)
+            else:
+                if not sd.is_socket_unix(fd, socket.SOCK_STREAM,
+                                         listening=True, path=address):
+                    continue
+                logger.info('Using systemd socket activation on path %s',
+                            address)
+                sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+            fds.remove(fd)
+            if sys.version_info[0] < 3:
+                # Python 2.7's socket.fromfd() returns _socket.socket
+                sock = socket.socket(_sock=sock)
+            return sock
+        return address
 
     def get_socket(self):
         return (self.httpd.socket, self.httpd.socket_file)
 
+    @property
+    def requests_handled(self):
+        return sum(httpd.requests_handled for httpd in self.servers)
+
+    def _dispatch(self, done):
+        """Dispatch loop for all listeners, runs until done() is true
+        """
+        with selectors.DefaultSelector() as selector:
+            for httpd in self.servers:
+                selector.register(httpd, selectors.EVENT_READ)
+            while not done():
+                for key, _ in selector.select(self.poll_interval):
+                    # pylint: disable=protected-access
+                    key.fileobj._handle_request_noblock()
+                for httpd in self.servers:
+                    # reap forked children
+                    httpd.service_actions()
+
+    def _worker_exhausted(self):
+        if self._stop_worker:
+            return True
+        requests_handled = self.requests_handled
+        if (self.worker_max_requests
+                and requests_handled >= self.worker_max_requests):
+            logger.info('Worker %i handled %i requests, recycling',
+                        os.getpid(), requests_handled)
+            return True
+        if self.worker_max_memory:
+            # ru_maxrss is in KiB on Linux
+            maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            if maxrss > self.worker_max_memory * 1024:
+                logger.info('Worker %i uses %i KiB of memory, recycling',
+                            os.getpid(), maxrss)
+                return True
+        return False
+
+    def _stop_worker_handler(self, signum, frame):
+        self._stop_worker = True
+
+    def serve_worker(self, worker_id=0):
+        """Accept and handle requests in a pre-forked worker process
+
+        Returns when the worker has to be recycled or has been asked to
+        stop with SIGTERM, SIGINT or SIGHUP. The current request is always
+        completed first.
+        """
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self._stop_worker_handler)
+        for httpd in self.servers:
+            httpd.forking = False
+            if httpd.reuse_port:
+                httpd.reuse_port_rebind()
+            # another worker may win the race for a connection,
+            # get_request() fails with EAGAIN instead of blocking.
+            httpd.socket.setblocking(False)
+        self._dispatch(self._worker_exhausted)
+        for httpd in self.servers:
+            httpd.drain()
+
+    def serve_forever(self):
+        self._dispatch(lambda: False)
+
     def serve(self):
         if sd is not None and sd.booted():
             sd.notify("READY=1")
-        return self.httpd.serve_forever()
+        if self.engine == 'asyncio':
+            # pylint: disable=cyclic-import
+            from custodia.httpd.aioserver import AsyncHTTPServer
+            logger.info('Starting asyncio engine with %i threads',
+                        self.threads)
+            engine = AsyncHTTPServer(self.servers, self.threads)
+            return engine.serve_forever()
+        if self.workers:
+            logger.info('Starting %i pre-forked workers', self.workers)
+            supervisor = Supervisor(self.workers, self.serve_worker)
+            return supervisor.run()
+        return self.serve_forever()
@@ -0,0 +1,126 @@
+# Copyright (C) 2026  Custodia Project Contributors - see LICENSE file
+from __future__ import absolute_import
+
+import errno
+import os
+import signal
+import time
+
+from custodia import log
+
+logger = log.getLogger(__name__)
+
+FORWARD_SIGNALS = (signal.SIGTERM, signal.SIGINT, signal.SIGHUP)
+
+
+def fork_child(target, name, *args):
+    """Fork a child that calls target(*args), return its pid
+
+    The child restores the default handlers of the signals, that are
+    forwarded to it, and exits with status 0 when target() returns or 1
+    when it fails. It never returns into the parent's stack.
+    """
+    # A signal, that arrives before the child has restored the default
+    # handlers, would run the handler of the parent and get lost.
+    mask = signal.pthread_sigmask(signal.SIG_BLOCK, FORWARD_SIGNALS)
+    try:
+        pid = os.fork()
+    except BaseException:
+        signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+        raise
+    if pid:
+        signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+        return pid
+
+    # child
+    status = 1
+    try:
+        for signum in FORWARD_SIGNALS:
+            signal.signal(signum, signal.SIG_DFL)
+        signal.pthread_sigmask(signal.SIG_SETMASK, mask)
+        target(*args)
+        status = 0
+    except BaseException:  # pylint: disable=broad-except
+        logger.exception('%s failed', name)
+    finally:
+        # skip atexit handlers of the parent
+        os._exit(status)  # pylint: disable=protected-access
+
+
+class Supervisor(object):
+    """Fork and babysit a fixed number of worker processes.
+
+    The supervisor forks `workers` children and calls `target(worker_id)`
+    in each of them. A worker that exits, either because it decided to
+    recycle itself or because it crashed, is replaced by a fresh one with
+    the same id.
+
+    SIGTERM, SIGINT and SIGHUP received by the supervisor are forwarded to
+    all workers. SIGTERM and SIGINT also stop the supervisor: workers are
+    no longer respawned and run() returns once all of them are gone.
+    """
+    forward_signals = FORWARD_SIGNALS
+    stop_signals = (signal.SIGTERM, signal.SIGINT)
+    # workers that die faster than this are considered crash-looping
+    min_lifetime = 1.0
+
+    def __init__(self, workers, target, name='worker'):
+        if workers < 1:
+            raise ValueError('Supervisor needs at least one worker')
+        self.workers = workers
+        self.target = target
+        self.name = name
+        self.children = {}
+        self.stopping = False
+
+    def _signal_handler(self, signum, frame):
+        if signum in self.stop_signals:
+            self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _spawn(self, worker_id):
+        pid = fork_child(self.target, '%s %i' % (self.name, worker_id),
+                         worker_id)
+        self.children[pid] = (worker_id, time.time())
+        logger.debug('Started %s %i (pid %i)', self.name, worker_id, pid)
+        if self.stopping:
+            # stopped during the fork, the signal missed the new child
+            os.kill(pid, signal.SIGTERM)
+        return pid
+
+    def run(self):
+        handlers = {}
+        for signum in self.forward_signals:
+            handlers[signum] = signal.signal(signum, self._signal_handler)
+        try:
+            for worker_id in range(self.workers):
+                self._spawn(worker_id)
+            while self.children:
+                pid, status = os.wait()
+                worker_id, started = self.children.pop(pid, (None, None))
+                if worker_id is None:
+                    # another child of the server, e.g. the reaper
+                    logger.warning('Child process %i exited with status '
+                                   '%i', pid, status)
+                    continue
+                if status:
+                    logger.error('%s %i (pid %i) exited with status %i',
+                                 self.name, worker_id, pid, status)
+                else:
+                    logger.debug('%s %i (pid %i) exited',
+                                 self.name, worker_id, pid)
+                if self.stopping:
+                    continue
+                if status and time.time() - started < self.min_lifetime:
+                    time.sleep(self.min_lifetime)
+                    if self.stopping:
+                        continue
+                self._spawn(worker_id)
+        finally:
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
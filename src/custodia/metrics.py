@@ -0,0 +1,251 @@
+# Copyright (C) 2026  Custodia Project Contributors - see LICENSE file
+"""Request metrics
+
+Latency histograms for the stages of the request pipeline and request
+counters. The values are kept in shared memory (see custodia.cache),
+nothing is lost when a child exits.
+"""
+from __future__ import absolute_import
+
+import functools
+import multiprocessing
+import time
+
+from custodia.plugin import HTTPConsumer, HTTPError, PluginOption
+
+STORE_METHODS = ('get', 'set', 'span', 'list', 'list_page', 'cut',
+                 'exists', 'stat', 'get_many', 'set_many', 'cut_many',
+                 'versions', 'get_version', 'restore', 'set_expiring',
+                 'reap')
+CODE_CLASSES = ('1xx', '2xx', '3xx', '4xx', '5xx')
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _NullTimer(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class _Timer(object):
+    __slots__ = ('registry', 'index', 'start')
+
+    def __init__(self, registry, index):
+        self.registry = registry
+        self.index = index
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # pylint: disable=protected-access
+        self.registry._observe(self.index, time.perf_counter() - self.start)
+        return False
+
+
+class NullRegistry(object):
+    """Registry that does not record anything
+    """
+    def timed(self, stage, plugin):
+        return _NULL_TIMER
+
+    def count_request(self, code):
+        pass
+
+    def render(self):
+        return ''
+
+
+class Registry(NullRegistry):
+    """Histograms and counters in shared memory
+
+    'series' is a list of (stage, plugin) tuples. Every series has a
+    histogram with 'buckets' (upper bounds in seconds), a count and a sum.
+    Observations for unknown series are ignored.
+    """
+    # seconds to wait for the lock, see custodia.cache
+    lock_timeout = 1.0
+
+    def __init__(self, series, buckets):
+        self.series = list(series)
+        self.buckets = sorted(buckets)
+        self._index = dict((key, i) for i, key in enumerate(self.series))
+        # buckets, count, sum
+        self._width = len(self.buckets) + 2
+        self._values = multiprocessing.RawArray(
+            'd', len(self.series) * self._width)
+        self._requests = multiprocessing.RawArray('d', len(CODE_CLASSES))
+        self._lock = multiprocessing.Lock()
+
+    def timed(self, stage, plugin):
+        """Context manager, that observes the duration of its block
+        """
+        index = self._index.get((stage, plugin))
+        if index is None:
+            return _NULL_TIMER
+        return _Timer(self, index)
+
+    def _observe(self, index, seconds):
+        offset = index * self._width
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                bucket = offset + i
+                break
+        else:
+            bucket = None
+        if not self._lock.acquire(timeout=self.lock_timeout):
+            return
+        try:
+            if bucket is not None:
+                self._values[bucket] += 1
+            self._values[offset + self._width - 2] += 1
+            self._values[offset + self._width - 1] += seconds
+        finally:
+            self._lock.release()
+
+    def count_request(self, code):
+        i = int(code) // 100 - 1
+        if not 0 <= i < len(CODE_CLASSES):
+            return
+        if not self._lock.acquire(timeout=self.lock_timeout):
+            return
+        try:
+            self._requests[i] += 1
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        if not self._lock.acquire(timeout=self.lock_timeout):
+            raise HTTPError(503, 'Metrics lock is stuck')
+        try:
+            return list(self._values), list(self._requests)
+        finally:
+            self._lock.release()
+
+    def render(self):
+        """Render all metrics in Prometheus text format
+        """
+        values, requests = self.snapshot()
+        lines = [
+            '# HELP custodia_requests_total Responses by status code class',
+            '# TYPE custodia_requests_total counter',
+        ]
+        for code, count in zip(CODE_CLASSES, requests):
+            lines.append(
+                'custodia_requests_total{code="%s"} %d' % (code, count))
+        name = 'custodia_stage_duration_seconds'
+        lines.extend([
+            '# HELP %s Time spent in request pipeline stages' % name,
+            '# TYPE %s histogram' % name,
+        ])
+        for i, (stage, plugin) in enumerate(self.series):
+            labels = 'stage="%s",plugin="%s"' % (
+                _escape(stage), _escape(plugin))
+            offset = i * self._width
+            cumulative = 0
+            for j, bound in enumerate(self.buckets):
+                cumulative += values[offset + j]
+                lines.append('%s_bucket{%s,le="%r"} %d' % (
+                    name, labels, float(bound), cumulative))
+            count = values[offset + self._width - 2]
+            lines.append(
+                '%s_bucket{%s,le="+Inf"} %d' % (name, labels, count))
+            lines.append('%s_sum{%s} %r' % (
+                name, labels, values[offset + self._width - 1]))
+            lines.append('%s_count{%s} %d' % (name, labels, count))
+        lines.append('')
+        return '\n'.join(lines)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+_registry = NullRegistry()
+
+
+def get_registry():
+    return _registry
+
+
+def install_registry(registry):
+    # pylint: disable=global-statement
+    global _registry
+    _registry = registry
+
+
+def consumer_name(consumer):
+    return getattr(consumer, 'section', None) or consumer.__class__.__name__
+
+
+def _timed_method(registry, stage, plugin, method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        with registry.timed(stage, plugin):
+            return method(*args, **kwargs)
+    wrapper.metrics_wrapped = True
+    return wrapper
+
+
+class Metrics(HTTPConsumer):
+    """Expose request metrics in Prometheus text format
+
+    The consumer creates the metrics registry when the server starts.
+    Every authenticator, authorizer, consumer and the store methods
+    get(), set(), span(), list(), list_page(), cut(), exists(), stat(),
+    the batch and the version methods of every store are timed.
+
+    Example::
+
+        [/metrics]
+        handler = custodia.metrics.Metrics
+    """
+    buckets = PluginOption(
+        'str_list', None,
+        'Upper bounds of the latency histogram buckets in seconds')
+
+    def finalize_init(self, config, cfgparser, context=None):
+        super(Metrics, self).finalize_init(config, cfgparser, context)
+        if isinstance(get_registry(), Registry):
+            # another metrics consumer did the work
+            return
+        series = []
+        for name in sorted(config['authenticators']):
+            series.append(('authenticator', name))
+        for name in sorted(config['authorizers']):
+            series.append(('authorizer', name))
+        for path_chain in sorted(config['consumers']):
+            consumer = config['consumers'][path_chain]
+            series.append(('consumer', consumer_name(consumer)))
+        for name in sorted(config['stores']):
+            for method in STORE_METHODS:
+                series.append(('store_' + method, name))
+        if self.buckets:
+            # pylint: disable=not-an-iterable
+            buckets = [float(b) for b in self.buckets]
+        else:
+            buckets = DEFAULT_BUCKETS
+        registry = Registry(series, buckets)
+        for name, store in config['stores'].items():
+            for method in STORE_METHODS:
+                func = getattr(store, method)
+                if getattr(func, 'metrics_wrapped', False):
+                    continue
+                setattr(store, method, _timed_method(
+                    registry, 'store_' + method, name, func))
+        install_registry(registry)
+
+    def GET(self, request, response):
+        response['headers']['Content-Type'] = CONTENT_TYPE
+        return get_registry().render().encode('utf-8')
@@ -5,8 +5,10 @@ import abc
 import grp
 import inspect
 import json
+import os
 import pwd
 import re
+import stat
 import sys
 
 from jwcrypto.common import json_encode
@@ -378,7 +380,19 @@ class CustodiaPlugin(object):
 
 class CSStore(CustodiaPlugin):
     """Base class for stores
+
+    Values are text. Stores with 'binary_values' also store bytes and
+    return them as bytes, text is returned as text. Other stores may
+    return text as bytes.
+
+    Stores with 'versioned_keys' report the 'version' and the 'modified'
+    time of keys in a native stat(). Stores with 'expiring_keys'
+    implement set_expiring() and reap().
     """
+    binary_values = False
+    versioned_keys = False
+    expiring_keys = False
+
     @abc.abstractmethod
     def get(self, key):
         pass
@@ -401,6 +415,160 @@ class CSStore(CustodiaPlugin):
     def cut(self, key):
         raise NotImplementedError
 
+    def list_page(self, keyfilter, limit, after=None):
+        """List a container in pages
+
+        Returns None when the container does not exist, otherwise a
+        (names, last) tuple. 'names' holds up to 'limit' names of list()
+        that follow 'after'. 'last' is passed as 'after' to fetch the next
+        page, it is None on the last page. The fallback lists the whole
+        container, stores override it with ordered index scans.
+        """
+        keylist = self.list(keyfilter)
+        if keylist is None:
+            return None
+        if after is not None:
+            keylist = [name for name in keylist if name > after]
+        names = keylist[:limit]
+        if len(keylist) > limit:
+            return names, names[-1]
+        return names, None
+
+    def list_iter(self, keyfilter, page_size=1000):
+        """Iterate over the names of a container
+
+        Returns None when the container does not exist, otherwise an
+        iterator over the names of list_page(). The fallback lists the
+        whole container, stores with a native list_page() fetch the names
+        page by page.
+        """
+        keylist = self.list(keyfilter)
+        if keylist is None:
+            return None
+        return iter(keylist)
+
+    def exists(self, key):
+        """Check whether a key exists
+
+        A name that ends in '/' refers to a container. A container exists
+        when its entry or any key below it exists.
+        """
+        return self.stat(key) is not None
+
+    def stat(self, key):
+        """Return None when the key does not exist, otherwise a dict
+
+        'container' tells whether the entry is a container, containers
+        also report whether they are 'empty'. Keys report the 'size' of
+        the stored value in bytes. Stores that track them add the
+        'version' (incremented on every replace) and the 'modified' time
+        (seconds since the epoch), keys that expire the 'expires' time.
+        The fallback uses get() and list(), stores override it with
+        cheaper lookups.
+        """
+        if key.endswith('/'):
+            keylist = self.list(key)
+            if keylist is None:
+                return None
+            return {'container': True, 'empty': not keylist}
+        value = self.get(key)
+        if value is None:
+            return None
+        if value == '':
+            # containers are stored with an empty value
+            return self.stat(key + '/')
+        if not isinstance(value, bytes):
+            value = value.encode('utf-8')
+        return {'container': False, 'size': len(value)}
+
+    # Versions. Stores with a history override these methods, the
+    # fallbacks only know the current version.
+
+    def versions(self, key):
+        """List the versions of a key, the newest first
+
+        Returns None when the key does not exist, otherwise a list of
+        dicts with the 'version', the 'modified' time and the 'size' of
+        every version the store keeps.
+        """
+        info = self.stat(key)
+        if info is None or info['container']:
+            return None
+        return [dict((k, info[k]) for k in ('version', 'modified', 'size')
+                     if k in info)]
+
+    def get_version(self, key, version):
+        """Fetch a version of a key, None when it is not kept
+        """
+        info = self.stat(key)
+        if (info is None or info['container']
+                or info.get('version') != version):
+            return None
+        return self.get(key)
+
+    def restore(self, key, version):
+        """Make a kept version the current one
+
+        The value of the version is stored as a new version, the version
+        number never goes back. Returns False when the version is not
+        kept.
+        """
+        value = self.get_version(key, version)
+        if value is None:
+            return False
+        if self.stat(key).get('version') != version:
+            self.set(key, value, replace=True)
+        return True
+
+    # Expiring keys. Stores with 'expiring_keys' override these methods.
+
+    def set_expiring(self, key, value, expires, replace=False):
+        """Store a value that expires at 'expires', seconds since the epoch
+
+        An expired key does not exist for any method, a write replaces it
+        like a missing key. A replaced value keeps the expiry time unless
+        it is replaced with set_expiring().
+        """
+        raise CSStoreUnsupported('Expiring keys are not supported')
+
+    def reap(self):
+        """Remove expired keys from the storage
+
+        Returns the list of removed keys. Expired keys are hidden right
+        away, reap() is called by a background process to free their
+        space in bulk.
+        """
+        return []
+
+    # Batch operations. The fallbacks call the single key methods, stores
+    # override them with native implementations.
+
+    def get_many(self, keys):
+        """Fetch several keys
+
+        Returns a dict that maps every key to its value or None.
+        """
+        return dict((key, self.get(key)) for key in keys)
+
+    def set_many(self, items, replace=False):
+        """Store several (key, value) pairs
+
+        Native implementations store all or nothing. The fallback stops at
+        the first error, pairs before the failing one remain stored.
+        """
+        for key, value in items:
+            self.set(key, value, replace)
+
+    def cut_many(self, keys):
+        """Remove several keys
+
+        Returns a dict that maps every key to True when it was removed.
+        """
+        result = {}
+        for key in keys:
+            result[key] = self.cut(key) or result.get(key, False)
+        return result
+
 
 class HTTPAuthorizer(CustodiaPlugin):
     """Base class for authorizers
@@ -419,12 +587,34 @@ class HTTPAuthenticator(CustodiaPlugin):
 
 
 DEFAULT_CTYPE = 'text/html; charset=utf-8'
-SUPPORTED_COMMANDS = ['GET', 'PUT', 'POST', 'DELETE']
+SUPPORTED_COMMANDS = ['GET', 'HEAD', 'PUT', 'POST', 'DELETE']
+
+
+def _is_iterator(output):
+    return hasattr(output, '__next__') or hasattr(output, 'next')
+
+
+def _remaining_size(fileobj):
+    """Size of the unread part of a regular file or None
+    """
+    try:
+        st = os.fstat(fileobj.fileno())
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        return st.st_size - fileobj.tell()
+    except (AttributeError, IOError, OSError, ValueError):
+        return None
 
 
 class HTTPConsumer(CustodiaPlugin):
     """Base class for consumers
+
+    Handlers may return bytes, a file-like object or an iterator over
+    bytes as output. Consumers with 'stream_body' get the request body
+    as a file-like object instead of bytes.
     """
+    stream_body = False
+
     def __init__(self, config, section=None):
         super(HTTPConsumer, self).__init__(config, section)
         self.subs = dict()
@@ -442,22 +632,34 @@ class HTTPConsumer(CustodiaPlugin):
             raise HTTPError(501)
         trail = request.get('trail', None)
         if trail is not None:
-            for comp in trail:
+            while trail:
                 subs = getattr(base, 'subs', {})
-                if comp in subs:
-                    base = subs[comp]
-                    trail.pop(0)
+                if trail[0] in subs:
+                    base = subs[trail.pop(0)]
                 else:
                     break
 
-        handler = getattr(base, command)
+        handler = getattr(base, command, None)
+        if handler is None and command == 'HEAD':
+            # HEAD is GET without the body
+            handler = getattr(base, 'GET', None)
         if handler is None:
-            raise HTTPError(400)
+            raise HTTPError(405)
 
         return handler
 
     def handle(self, request):
-        handler = self._find_handler(request)
+        """Handle a request
+
+        The server passes the handler method, that it has already
+        resolved with its routing trie, in request['handler']. Otherwise
+        the handler is looked up in the consumer and its sub-consumers.
+        """
+        # consumed here, a consumer that passes the request on to another
+        # consumer must not call the handler of this one
+        handler = request.pop('handler', None)
+        if handler is None:
+            handler = self._find_handler(request)
         response = {'headers': dict()}
 
         # Handle request
@@ -475,16 +677,18 @@ class HTTPConsumer(CustodiaPlugin):
 
         response['output'] = output
 
-        if output is not None and not hasattr(output, 'read') \
+        streaming = hasattr(output, 'read') or _is_iterator(output)
+        if output is not None and not streaming \
                 and not isinstance(output, six.binary_type):
             msg = "Handler {} returned unsupported type {} ({}):\n{!r}"
             raise TypeError(msg.format(handler, type(output), ct, output))
 
         if output is not None and 'Content-Length' not in response['headers']:
             if hasattr(output, 'read'):
-                # LOG: warning file-type objects should set Content-Length
-                pass
-            else:
+                size = _remaining_size(output)
+                if size is not None:
+                    response['headers']['Content-Length'] = str(size)
+            elif not streaming:
                 response['headers']['Content-Length'] = str(len(output))
 
         return response
@@ -0,0 +1,121 @@
+# Copyright (C) 2026  Custodia Project Contributors - see LICENSE file
+"""Background removal of expired keys
+
+Stores hide expired keys right away, but their rows stay in the storage
+until the keys are written again. The reaper is a process, that is forked
+once the plugins are loaded. It calls reap() of the stores every
+'reap_interval' seconds, the stores remove the expired keys in bulk. A
+reaper that dies is logged and restarted by its Supervisor.
+"""
+from __future__ import absolute_import
+
+import errno
+import os
+import select
+import signal
+import time
+
+from custodia import log
+from custodia.httpd.supervisor import Supervisor, fork_child
+
+logger = log.getLogger(__name__)
+
+
+def _top_stores(stores):
+    """Stores with expiring keys that are not backing an overlay
+
+    Overlays pass reap() on to their backing store and invalidate their
+    caches, every stack of stores is reaped from the top.
+    """
+    backing = set(getattr(store, 'store_name', None)
+                  for store in stores.values())
+    return [stores[name] for name in sorted(stores)
+            if name not in backing and stores[name].expiring_keys]
+
+
+class Reaper(object):
+    """Call reap() of the stores in a supervised process
+
+    The server forks a Supervisor, that runs the reaper in a child of its
+    own and restarts it when it dies. Both exit once the server is gone,
+    the server holds the write end of a pipe and the reaper waits for the
+    end of the file between its runs.
+    """
+
+    def __init__(self, stores, interval):
+        self.stores = stores
+        self.interval = interval
+        self.parent = None
+        self.pid = None
+        self._pipe = None
+
+    def reap(self):
+        """Reap all stores once, returns the number of removed keys
+        """
+        removed = 0
+        for store in self.stores:
+            try:
+                removed += len(store.reap())
+            except Exception:  # pylint: disable=broad-except
+                logger.exception('Failed to remove expired keys of %s',
+                                 store.section)
+        return removed
+
+    def start(self):
+        self.parent = os.getpid()
+        rfd, wfd = os.pipe()
+        self.pid = fork_child(self._supervise, 'reaper supervisor', rfd, wfd)
+        os.close(rfd)
+        self._pipe = wfd
+        logger.debug('Started reaper supervisor (pid %i)', self.pid)
+        return self.pid
+
+    def _supervise(self, rfd, wfd):
+        os.close(wfd)
+        self._pipe = rfd
+        Supervisor(1, self.run, name='reaper').run()
+
+    def run(self, worker_id=0):
+        deadline = time.monotonic()
+        while True:
+            if time.monotonic() >= deadline:
+                removed = self.reap()
+                if removed:
+                    logger.info('Removed %i expired keys', removed)
+                deadline = time.monotonic() + self.interval
+            readable, _, _ = select.select(
+                [self._pipe], [], [], max(0, deadline - time.monotonic()))
+            if readable:
+                # the server is gone, the supervisor must not restart us
+                os.kill(os.getppid(), signal.SIGTERM)
+                return
+
+    def stop(self):
+        # forked children of the server don't own the reaper
+        if self.pid is None or os.getpid() != self.parent:
+            return
+        os.close(self._pipe)
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+            os.waitpid(self.pid, 0)
+        except OSError as e:
+            # gone or already waited for by the supervisor of the server
+            if e.errno not in (errno.ESRCH, errno.ECHILD):
+                raise
+        self.pid = None
+
+
+def start_reaper(config):
+    """Fork the reaper for the stores in config['stores']
+
+    Returns None when 'reap_interval' is 0 or no store has expiring keys.
+    """
+    interval = float(config.get('reap_interval', 60.0))
+    if interval <= 0:
+        return None
+    stores = _top_stores(config.get('stores', {}))
+    if not stores:
+        return None
+    reaper = Reaper(stores, interval)
+    reaper.start()
+    return reaper
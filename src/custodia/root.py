@@ -15,6 +15,11 @@ class Root(HTTPConsumer):
         if self.store_name is not None:
             self.add_sub('secrets', Secrets(config, section))
 
+    def finalize_init(self, config, cfgparser, context=None):
+        super(Root, self).finalize_init(config, cfgparser, context)
+        for sub in self.subs.values():
+            sub.finalize_init(config, cfgparser, context)
+
     def GET(self, request, response):
         msg = json.dumps({'message': "Quis custodiet ipsos custodes?"})
         return msg.encode('utf-8')
@@ -1,11 +1,16 @@
 # Copyright (C) 2015  Custodia Project Contributors - see LICENSE file
 from __future__ import absolute_import
 
+import hashlib
 import json
 import os
+import time
 from base64 import b64decode, b64encode
+from base64 import urlsafe_b64encode
+from email.utils import formatdate
 
 from custodia import log
+from custodia import watch
 from custodia.message.common import UnallowedMessage
 from custodia.message.common import UnknownMessageType
 from custodia.message.formats import Validator
@@ -15,13 +20,124 @@ from custodia.plugin import (
 from custodia.plugin import HTTPConsumer, HTTPError, PluginOption
 
 
+# multiple of 3, so base64 chunks can be concatenated
+B64_CHUNK_SIZE = 48 * 1024
+
+# POST <container>/_batch runs several key operations
+BATCH_RESOURCE = '_batch'
+
+# GET ...?wait=<seconds> blocks while If-None-Match matches the ETag
+WAIT_PARAMETER = 'wait'
+
+# GET <container>/?limit=<n>&cursor=<token> lists a container in pages,
+# the token of the next page is returned in a header
+LIMIT_PARAMETER = 'limit'
+CURSOR_PARAMETER = 'cursor'
+CURSOR_HEADER = 'X-Custodia-Cursor'
+
+# GET <container>/?recursive=false lists the direct children only
+RECURSIVE_PARAMETER = 'recursive'
+
+# GET <key>?version=<n> reads a kept version, POST restores it,
+# GET <key>?history=true lists the kept versions
+VERSION_PARAMETER = 'version'
+HISTORY_PARAMETER = 'history'
+
+# PUT <key>?ttl=<seconds> or ?expires=<seconds since the epoch> stores a
+# key that expires, the expiry time is returned in a header
+TTL_PARAMETER = 'ttl'
+EXPIRES_PARAMETER = 'expires'
+EXPIRES_HEADER = 'X-Custodia-Expires'
+
+# query parameters, that are not part of the message
+CONTROL_PARAMETERS = (WAIT_PARAMETER, LIMIT_PARAMETER, CURSOR_PARAMETER,
+                      RECURSIVE_PARAMETER, VERSION_PARAMETER,
+                      HISTORY_PARAMETER, TTL_PARAMETER, EXPIRES_PARAMETER)
+
+# listings are streamed as JSON lines, a name per line
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
+NDJSON_CHUNK_SIZE = 64 * 1024
+
+
+def _read_body(body):
+    if hasattr(body, 'read'):
+        return body.read()
+    return bytes(body)
+
+
+def _b64encode_body(body):
+    """Base64 encode a bytes or file-like body without a raw copy
+    """
+    if not hasattr(body, 'read'):
+        return b64encode(bytes(body)).decode('utf-8')
+    value = bytearray()
+    rest = b''
+    while True:
+        chunk = body.read(B64_CHUNK_SIZE)
+        if not chunk:
+            break
+        chunk = rest + chunk
+        cut = len(chunk) - len(chunk) % 3
+        value += b64encode(chunk[:cut])
+        rest = chunk[cut:]
+    value += b64encode(rest)
+    return value.decode('utf-8')
+
+
+def _is_child(name):
+    # direct children, containers end in '/'
+    return '/' not in name.rstrip('/')
+
+
+def _ndjson_chunks(names):
+    """Encode names as JSON lines, joined to chunks of about 64 KiB
+    """
+    lines = []
+    size = 0
+    for name in names:
+        line = (json.dumps(name) + '\n').encode('utf-8')
+        lines.append(line)
+        size += len(line)
+        if size >= NDJSON_CHUNK_SIZE:
+            yield b''.join(lines)
+            lines = []
+            size = 0
+    if lines:
+        yield b''.join(lines)
+
+
 class Secrets(HTTPConsumer):
     allowed_keytypes = PluginOption('str_set', 'simple', None)
     store = PluginOption('store', None, None)
+    batch_max_items = PluginOption(
+        int, 100, 'Maximum number of operations in a batch request')
+    max_wait = PluginOption(
+        float, 30.0, 'Maximum seconds a GET waits for a change')
+    max_page_size = PluginOption(
+        int, 1000, 'Maximum number of names in a page of a listing')
+    # without a change notifier the store is polled
+    wait_poll_interval = 1.0
+    # binary secrets are encoded while the body is read
+    stream_body = True
+
+    # batch method -> handler, audit action for denied items
+    batch_methods = {
+        'GET': ('_get_key', log.AUDIT_GET_DENIED),
+        'PUT': ('_set_key', log.AUDIT_SET_DENIED),
+        'DELETE': ('_del_key', log.AUDIT_DEL_DENIED),
+    }
 
     def __init__(self, config, section):
         super(Secrets, self).__init__(config, section)
         self._validator = Validator(self.allowed_keytypes)
+        # every operation of a batch is authorized on its own
+        self.authorizers = None
+
+    def finalize_init(self, config, cfgparser, context=None):
+        super(Secrets, self).finalize_init(config, cfgparser, context)
+        self.authorizers = config.get('authorizers')
+        # shared memory, see custodia.cache
+        watch.install_notifier(config)
 
     def _db_key(self, trail):
         if len(trail) < 2:
@@ -54,6 +170,9 @@ class Secrets(HTTPConsumer):
     def _parse_query(self, request, name):
         # default to simple
         query = request.get('query', '')
+        if isinstance(query, dict):
+            query = dict((k, v) for k, v in query.items()
+                         if k not in CONTROL_PARAMETERS)
         if len(query) == 0:
             query = {'type': 'simple', 'value': ''}
         return self._parse(request, query, name)
@@ -62,7 +181,18 @@ class Secrets(HTTPConsumer):
         body = request.get('body')
         if body is None:
             raise HTTPError(400)
-        value = b64encode(bytes(body)).decode('utf-8')
+        if self.root.store.binary_values:
+            value = _read_body(body)
+            if value:
+                # stored as it is, checks that 'simple' is allowed
+                msg = self._parse(request, {'type': 'simple', 'value': ''},
+                                  name)
+                msg.payload = value
+                return msg
+            # an empty value would look like a container
+            value = ''
+        else:
+            value = _b64encode_body(body)
         payload = {'type': 'simple', 'value': value}
         return self._parse(request, payload, name)
 
@@ -70,7 +200,7 @@ class Secrets(HTTPConsumer):
         body = request.get('body')
         if body is None:
             raise HTTPError(400)
-        value = json.loads(bytes(body).decode('utf-8'))
+        value = json.loads(_read_body(body).decode('utf-8'))
         return self._parse(request, value, name)
 
     def _parse_maybe_body(self, request, name):
@@ -78,21 +208,21 @@ class Secrets(HTTPConsumer):
         if body is None:
             value = {'type': 'simple', 'value': ''}
         else:
-            value = json.loads(bytes(body).decode('utf-8'))
+            value = json.loads(_read_body(body).decode('utf-8'))
         return self._parse(request, value, name)
 
     def _parent_exists(self, default, trail):
         # check that the containers exist
         basename = self._db_container_key(trail[0], trail[:-1] + [''])
         try:
-            keylist = self.root.store.list(basename)
+            exists = self.root.store.exists(basename)
         except CSStoreError:
             raise HTTPError(500)
 
         self.logger.debug('parent_exists: %s (%s, %r) -> %r',
-                          basename, default, trail, keylist)
+                          basename, default, trail, exists)
 
-        if keylist is not None:
+        if exists:
             return True
 
         # create default namespace if it is the only missing piece
@@ -104,20 +234,19 @@ class Secrets(HTTPConsumer):
         return False
 
     def _format_reply(self, request, response, handler, output):
+        if isinstance(output, bytes) and self.root.store.binary_values:
+            # a binary value, messages carry it base64 encoded
+            if (handler.msg_type == 'simple'
+                    and self._accepts_binary(request)):
+                response['headers'][
+                    'Content-Type'] = 'application/octet-stream'
+                response['output'] = output
+                return
+            output = b64encode(output).decode('ascii')
         reply = handler.reply(output)
         # special case to allow *very* simple clients
         if handler.msg_type == 'simple':
-            binary = False
-            accept = request.get('headers', {}).get('Accept', None)
-            if accept is not None:
-                types = accept.split(',')
-                for t in types:
-                    if t.strip() == 'application/json':
-                        binary = False
-                        break
-                    elif t.strip() == 'application/octet-stream':
-                        binary = True
-            if binary is True:
+            if self._accepts_binary(request):
                 response['headers'][
                     'Content-Type'] = 'application/octet-stream'
                 response['output'] = b64decode(reply['value'])
@@ -128,6 +257,28 @@ class Secrets(HTTPConsumer):
                 'Content-Type'] = 'application/json; charset=utf-8'
             response['output'] = reply
 
+    def _accepts_binary(self, request):
+        binary = False
+        accept = request.get('headers', {}).get('Accept', None)
+        if accept is not None:
+            types = accept.split(',')
+            for t in types:
+                if t.strip() == 'application/json':
+                    binary = False
+                    break
+                elif t.strip() == 'application/octet-stream':
+                    binary = True
+        return binary
+
+    def _accepts_ndjson(self, request):
+        accept = request.get('headers', {}).get('Accept', None)
+        if accept is None:
+            return False
+        for t in accept.split(','):
+            if t.split(';')[0].strip() == NDJSON_CONTENT_TYPE:
+                return True
+        return False
+
     def GET(self, request, response):
         trail = request.get('trail', [])
         if len(trail) == 0 or trail[-1] == '':
@@ -135,6 +286,13 @@ class Secrets(HTTPConsumer):
         else:
             self._get_key(trail, request, response)
 
+    def HEAD(self, request, response):
+        trail = request.get('trail', [])
+        if len(trail) == 0 or trail[-1] == '':
+            self._head_container(trail, request, response)
+        else:
+            self._head_key(trail, request, response)
+
     def PUT(self, request, response):
         trail = request.get('trail', [])
         if len(trail) == 0 or trail[-1] == '':
@@ -155,6 +313,11 @@ class Secrets(HTTPConsumer):
         trail = request.get('trail', [])
         if len(trail) > 0 and trail[-1] == '':
             self._create(trail, request, response)
+        elif len(trail) > 0 and trail[-1] == BATCH_RESOURCE:
+            self._batch(trail, request, response)
+        elif (len(trail) > 0
+                and self._query_value(request, VERSION_PARAMETER)):
+            self._restore_key(trail, request, response)
         else:
             raise HTTPError(405)
 
@@ -166,11 +329,27 @@ class Secrets(HTTPConsumer):
             raise HTTPError(406, str(e))
         default = request.get('default_namespace', None)
         basename = self._db_container_key(default, trail)
+        page = self._page(request)
+        recursive = self._recursive(request)
         try:
-            keylist = self.root.store.list(basename)
+            if (page is None and msg.msg_type == 'simple'
+                    and self._accepts_ndjson(request)):
+                self._list_stream(basename, recursive, response)
+                return
+            etag, (keylist, last), not_modified = self._watch(
+                request, basename,
+                lambda: self._lookup_list(basename, page, recursive))
             self.logger.debug('list %s returned %r', basename, keylist)
             if keylist is None:
                 raise HTTPError(404)
+            response['headers']['ETag'] = etag
+            if last is not None:
+                cursor = urlsafe_b64encode(last.encode('utf-8'))
+                response['headers'][CURSOR_HEADER] = (
+                    cursor.decode('ascii').rstrip('='))
+            if not_modified:
+                response['code'] = 304
+                return
             response['headers'][
                 'Content-Type'] = 'application/json; charset=utf-8'
             response['output'] = msg.reply(keylist)
@@ -185,6 +364,257 @@ class Secrets(HTTPConsumer):
             self.logger.exception('List: Unsupported operation')
             raise HTTPError(501)
 
+    def _stat_headers(self, stat, response):
+        """Describe a key or container with response headers
+        """
+        headers = response['headers']
+        headers['Content-Type'] = 'application/json; charset=utf-8'
+        etag = self._etag(stat)
+        if etag is not None:
+            headers['ETag'] = etag
+            headers['X-Custodia-Version'] = str(stat['version'])
+        if stat.get('modified'):
+            headers['Last-Modified'] = formatdate(stat['modified'],
+                                                  usegmt=True)
+        if 'size' in stat:
+            headers['X-Custodia-Size'] = str(stat['size'])
+        self._expires_header(stat, response)
+
+    def _expires_header(self, stat, response):
+        if stat.get('expires'):
+            response['headers'][EXPIRES_HEADER] = formatdate(
+                stat['expires'], usegmt=True)
+
+    def _etag(self, stat):
+        """Strong ETag of a stored version or None
+        """
+        if stat is None or 'version' not in stat or 'modified' not in stat:
+            return None
+        # the time tells apart keys that were deleted and created again
+        return '"{:x}-{:x}"'.format(stat['version'],
+                                    int(stat['modified'] * 1000000))
+
+    def _lookup_key(self, key):
+        stat = self.root.store.stat(key)
+        return self._etag(stat), stat
+
+    def _list_stream(self, basename, recursive, response):
+        names = self.root.store.list_iter(basename, self.max_page_size)
+        if names is None:
+            raise HTTPError(404)
+        if not recursive:
+            names = (name for name in names if _is_child(name))
+        response['headers']['Content-Type'] = NDJSON_CONTENT_TYPE
+        response['output'] = _ndjson_chunks(names)
+
+    def _list_page(self, basename, limit, after, recursive):
+        """Fetch a page of at most 'limit' names after 'after'
+
+        Without 'recursive' the descendants of sub-containers are left
+        out. Store pages are fetched until the page is full or the
+        listing ends, a page is never empty when more names follow.
+        """
+        keylist = []
+        last = after
+        while True:
+            result = self.root.store.list_page(basename, limit, last)
+            if result is None:
+                return None, None
+            names, last = result
+            if not recursive:
+                names = [name for name in names if _is_child(name)]
+            keylist.extend(names)
+            if last is None or len(keylist) >= limit:
+                break
+        if len(keylist) > limit:
+            keylist = keylist[:limit]
+            last = keylist[-1]
+        return keylist, last
+
+    def _lookup_list(self, basename, page=None, recursive=True):
+        if page is None:
+            keylist, last = self.root.store.list(basename), None
+            if keylist is not None and not recursive:
+                keylist = [name for name in keylist if _is_child(name)]
+        else:
+            keylist, last = self._list_page(basename, page[0], page[1],
+                                            recursive)
+        if keylist is None:
+            return None, (None, None)
+        # changes when keys are added or removed, not when values change
+        digest = hashlib.sha256(
+            json.dumps([sorted(keylist), last]).encode('utf-8')).hexdigest()
+        return '"{}"'.format(digest[:32]), (keylist, last)
+
+    def _query_value(self, request, name):
+        query = request.get('query')
+        if not isinstance(query, dict) or name not in query:
+            return None
+        value = query[name]
+        if isinstance(value, list):
+            if len(value) != 1:
+                raise HTTPError(400, '{} is multivalued'.format(name))
+            value = value[0]
+        return value
+
+    def _page(self, request):
+        """Return (limit, after) of a paged listing or None
+        """
+        limit = self._query_value(request, LIMIT_PARAMETER)
+        cursor = self._query_value(request, CURSOR_PARAMETER)
+        if limit is None and cursor is None:
+            return None
+        if limit is None:
+            limit = self.max_page_size
+        else:
+            try:
+                limit = int(limit)
+            except (TypeError, ValueError):
+                raise HTTPError(400, 'Invalid limit')
+            if limit < 1:
+                raise HTTPError(400, 'Invalid limit')
+            limit = min(limit, self.max_page_size)
+        after = None
+        if cursor:
+            # opaque to clients, the position of the store
+            cursor += '=' * (-len(cursor) % 4)
+            try:
+                after = b64decode(cursor.encode('ascii'), altchars=b'-_',
+                                  validate=True).decode('utf-8')
+            except (TypeError, ValueError):
+                raise HTTPError(400, 'Invalid cursor')
+        return limit, after
+
+    def _flag(self, request, name, default):
+        value = self._query_value(request, name)
+        if value is None:
+            return default
+        if value.lower() in ('true', 'yes', '1'):
+            return True
+        if value.lower() in ('false', 'no', '0'):
+            return False
+        raise HTTPError(400, 'Invalid value of {}'.format(name))
+
+    def _recursive(self, request):
+        return self._flag(request, RECURSIVE_PARAMETER, True)
+
+    def _version(self, request):
+        value = self._query_value(request, VERSION_PARAMETER)
+        if value is None:
+            return None
+        try:
+            version = int(value)
+        except (TypeError, ValueError):
+            raise HTTPError(400, 'Invalid version')
+        if version < 1:
+            raise HTTPError(400, 'Invalid version')
+        return version
+
+    def _expires(self, request):
+        """Expiry time of a PUT in seconds since the epoch or None
+        """
+        ttl = self._query_value(request, TTL_PARAMETER)
+        expires = self._query_value(request, EXPIRES_PARAMETER)
+        if ttl is None and expires is None:
+            return None
+        if ttl is not None and expires is not None:
+            raise HTTPError(400, 'ttl and expires are mutually exclusive')
+        try:
+            value = float(expires if ttl is None else ttl)
+        except (TypeError, ValueError):
+            raise HTTPError(400, 'Invalid expiry time')
+        if ttl is not None:
+            value += time.time()
+        # also rejects NaN
+        if not time.time() < value < float('inf'):
+            raise HTTPError(400, 'Invalid expiry time')
+        return value
+
+    def _wait_time(self, request):
+        value = self._query_value(request, WAIT_PARAMETER)
+        if value is None:
+            return 0.0
+        try:
+            seconds = float(value)
+        except (TypeError, ValueError):
+            raise HTTPError(400, 'Invalid wait time')
+        if seconds != seconds:
+            # NaN
+            raise HTTPError(400, 'Invalid wait time')
+        return max(0.0, min(seconds, self.max_wait))
+
+    def _watch(self, request, name, lookup):
+        """Look up the current version, wait while it is not modified
+
+        lookup() returns an (etag, value) tuple. As long as the ETag
+        matches If-None-Match, the request waits up to 'wait' seconds
+        for a change of 'name'. Returns (etag, value, not_modified).
+        """
+        deadline = time.monotonic() + self._wait_time(request)
+        notifier = watch.get_notifier()
+        waiting = False
+        try:
+            while True:
+                # read before the lookup, a change in between is not missed
+                counter = None if notifier is None else notifier.counter(name)
+                etag, value = lookup()
+                if etag is None or not self._not_modified(request, etag):
+                    return etag, value, False
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return etag, value, True
+                if notifier is None:
+                    time.sleep(min(remaining, self.wait_poll_interval))
+                    continue
+                if not waiting:
+                    waiting = notifier.acquire_waiter()
+                    if not waiting:
+                        # the pool is not filled up with waiters
+                        self.logger.debug('Too many waiters for %s', name)
+                        return etag, value, True
+                # a hash collision wakes us up early, the loop checks again
+                notifier.wait(name, counter, remaining)
+        finally:
+            if waiting:
+                notifier.release_waiter()
+
+    def _not_modified(self, request, etag):
+        value = request.get('headers', {}).get('If-None-Match')
+        if not value:
+            return False
+        for tag in value.split(','):
+            tag = tag.strip()
+            if tag.startswith('W/'):
+                # weak comparison
+                tag = tag[2:]
+            if tag == '*' or tag == etag:
+                return True
+        return False
+
+    def _head_container(self, trail, request, response):
+        try:
+            name = '/'.join(trail)
+            self._parse_query(request, name)
+        except Exception as e:
+            raise HTTPError(406, str(e))
+        default = request.get('default_namespace', None)
+        basename = self._db_container_key(default, trail)
+        try:
+            stat = self.root.store.stat(basename)
+        except CSStoreDenied:
+            self.logger.exception(
+                "Head: Permission to perform this operation was denied")
+            raise HTTPError(403)
+        except CSStoreError:
+            self.logger.exception('Head: Internal server error')
+            raise HTTPError(500)
+        except CSStoreUnsupported:
+            self.logger.exception('Head: Unsupported operation')
+            raise HTTPError(501)
+        if stat is None:
+            raise HTTPError(404)
+        self._stat_headers(stat, response)
+
     def _create(self, trail, request, response):
         try:
             name = '/'.join(trail)
@@ -230,10 +660,10 @@ class Secrets(HTTPConsumer):
             raise HTTPError(406, str(e))
         basename = self._db_container_key(None, trail)
         try:
-            keylist = self.root.store.list(basename)
-            if keylist is None:
+            stat = self.root.store.stat(basename)
+            if stat is None:
                 raise HTTPError(404)
-            if len(keylist) != 0:
+            if not stat['empty']:
                 raise HTTPError(409)
             ret = self.root.store.cut(basename.rstrip('/'))
         except CSStoreDenied:
@@ -259,6 +689,128 @@ class Secrets(HTTPConsumer):
             response['output'] = output
             response['code'] = 200
 
+    def _batch(self, trail, request, response):
+        try:
+            body = request.get('body')
+            if body is None:
+                raise ValueError('Missing body')
+            items = json.loads(_read_body(body).decode('utf-8'))
+            if not isinstance(items, list):
+                raise ValueError('The batch must be a list')
+        except Exception as e:
+            raise HTTPError(400, str(e))
+        if len(items) > self.batch_max_items:
+            raise HTTPError(413, 'Too many operations')
+
+        subs = [self._batch_request(request, trail[:-1], item)
+                for item in items]
+        results = []
+        for i, sub in enumerate(subs):
+            if isinstance(sub, HTTPError):
+                results.append(self._batch_result(items[i], sub))
+                continue
+            if sub['command'] == 'GET' and 'batch_values' not in sub:
+                self._batch_prefetch(subs[i:])
+            rep = {'headers': dict()}
+            handler = getattr(self, self.batch_methods[sub['command']][0])
+            try:
+                handler(sub['trail'], sub, rep)
+            except HTTPError as e:
+                results.append(self._batch_result(items[i], e))
+            else:
+                results.append(self._batch_result(items[i], rep))
+
+        response['headers'][
+            'Content-Type'] = 'application/json; charset=utf-8'
+        response['output'] = results
+        response['code'] = 200
+
+    def _batch_request(self, request, base, item):
+        """Authorized request for a batch item or an HTTPError
+        """
+        try:
+            method = item['method']
+            name = item['name']
+            if method not in self.batch_methods:
+                raise ValueError('Unsupported method')
+            parts = name.split('/')
+            if any(p in ('', '.', '..') for p in parts):
+                raise ValueError('Invalid name')
+        except Exception as e:  # pylint: disable=broad-except
+            return HTTPError(400, str(e))
+
+        sub = dict(request)
+        sub['command'] = method
+        sub['trail'] = base + parts
+        sub['query'] = item.get('query', '')
+        sub['headers'] = {'Content-Type': 'application/json'}
+        sub['body'] = None
+        if method == 'PUT':
+            sub['body'] = json.dumps(item.get('value')).encode('utf-8')
+        # replace the trailing _batch component
+        if 'path' in request:
+            path = request['path']
+            sub['path'] = path[:path.rindex('/') + 1] + name
+        else:
+            sub['path'] = '/'.join([''] + sub['trail'])
+        if 'path_chain' in request:
+            sub['path_chain'] = tuple(request['path_chain'][:-1]) + tuple(
+                parts)
+
+        if not self._authorize(sub):
+            self.audit_key_access(self.batch_methods[method][1],
+                                  self._client_name(request),
+                                  '/'.join(sub['trail']))
+            return HTTPError(403)
+        return sub
+
+    def _authorize(self, request):
+        """Run the authorizers like the server does for every request
+        """
+        if not self.authorizers:
+            return False
+        authz_ok = None
+        for authz in self.authorizers:
+            valid = self.authorizers[authz].handle(request)
+            if valid is True:
+                authz_ok = True
+            elif valid is False:
+                return False
+        return authz_ok is True
+
+    def _batch_prefetch(self, subs):
+        """Fetch the keys of consecutive GET items with one store call
+        """
+        values = {}
+        keys = []
+        for sub in subs:
+            if isinstance(sub, HTTPError):
+                continue
+            if sub['command'] != 'GET':
+                break
+            sub['batch_values'] = values
+            try:
+                keys.append(self._db_key(sub['trail']))
+            except HTTPError:
+                pass
+        try:
+            values.update(self.root.store.get_many(keys))
+        except (CSStoreDenied, CSStoreError, CSStoreUnsupported):
+            # every item reports its own error
+            self.logger.debug('Batch prefetch failed', exc_info=True)
+
+    def _batch_result(self, item, result):
+        name = item.get('name') if isinstance(item, dict) else None
+        if isinstance(result, HTTPError):
+            reply = {'name': name, 'code': result.code}
+            if result.mesg is not None:
+                reply['message'] = result.mesg
+            return reply
+        reply = {'name': name, 'code': result.get('code', 200)}
+        if result.get('output') is not None:
+            reply['output'] = result['output']
+        return reply
+
     def _client_name(self, request):
         if 'remote_user' in request:
             return request['remote_user']
@@ -289,8 +841,45 @@ class Secrets(HTTPConsumer):
         except Exception as e:
             raise HTTPError(406, str(e))
         key = self._db_key(trail)
+        version = self._version(request)
         try:
-            output = self.root.store.get(key)
+            if self._flag(request, HISTORY_PARAMETER, False):
+                versions = self.root.store.versions(key)
+                if versions is None:
+                    raise HTTPError(404)
+                response['headers'][
+                    'Content-Type'] = 'application/json; charset=utf-8'
+                response['output'] = versions
+                return
+            if version is not None:
+                output = self.root.store.get_version(key, version)
+                if output is None:
+                    raise HTTPError(404)
+                self._format_reply(request, response, handler, output)
+                return
+            values = request.get('batch_values')
+            store = self.root.store
+            if values is None and (store.versioned_keys
+                                   or store.expiring_keys):
+                # The version is looked up before the value, a concurrent
+                # change is never sent with the ETag of the old version.
+                # Other stores have neither an ETag nor an expiry, the
+                # fallback stat() would read the value twice.
+                etag, stat, not_modified = self._watch(
+                    request, key, lambda: self._lookup_key(key))
+                if stat is None:
+                    raise HTTPError(404)
+                self._expires_header(stat, response)
+                if etag is not None:
+                    response['headers']['ETag'] = etag
+                    if not_modified:
+                        # neither read nor decrypted
+                        response['code'] = 304
+                        return
+            if values is not None and key in values:
+                output = values[key]
+            else:
+                output = self.root.store.get(key)
             if output is None:
                 raise HTTPError(404)
             elif len(output) == 0:
@@ -307,6 +896,61 @@ class Secrets(HTTPConsumer):
             self.logger.exception('Get: Unsupported operation')
             raise HTTPError(501)
 
+    def _restore_key(self, trail, request, response):
+        self._audit(log.AUDIT_SET_ALLOWED, log.AUDIT_SET_DENIED,
+                    self._int_restore_key, trail, request, response)
+
+    def _int_restore_key(self, trail, request, response):
+        version = self._version(request)
+        key = self._db_key(trail)
+        try:
+            ok = self.root.store.restore(key, version)
+            stat = self.root.store.stat(key) if ok else None
+        except CSStoreDenied:
+            self.logger.exception(
+                "Restore: Permission to perform this operation was denied")
+            raise HTTPError(403)
+        except CSStoreError:
+            self.logger.exception('Restore: Internal server error')
+            raise HTTPError(500)
+        except CSStoreUnsupported:
+            self.logger.exception('Restore: Unsupported operation')
+            raise HTTPError(501)
+        if stat is None:
+            raise HTTPError(404)
+        self._stat_headers(stat, response)
+
+    def _head_key(self, trail, request, response):
+        self._audit(log.AUDIT_GET_ALLOWED, log.AUDIT_GET_DENIED,
+                    self._int_head_key, trail, request, response)
+
+    def _int_head_key(self, trail, request, response):
+        try:
+            name = '/'.join(trail)
+            self._parse_query(request, name)
+        except Exception as e:
+            raise HTTPError(406, str(e))
+        key = self._db_key(trail)
+        try:
+            # metadata only, the value is neither read nor decrypted
+            stat = self.root.store.stat(key)
+        except CSStoreDenied:
+            self.logger.exception(
+                "Head: Permission to perform this operation was denied")
+            raise HTTPError(403)
+        except CSStoreError:
+            self.logger.exception('Head: Internal server error')
+            raise HTTPError(500)
+        except CSStoreUnsupported:
+            self.logger.exception('Head: Unsupported operation')
+            raise HTTPError(501)
+        if stat is None:
+            raise HTTPError(404)
+        elif stat['container']:
+            # like GET of a key with an empty value
+            raise HTTPError(406)
+        self._stat_headers(stat, response)
+
     def _set_key(self, trail, request, response):
         self._audit(log.AUDIT_SET_ALLOWED, log.AUDIT_SET_DENIED,
                     self._int_set_key, trail, request, response)
@@ -334,6 +978,7 @@ class Secrets(HTTPConsumer):
         # otherwise users would e able to probe containers in namespaces
         # they do not have access to.
         key = self._db_key(trail)
+        expires = self._expires(request)
 
         try:
             default = request.get('default_namespace', None)
@@ -341,7 +986,10 @@ class Secrets(HTTPConsumer):
             if not ok:
                 raise HTTPError(404)
 
-            ok = self.root.store.set(key, msg.payload)
+            if expires is None:
+                ok = self.root.store.set(key, msg.payload)
+            else:
+                ok = self.root.store.set_expiring(key, msg.payload, expires)
         except CSStoreDenied:
             self.logger.exception(
                 "Set: Permission to perform this operation was denied")
@@ -10,6 +10,7 @@ import six
 
 from custodia import log
 from custodia.httpd.server import HTTPServer
+from custodia.reaper import start_reaper
 
 from .args import default_argparser
 from .args import parse_args as _parse_args
@@ -137,6 +138,12 @@ def main(argparser=None):
     logger.debug('Config file(s) %s loaded', config['configfiles'])
     # load plugins after logging
     _load_plugins(config, cfgparser)
-    # create and run server
-    httpd = HTTPServer(config['server_url'], config)
-    httpd.serve()
+    # forked before the server, it doesn't inherit the listening sockets
+    reaper = start_reaper(config)
+    try:
+        # create and run server
+        httpd = HTTPServer(config['server_url'], config)
+        httpd.serve()
+    finally:
+        if reaper is not None:
+            reaper.stop()
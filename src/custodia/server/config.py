@@ -110,10 +110,34 @@ class CustodiaConfig(object):
 
         config['tls_verify_client'] = self.parser.getboolean(
             'global', 'tls_verify_client', fallback=False)
+        config['tls_session_tickets'] = self.parser.getboolean(
+            'global', 'tls_session_tickets', fallback=True)
+        config['tls_handshake_timeout'] = self.parser.getfloat(
+            'global', 'tls_handshake_timeout', fallback=10.0)
         config['debug'] = self.parser.getboolean(
             'global', 'debug', fallback=False)
         config['makedirs'] = self.parser.getboolean(
             'global', 'makedirs', fallback=False)
+        config['server_engine'] = self.parser.get(
+            'global', 'server_engine', fallback='fork')
+        config['server_threads'] = self.parser.getint(
+            'global', 'server_threads', fallback=8)
+        config['server_keepalive_timeout'] = self.parser.getfloat(
+            'global', 'server_keepalive_timeout', fallback=0.0)
+        config['server_keepalive_requests'] = self.parser.getint(
+            'global', 'server_keepalive_requests', fallback=100)
+        config['server_workers'] = self.parser.getint(
+            'global', 'server_workers', fallback=0)
+        config['server_reuseport'] = self.parser.getboolean(
+            'global', 'server_reuseport', fallback=False)
+        config['server_worker_max_requests'] = self.parser.getint(
+            'global', 'server_worker_max_requests', fallback=0)
+        config['server_worker_max_memory'] = self.parser.getint(
+            'global', 'server_worker_max_memory', fallback=0)
+        config['server_max_waiters'] = self.parser.getint(
+            'global', 'server_max_waiters', fallback=None)
+        config['reap_interval'] = self.parser.getfloat(
+            'global', 'reap_interval', fallback=60.0)
         if self.args.debug:
             config['debug'] = self.args.debug
 
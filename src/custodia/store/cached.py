@@ -0,0 +1,209 @@
+# Copyright (C) 2026  Custodia Project Contributors - see LICENSE file
+from __future__ import absolute_import
+
+import json
+import time
+
+from custodia.cache import SharedCache
+from custodia.plugin import CSStore
+from custodia.plugin import PluginOption, REQUIRED
+
+
+class CachedOverlay(CSStore):
+    """Shared memory cache overlay for storage backends
+
+    Values returned by get() and get_many() and the stat() of keys are
+    cached in memory that is shared by all server processes. set(),
+    span(), cut() and their batch variants invalidate the keys. Stack the
+    overlay on top of an EncryptedOverlay to skip both the store read and
+    the JWE decryption, on top of the encrypted store to keep only
+    encrypted values in memory.
+
+    Values and stats of keys that expire are not cached beyond their
+    expiry time, a miss reads the stat() of the key to learn it.
+
+    Arguments:
+        backing_store (required):
+            name of backing storage
+        cache_ttl (default: 60):
+            seconds a cached value stays valid
+        cache_slots (default: 1024):
+            number of cached values
+        cache_slot_size (default: 8192):
+            maximum size of a cached value in bytes, larger values are
+            always read from the backing store
+    """
+    backing_store = PluginOption(str, REQUIRED, None)
+    cache_ttl = PluginOption(float, 60.0, 'TTL of cached values in seconds')
+    cache_slots = PluginOption(int, 1024, 'Number of cached values')
+    cache_slot_size = PluginOption(int, 8192, 'Max size of a cached value')
+
+    def __init__(self, config, section):
+        super(CachedOverlay, self).__init__(config, section)
+        self.store_name = self.backing_store
+        self.store = None
+        # shared memory, see custodia.cache
+        self.cache = SharedCache(slots=self.cache_slots,
+                                 slot_size=self.cache_slot_size,
+                                 ttl=self.cache_ttl)
+
+    @property
+    def binary_values(self):
+        return self.store.binary_values
+
+    @property
+    def versioned_keys(self):
+        return self.store.versioned_keys
+
+    @property
+    def expiring_keys(self):
+        return self.store.expiring_keys
+
+    def _pack(self, value):
+        # the first byte tells bytes and text apart
+        if isinstance(value, bytes):
+            return b'b' + value
+        return b't' + value.encode('utf-8')
+
+    def _unpack(self, data):
+        if data[:1] == b'b':
+            return bytes(data[1:])
+        return data[1:].decode('utf-8')
+
+    def _stat_key(self, key):
+        return key + '\0stat'
+
+    def _invalidate(self, key):
+        self.cache.invalidate(key)
+        self.cache.invalidate(self._stat_key(key))
+
+    def _ttl(self, key):
+        """Seconds until the key expires, None when it never expires
+        """
+        if not self.store.expiring_keys:
+            return None
+        stat = self.stat(key)
+        if stat is None:
+            # expired or removed since it was read, not cached
+            return 0
+        if stat.get('expires') is None:
+            return None
+        return stat['expires'] - time.time()
+
+    def get(self, key):
+        value = self.cache.get(key)
+        if value is not None:
+            return self._unpack(value)
+        generation = self.cache.generation(key)
+        value = self.store.get(key)
+        if value is not None:
+            self.cache.put(key, self._pack(value), generation,
+                           self._ttl(key))
+        return value
+
+    def get_many(self, keys):
+        result = {}
+        missing = []
+        for key in keys:
+            value = self.cache.get(key)
+            if value is not None:
+                result[key] = self._unpack(value)
+            else:
+                missing.append(key)
+        if missing:
+            generations = [self.cache.generation(key) for key in missing]
+            values = self.store.get_many(missing)
+            for key, generation in zip(missing, generations):
+                value = result[key] = values.get(key)
+                if value is not None:
+                    self.cache.put(key, self._pack(value), generation,
+                                   self._ttl(key))
+        return result
+
+    def get_version(self, key, version):
+        return self.store.get_version(key, version)
+
+    def versions(self, key):
+        return self.store.versions(key)
+
+    def restore(self, key, version):
+        try:
+            return self.store.restore(key, version)
+        finally:
+            self._invalidate(key)
+
+    def set(self, key, value, replace=False):
+        try:
+            return self.store.set(key, value, replace)
+        finally:
+            self._invalidate(key)
+
+    def set_many(self, items, replace=False):
+        items = list(items)
+        try:
+            return self.store.set_many(items, replace)
+        finally:
+            for key, _ in items:
+                self._invalidate(key)
+
+    def set_expiring(self, key, value, expires, replace=False):
+        try:
+            return self.store.set_expiring(key, value, expires, replace)
+        finally:
+            self._invalidate(key)
+
+    def reap(self):
+        keys = self.store.reap()
+        for key in keys:
+            self._invalidate(key)
+        return keys
+
+    def span(self, key):
+        try:
+            return self.store.span(key)
+        finally:
+            self._invalidate(key)
+
+    def exists(self, key):
+        return self.store.exists(key)
+
+    def stat(self, key):
+        if key.endswith('/'):
+            # containers change when keys below them change
+            return self.store.stat(key)
+        skey = self._stat_key(key)
+        cached = self.cache.get(skey)
+        if cached is not None:
+            return json.loads(cached.decode('utf-8'))
+        generation = self.cache.generation(skey)
+        stat = self.store.stat(key)
+        if stat is not None and not stat['container']:
+            ttl = None
+            if stat.get('expires') is not None:
+                ttl = stat['expires'] - time.time()
+            self.cache.put(skey, json.dumps(stat).encode('utf-8'),
+                           generation, ttl)
+        return stat
+
+    def list(self, keyfilter=''):
+        return self.store.list(keyfilter)
+
+    def list_page(self, keyfilter, limit, after=None):
+        return self.store.list_page(keyfilter, limit, after)
+
+    def list_iter(self, keyfilter, page_size=1000):
+        return self.store.list_iter(keyfilter, page_size)
+
+    def cut(self, key):
+        try:
+            return self.store.cut(key)
+        finally:
+            self._invalidate(key)
+
+    def cut_many(self, keys):
+        keys = list(keys)
+        try:
+            return self.store.cut_many(keys)
+        finally:
+            for key in keys:
+                self._invalidate(key)
@@ -10,6 +10,9 @@ from jwcrypto.jwk import JWK
 from custodia.plugin import CSStore, CSStoreError
 from custodia.plugin import PluginOption, REQUIRED
 
+# JWE content type of binary values, text is UTF-8 encoded
+BINARY_CTY = 'application/octet-stream'
+
 
 class EncryptedOverlay(CSStore):
     """Encrypted overlay for storage backends
@@ -30,6 +33,8 @@ class EncryptedOverlay(CSStore):
             add data, to prevent key swapping in the db
             - 'migrate': as pinning, but on missing key information the
             secret is updated instead of throwing an exception.
+
+    Binary values are encrypted as they are, the JWE has a 'cty' header.
     """
     key_sizes = {
         'A128CBC-HS256': 256,
@@ -42,6 +47,8 @@ class EncryptedOverlay(CSStore):
     autogen_master_key = PluginOption(bool, False, None)
     secret_protection = PluginOption(str, False, 'encrypt')
 
+    binary_values = True
+
     def __init__(self, config, section):
         super(EncryptedOverlay, self).__init__(config, section)
         self.store_name = self.backing_store
@@ -63,46 +70,127 @@ class EncryptedOverlay(CSStore):
             key = json_decode(data)
             self.mkey = JWK(**key)
 
-    def get(self, key):
-        value = self.store.get(key)
-        if value is None:
-            return None
+    def _decrypt(self, key, value):
+        """Decrypt a value, returns (value, pinned key or None)
+        """
         try:
             jwe = JWE()
             jwe.deserialize(value, self.mkey)
-            value = jwe.payload.decode('utf-8')
+            value = jwe.payload
+            if jwe.jose_header.get('cty') != BINARY_CTY:
+                value = value.decode('utf-8')
         except Exception as err:
             self.logger.error("Error parsing key %s: [%r]" % (key, repr(err)))
             raise CSStoreError('Error occurred while trying to parse key')
         if self.secret_protection == 'encrypt':
-            return value
+            return value, None
         if 'custodia.key' not in jwe.jose_header:
             if self.secret_protection == 'migrate':
-                self.set(key, value, replace=True)
-            else:
-                raise CSStoreError('Secret Pinning check failed!'
-                                   + 'Missing custodia.key element')
+                return value, key
+            raise CSStoreError('Secret Pinning check failed!'
+                               + 'Missing custodia.key element')
         elif jwe.jose_header['custodia.key'] != key:
             raise CSStoreError(
                 'Secret Pinning check failed! Expected {} got {}'.format(
                     key, jwe.jose_header['custodia.key']))
+        return value, None
+
+    def _encrypt(self, items):
+        """Encrypt (key, value) pairs, returns a list of (key, JWE) pairs
+        """
+        header = {'alg': 'dir', 'enc': self.master_enctype}
+        result = []
+        for key, value in items:
+            header.pop('cty', None)
+            if isinstance(value, bytes):
+                header['cty'] = BINARY_CTY
+            if self.secret_protection != 'encrypt':
+                header['custodia.key'] = key
+            jwe = JWE(value, json_encode(header))
+            jwe.add_recipient(self.mkey)
+            result.append((key, jwe.serialize(compact=True)))
+        self.protected_header = header
+        return result
+
+    def get(self, key):
+        value = self.store.get(key)
+        if value is None:
+            return None
+        value, migrate = self._decrypt(key, value)
+        if migrate is not None:
+            self.set(key, value, replace=True)
+        return value
+
+    def get_many(self, keys):
+        result = self.store.get_many(keys)
+        migrate = []
+        for key, value in result.items():
+            if value is None:
+                continue
+            result[key], pinned = self._decrypt(key, value)
+            if pinned is not None:
+                migrate.append((key, result[key]))
+        if migrate:
+            self.set_many(migrate, replace=True)
+        return result
+
+    def get_version(self, key, version):
+        value = self.store.get_version(key, version)
+        if value is None:
+            return None
+        # old versions are not migrated
+        value, _ = self._decrypt(key, value)
         return value
 
+    def versions(self, key):
+        return self.store.versions(key)
+
+    def restore(self, key, version):
+        # the encrypted value is restored as it is
+        return self.store.restore(key, version)
+
     def set(self, key, value, replace=False):
-        self.protected_header = {'alg': 'dir', 'enc': self.master_enctype}
-        if self.secret_protection != 'encrypt':
-            self.protected_header['custodia.key'] = key
-        protected = json_encode(self.protected_header)
-        jwe = JWE(value, protected)
-        jwe.add_recipient(self.mkey)
-        cvalue = jwe.serialize(compact=True)
+        key, cvalue = self._encrypt([(key, value)])[0]
         return self.store.set(key, cvalue, replace)
 
+    def set_many(self, items, replace=False):
+        return self.store.set_many(self._encrypt(items), replace)
+
+    @property
+    def versioned_keys(self):
+        return self.store.versioned_keys
+
+    @property
+    def expiring_keys(self):
+        return self.store.expiring_keys
+
+    def set_expiring(self, key, value, expires, replace=False):
+        key, cvalue = self._encrypt([(key, value)])[0]
+        return self.store.set_expiring(key, cvalue, expires, replace)
+
+    def reap(self):
+        return self.store.reap()
+
     def span(self, key):
         return self.store.span(key)
 
+    def exists(self, key):
+        return self.store.exists(key)
+
+    def stat(self, key):
+        return self.store.stat(key)
+
     def list(self, keyfilter=''):
         return self.store.list(keyfilter)
 
+    def list_page(self, keyfilter, limit, after=None):
+        return self.store.list_page(keyfilter, limit, after)
+
+    def list_iter(self, keyfilter, page_size=1000):
+        return self.store.list_iter(keyfilter, page_size)
+
     def cut(self, key):
         return self.store.cut(key)
+
+    def cut_many(self, keys):
+        return self.store.cut_many(keys)
@@ -6,6 +6,7 @@ from jwcrypto.jwe import JWE
 from jwcrypto.jwk import JWK
 
 from custodia.plugin import CSStoreError, PluginOption, REQUIRED
+from custodia.store.encgen import BINARY_CTY
 from custodia.store.sqlite import SqliteStore
 
 
@@ -20,21 +21,59 @@ class EncryptedStore(SqliteStore):
             key = json_decode(data)
             self.mkey = JWK(**key)
 
-    def get(self, key):
-        value = super(EncryptedStore, self).get(key)
-        if value is None:
-            return None
+    def _decrypt(self, key, value):
         try:
             jwe = JWE()
             jwe.deserialize(value, self.mkey)
+            if jwe.jose_header.get('cty') == BINARY_CTY:
+                return jwe.payload
             return jwe.payload.decode('utf-8')
         except Exception:
             self.logger.exception("Error parsing key %s", key)
             raise CSStoreError('Error occurred while trying to parse key')
 
-    def set(self, key, value, replace=False):
+    def _encrypt(self, items):
         protected = json_encode({'alg': 'dir', 'enc': self.master_enctype})
-        jwe = JWE(value, protected)
-        jwe.add_recipient(self.mkey)
-        cvalue = jwe.serialize(compact=True)
+        binary = json_encode({'alg': 'dir', 'enc': self.master_enctype,
+                              'cty': BINARY_CTY})
+        result = []
+        for key, value in items:
+            if isinstance(value, bytes):
+                jwe = JWE(value, binary)
+            else:
+                jwe = JWE(value, protected)
+            jwe.add_recipient(self.mkey)
+            result.append((key, jwe.serialize(compact=True)))
+        return result
+
+    def get(self, key):
+        value = super(EncryptedStore, self).get(key)
+        if value is None:
+            return None
+        return self._decrypt(key, value)
+
+    def get_many(self, keys):
+        result = super(EncryptedStore, self).get_many(keys)
+        for key, value in result.items():
+            if value is not None:
+                result[key] = self._decrypt(key, value)
+        return result
+
+    def get_version(self, key, version):
+        value = super(EncryptedStore, self).get_version(key, version)
+        if value is None:
+            return None
+        return self._decrypt(key, value)
+
+    def set(self, key, value, replace=False):
+        key, cvalue = self._encrypt([(key, value)])[0]
         return super(EncryptedStore, self).set(key, cvalue, replace)
+
+    def set_many(self, items, replace=False):
+        return super(EncryptedStore, self).set_many(
+            self._encrypt(items), replace)
+
+    def set_expiring(self, key, value, expires, replace=False):
+        key, cvalue = self._encrypt([(key, value)])[0]
+        return super(EncryptedStore, self).set_expiring(
+            key, cvalue, expires, replace)
@@ -3,34 +3,228 @@ from __future__ import absolute_import, print_function
 
 import os
 import sqlite3
+import threading
+import time
 
 from custodia.plugin import CSStore, CSStoreError, CSStoreExists
 from custodia.plugin import PluginOption, REQUIRED
 
+# Keys per "IN (...)" query, stays below SQLITE_MAX_VARIABLE_NUMBER
+BATCH_SIZE = 500
+
+# Schema versions of the store tables, one row per table
+SCHEMA_TABLE = 'CustodiaSchema'
+
+# Seconds since the epoch, evaluated once per statement
+NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+
+# Rows of keys that have not expired, expired rows are never returned
+LIVE = "(expires IS NULL OR expires > %s)" % NOW
+
 
 class SqliteStore(CSStore):
+    """SQLite store
+
+    Every process and thread keeps a connection of its own, that is
+    opened on first use. Connections are never shared across fork(), a
+    child opens a new connection instead of using the parent's one.
+
+    The table layout is versioned. The table is created or upgraded once
+    when the store is initialized, the version is recorded in the
+    CustodiaSchema table. Tables of old releases without a version are
+    migrated in place.
+
+    Keys stored with set_expiring() are hidden as soon as they expire.
+    Their rows are replaced by the next write of the key, reap() removes
+    them in bulk with a scan of the partial index on the expiry time.
+
+    Text values are stored as TEXT, bytes as BLOBs without any encoding.
+
+    With 'history', replaced values are kept in a second table, the
+    name of the table with the suffix 'History'. Old versions are read
+    and restored without decrypting them in an overlay, a restore copies
+    the row within the database.
+    """
     dburi = PluginOption(str, REQUIRED, None)
     table = PluginOption(str, "CustodiaSecrets", None)
     filemode = PluginOption(oct, '600', None)
+    cached_statements = PluginOption(
+        int, 64, 'Number of prepared statements cached per connection')
+    journal_mode = PluginOption(
+        str, None, 'SQLite journal mode, e.g. WAL (default: unchanged)')
+    synchronous = PluginOption(
+        str, None, 'OFF, NORMAL, FULL or EXTRA (default: unchanged)')
+    mmap_size = PluginOption(
+        int, None, 'Max bytes of the database file to mmap()')
+    cache_size = PluginOption(
+        int, None, 'Page cache size, pages or -KiB if negative')
+    busy_timeout = PluginOption(
+        float, 5.0, 'Seconds to wait for a locked database')
+    history = PluginOption(
+        int, 0, 'Number of replaced versions kept for every key')
+
+    journal_modes = {'delete', 'truncate', 'persist', 'memory', 'wal', 'off'}
+    synchronous_modes = {'off', 'normal', 'full', 'extra'}
+
+    binary_values = True
+    versioned_keys = True
+    expiring_keys = True
+
+    # current table layout, _upgrade_<n>() upgrades from n - 1 to n
+    schema_version = 4
 
     def __init__(self, config, section):
         super(SqliteStore, self).__init__(config, section)
-        # Initialize the DB by trying to create the default table
+        if self.journal_mode is not None:
+            self.journal_mode = self.journal_mode.lower()
+            if self.journal_mode not in self.journal_modes:
+                raise ValueError(
+                    'Invalid journal_mode: {}'.format(self.journal_mode))
+        if self.synchronous is not None:
+            self.synchronous = self.synchronous.lower()
+            if self.synchronous not in self.synchronous_modes:
+                raise ValueError(
+                    'Invalid synchronous: {}'.format(self.synchronous))
+        self._local = threading.local()
+        # connections inherited from a parent process, they must neither
+        # be used nor closed.
+        self._inherited = []
+        # Initialize the DB by creating or upgrading the table
         try:
-            conn = sqlite3.connect(self.dburi)
+            conn = sqlite3.connect(self.dburi, timeout=self.busy_timeout)
             os.chmod(self.dburi, self.filemode)
-            with conn:
-                c = conn.cursor()
-                self._create(c)
+            self._pragmas(conn)
+            try:
+                self._setup(conn)
+            finally:
+                # don't keep a connection open in the parent process
+                conn.close()
         except sqlite3.Error:
             self.logger.exception("Error creating table %s", self.table)
             raise CSStoreError('Error occurred while trying to init db')
 
+    def _connect(self):
+        """Return the connection of the current process and thread
+        """
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is not None and local.pid == os.getpid():
+            return conn
+        if conn is not None:
+            self._inherited.append(conn)
+        conn = sqlite3.connect(self.dburi, timeout=self.busy_timeout,
+                               cached_statements=self.cached_statements)
+        self._pragmas(conn)
+        local.conn = conn
+        local.pid = os.getpid()
+        return conn
+
+    def _pragmas(self, conn):
+        """Apply the per-connection settings
+        """
+        pragmas = []
+        if self.journal_mode is not None:
+            # WAL is persistent, other modes are per connection
+            pragmas.append('journal_mode=%s' % self.journal_mode)
+        if self.synchronous is not None:
+            pragmas.append('synchronous=%s' % self.synchronous)
+        if self.mmap_size is not None:
+            pragmas.append('mmap_size=%i' % self.mmap_size)
+        if self.cache_size is not None:
+            pragmas.append('cache_size=%i' % self.cache_size)
+        for pragma in pragmas:
+            conn.execute('PRAGMA ' + pragma)
+
+    def _setup(self, conn):
+        """Create or upgrade the table in a single transaction
+        """
+        conn.isolation_level = None
+        cur = conn.cursor()
+        # IMMEDIATE serializes concurrent initializations
+        cur.execute("BEGIN IMMEDIATE")
+        try:
+            cur.execute("CREATE TABLE IF NOT EXISTS %s "
+                        "(name TEXT PRIMARY KEY NOT NULL, "
+                        "version INTEGER NOT NULL) WITHOUT ROWID"
+                        % SCHEMA_TABLE)
+            r = cur.execute("SELECT version FROM %s WHERE name=?"
+                            % SCHEMA_TABLE, (self.table,)).fetchone()
+            # tables without a version predate the schema table
+            version = 0 if r is None else r[0]
+            if version > self.schema_version:
+                raise CSStoreError(
+                    'Table {} has schema version {}, only {} is '
+                    'supported'.format(self.table, version,
+                                       self.schema_version))
+            if version < self.schema_version:
+                self.logger.info("Upgrading table %s from schema version "
+                                 "%i to %i", self.table, version,
+                                 self.schema_version)
+            while version < self.schema_version:
+                version += 1
+                getattr(self, '_upgrade_%i' % version)(cur)
+            cur.execute("INSERT OR REPLACE INTO %s VALUES (?, ?)"
+                        % SCHEMA_TABLE, (self.table, version))
+            cur.execute("COMMIT")
+        except Exception:
+            cur.execute("ROLLBACK")
+            raise
+
+    def _table_exists(self, cur, name):
+        r = cur.execute("SELECT 1 FROM sqlite_master "
+                        "WHERE type='table' AND name=?", (name,))
+        return r.fetchone() is not None
+
+    def _upgrade_1(self, cur):
+        """Typed columns and the primary key as the only index
+
+        Older releases used "(key PRIMARY KEY UNIQUE, value)", a rowid
+        table with two identical indexes on key.
+        """
+        legacy = self._table_exists(cur, self.table)
+        name = self.table + '_v1' if legacy else self.table
+        cur.execute("CREATE TABLE %s (key TEXT PRIMARY KEY NOT NULL, "
+                    "value BLOB) WITHOUT ROWID" % name)
+        if legacy:
+            cur.execute("INSERT INTO %s (key, value) "
+                        "SELECT key, value FROM %s" % (name, self.table))
+            cur.execute("DROP TABLE %s" % self.table)
+            cur.execute("ALTER TABLE %s RENAME TO %s" % (name, self.table))
+
+    def _upgrade_2(self, cur):
+        """Version and modification time of every entry
+        """
+        cur.execute("ALTER TABLE %s ADD COLUMN version INTEGER NOT NULL "
+                    "DEFAULT 1" % self.table)
+        cur.execute("ALTER TABLE %s ADD COLUMN modified REAL NOT NULL "
+                    "DEFAULT 0" % self.table)
+        cur.execute("UPDATE %s SET modified=?" % self.table, (time.time(),))
+
+    def _upgrade_3(self, cur):
+        """Replaced versions of keys
+        """
+        cur.execute("CREATE TABLE %s (key TEXT NOT NULL, "
+                    "version INTEGER NOT NULL, value BLOB, "
+                    "modified REAL NOT NULL, PRIMARY KEY (key, version)) "
+                    "WITHOUT ROWID" % self.history_table)
+
+    def _upgrade_4(self, cur):
+        """Expiry time of keys, NULL for keys that never expire
+        """
+        cur.execute("ALTER TABLE %s ADD COLUMN expires REAL" % self.table)
+        # only expiring keys are indexed
+        cur.execute("CREATE INDEX {0}Expires ON {0} (expires) "
+                    "WHERE expires IS NOT NULL".format(self.table))
+
+    @property
+    def history_table(self):
+        return self.table + 'History'
+
     def get(self, key):
         self.logger.debug("Fetching key %s", key)
-        query = "SELECT value from %s WHERE key=?" % self.table
+        query = "SELECT value from %s WHERE key=? AND %s" % (self.table, LIVE)
         try:
-            conn = sqlite3.connect(self.dburi)
+            conn = self._connect()
             c = conn.cursor()
             r = c.execute(query, (key,))
             value = r.fetchall()
@@ -43,27 +237,71 @@ class SqliteStore(CSStore):
         else:
             return None
 
-    def _create(self, cur):
-        create = "CREATE TABLE IF NOT EXISTS %s " \
-                 "(key PRIMARY KEY UNIQUE, value)" % self.table
-        cur.execute(create)
+    def _write(self, cur, key, value, replace, now, expires=None):
+        """Insert a value, replacing a value increments its version
+
+        A replaced value keeps the expiry time of the key unless a new
+        one is given.
+        """
+        self._purge(cur, key)
+        if replace:
+            if self.history > 0:
+                self._save_version(cur, key)
+            if expires is None:
+                cur.execute("UPDATE %s SET value=?, version=version + 1, "
+                            "modified=? WHERE key=?" % self.table,
+                            (value, now, key))
+            else:
+                cur.execute("UPDATE %s SET value=?, version=version + 1, "
+                            "modified=?, expires=? WHERE key=?" % self.table,
+                            (value, now, expires, key))
+            if cur.rowcount > 0:
+                return
+        cur.execute("INSERT into %s (key, value, version, modified, expires) "
+                    "VALUES (?, ?, 1, ?, ?)" % self.table,
+                    (key, value, now, expires))
+
+    def _purge(self, cur, key):
+        """Remove an expired key and its versions before it is written
+        """
+        cur.execute("DELETE FROM %s WHERE key=? AND NOT %s"
+                    % (self.table, LIVE), (key,))
+        if cur.rowcount > 0:
+            cur.execute("DELETE FROM %s WHERE key=?" % self.history_table,
+                        (key,))
+
+    def _save_version(self, cur, key):
+        """Copy the current version to the history, drop the oldest ones
+        """
+        cur.execute("INSERT OR REPLACE INTO {0} (key, version, value, "
+                    "modified) SELECT key, version, value, modified FROM {1} "
+                    "WHERE key=?".format(self.history_table, self.table),
+                    (key,))
+        if cur.rowcount > 0:
+            # the history keeps the last versions before the next one
+            cur.execute("DELETE FROM {0} WHERE key=? AND version <= "
+                        "(SELECT version FROM {1} WHERE key=?) - ?".format(
+                            self.history_table, self.table),
+                        (key, key, self.history))
 
     def set(self, key, value, replace=False):
         self.logger.debug("Setting key %s to value %s (replace=%s)",
                           key, value, replace)
+        self._set(key, value, replace, None)
+
+    def set_expiring(self, key, value, expires, replace=False):
+        self.logger.debug("Setting key %s to value %s (replace=%s, "
+                          "expires=%s)", key, value, replace, expires)
+        self._set(key, value, replace, float(expires))
+
+    def _set(self, key, value, replace, expires):
         if key.endswith('/'):
             raise ValueError('Invalid Key name, cannot end in "/"')
-        if replace:
-            query = "INSERT OR REPLACE into %s VALUES (?, ?)"
-        else:
-            query = "INSERT into %s VALUES (?, ?)"
-        setdata = query % (self.table,)
         try:
-            conn = sqlite3.connect(self.dburi)
+            conn = self._connect()
             with conn:
                 c = conn.cursor()
-                self._create(c)
-                c.execute(setdata, (key, value))
+                self._write(c, key, value, replace, time.time(), expires)
         except sqlite3.IntegrityError as err:
             raise CSStoreExists(str(err))
         except sqlite3.Error:
@@ -73,14 +311,15 @@ class SqliteStore(CSStore):
     def span(self, key):
         name = key.rstrip('/')
         self.logger.debug("Creating container %s", name)
-        query = "INSERT into %s VALUES (?, '')"
+        query = ("INSERT into %s (key, value, version, modified) "
+                 "VALUES (?, '', 1, ?)")
         setdata = query % (self.table,)
         try:
-            conn = sqlite3.connect(self.dburi)
+            conn = self._connect()
             with conn:
                 c = conn.cursor()
-                self._create(c)
-                c.execute(setdata, (name,))
+                self._purge(c, name)
+                c.execute(setdata, (name, time.time()))
         except sqlite3.IntegrityError as err:
             raise CSStoreExists(str(err))
         except sqlite3.Error:
@@ -91,55 +330,342 @@ class SqliteStore(CSStore):
         path = keyfilter.rstrip('/')
         self.logger.debug("Listing keys matching %s", path)
         child_prefix = path if path == '' else path + '/'
-        search = "SELECT key, value FROM %s WHERE key LIKE ?" % self.table
-        key = "%s%%" % (path,)
+        # Range scan on the primary key index, '0' is the successor of '/'.
+        # Values are not read, only whether the entry is a container.
+        search = ("SELECT key, value IS NULL OR value = '' FROM %s "
+                  "WHERE key >= ? AND key < ? AND %s ORDER BY key"
+                  % (self.table, LIVE))
+        exists = ("SELECT 1 FROM %s WHERE key IN (?, ?) AND %s"
+                  % (self.table, LIVE))
         try:
-            conn = sqlite3.connect(self.dburi)
-            r = conn.execute(search, (key,))
-            rows = r.fetchall()
+            conn = self._connect()
+            if path == '':
+                rows = conn.execute(
+                    "SELECT key, value IS NULL OR value = '' FROM %s "
+                    "WHERE %s" % (self.table, LIVE)).fetchall()
+                parent_exists = True
+            else:
+                rows = conn.execute(
+                    search, (child_prefix, path + '0')).fetchall()
+                parent_exists = bool(
+                    rows or conn.execute(
+                        exists, (path, child_prefix)).fetchall())
         except sqlite3.Error:
-            self.logger.exception("Error listing %s: [%r]", keyfilter)
+            self.logger.exception("Error listing %s", keyfilter)
             raise CSStoreError('Error occurred while trying to list keys')
         self.logger.debug("Searched for %s got result: %r", path, rows)
-        if len(rows) > 0:
-            parent_exists = False
-            result = list()
-            for key, value in rows:
-                if key == path or key == child_prefix:
-                    parent_exists = True
-                    continue
-                if not key.startswith(child_prefix):
-                    continue
-                result_value = key[len(child_prefix):].lstrip('/')
-                if not value:
-                    result.append(result_value + '/')
-                else:
-                    result.append(result_value)
-            if result:
-                self.logger.debug("Returning sorted values %r", result)
-                return sorted(result)
-            elif parent_exists:
-                self.logger.debug("Returning empty list")
-                return []
-        elif keyfilter == '':
-            self.logger.debug("Returning empty list")
-            return []
-        self.logger.debug("Returning 'Not Found'")
-        return None
+        if not parent_exists:
+            self.logger.debug("Returning 'Not Found'")
+            return None
+        result = list()
+        for key, container in rows:
+            if key == child_prefix:
+                continue
+            result_value = key[len(child_prefix):].lstrip('/')
+            if container:
+                result.append(result_value + '/')
+            else:
+                result.append(result_value)
+        self.logger.debug("Returning sorted values %r", result)
+        return sorted(result)
+
+    def list_page(self, keyfilter, limit, after=None):
+        path = keyfilter.rstrip('/')
+        child_prefix = path if path == '' else path + '/'
+        # Pages follow the order of the primary key index, 'after' is the
+        # last key of the previous page relative to the container.
+        start = child_prefix if after is None else child_prefix + after
+        if path == '':
+            search = ("SELECT key, value IS NULL OR value = '' FROM %s "
+                      "WHERE key > ? AND %s ORDER BY key LIMIT ?"
+                      % (self.table, LIVE))
+            args = (start, limit + 1)
+        else:
+            search = ("SELECT key, value IS NULL OR value = '' FROM %s "
+                      "WHERE key > ? AND key < ? AND %s ORDER BY key "
+                      "LIMIT ?" % (self.table, LIVE))
+            args = (start, path + '0', limit + 1)
+        try:
+            conn = self._connect()
+            rows = conn.execute(search, args).fetchall()
+            if not rows:
+                entry, children = self._container_stat(conn, path)
+                if not (entry or children):
+                    return None
+        except sqlite3.Error:
+            self.logger.exception("Error listing %s", keyfilter)
+            raise CSStoreError('Error occurred while trying to list keys')
+        names = []
+        for key, container in rows[:limit]:
+            name = key[len(child_prefix):].lstrip('/')
+            names.append(name + '/' if container else name)
+        if len(rows) > limit:
+            return names, rows[limit - 1][0][len(child_prefix):]
+        return names, None
+
+    def list_iter(self, keyfilter, page_size=1000):
+        page = self.list_page(keyfilter, page_size)
+        if page is None:
+            return None
+        return self._iter_pages(keyfilter, page_size, page)
+
+    def _iter_pages(self, keyfilter, page_size, page):
+        # Every page is a query of its own, no cursor is kept open while
+        # the names are consumed.
+        while page is not None:
+            names, after = page
+            for name in names:
+                yield name
+            if after is None:
+                return
+            page = self.list_page(keyfilter, page_size, after)
+
+    def _container_stat(self, conn, path):
+        """Return (entry exists, has children) of a container
+        """
+        if path == '':
+            children = conn.execute(
+                "SELECT EXISTS (SELECT 1 FROM %s WHERE %s)"
+                % (self.table, LIVE)).fetchone()
+            return True, bool(children[0])
+        # 'path/' itself is not a child, '0' is the successor of '/'
+        query = ("SELECT EXISTS (SELECT 1 FROM {0} WHERE key IN (?, ?) "
+                 "AND {1}), EXISTS (SELECT 1 FROM {0} WHERE key > ? AND "
+                 "key < ? AND {1})")
+        r = conn.execute(query.format(self.table, LIVE),
+                         (path, path + '/', path + '/', path + '0'))
+        entry, children = r.fetchone()
+        return bool(entry), bool(children)
+
+    def exists(self, key):
+        self.logger.debug("Checking key %s", key)
+        try:
+            conn = self._connect()
+            if key.endswith('/'):
+                entry, children = self._container_stat(conn, key.rstrip('/'))
+                return entry or children
+            r = conn.execute(
+                "SELECT 1 FROM %s WHERE key=? AND %s" % (self.table, LIVE),
+                (key,))
+            return r.fetchone() is not None
+        except sqlite3.Error:
+            self.logger.exception("Error checking key %s", key)
+            raise CSStoreError('Error occurred while trying to check key')
+
+    def stat(self, key):
+        self.logger.debug("Checking key %s", key)
+        try:
+            conn = self._connect()
+            path = key.rstrip('/')
+            # the size of the stored bytes, not the number of characters
+            r = conn.execute(
+                "SELECT value IS NULL OR value = '', "
+                "length(CAST(value AS BLOB)), version, modified, expires "
+                "FROM %s WHERE key=? AND %s" % (self.table, LIVE),
+                (path,)).fetchone()
+            if not key.endswith('/'):
+                if r is None:
+                    return None
+                if not r[0]:
+                    stat = {'container': False, 'size': r[1] or 0,
+                            'version': r[2], 'modified': r[3]}
+                    if r[4] is not None:
+                        stat['expires'] = r[4]
+                    return stat
+            entry, children = self._container_stat(conn, path)
+        except sqlite3.Error:
+            self.logger.exception("Error checking key %s", key)
+            raise CSStoreError('Error occurred while trying to check key')
+        if not entry and not children:
+            return None
+        stat = {'container': True, 'empty': not children}
+        if r is not None and r[0]:
+            # metadata of the container entry
+            stat.update(version=r[2], modified=r[3])
+        return stat
 
     def cut(self, key):
         self.logger.debug("Removing key %s", key)
         query = "DELETE from %s WHERE key=?" % self.table
+        history = "DELETE from %s WHERE key=?" % self.history_table
         try:
-            conn = sqlite3.connect(self.dburi)
+            conn = self._connect()
             with conn:
                 c = conn.cursor()
+                # an expired key counts as missing
+                self._purge(c, key)
                 r = c.execute(query, (key,))
+                removed = r.rowcount
+                # versions of a removed key are not restored
+                c.execute(history, (key,))
         except sqlite3.Error:
             self.logger.error("Error removing key %s", key)
             raise CSStoreError('Error occurred while trying to cut key')
         self.logger.debug("Key %s %s", key,
-                          "removed" if r.rowcount > 0 else "not found")
-        if r.rowcount > 0:
+                          "removed" if removed > 0 else "not found")
+        if removed > 0:
             return True
         return False
+
+    def get_many(self, keys):
+        keys = list(keys)
+        self.logger.debug("Fetching %i keys", len(keys))
+        result = dict.fromkeys(keys)
+        try:
+            conn = self._connect()
+            for i in range(0, len(keys), BATCH_SIZE):
+                chunk = keys[i:i + BATCH_SIZE]
+                query = ("SELECT key, value FROM %s WHERE key IN (%s) "
+                         "AND %s" % (self.table, ', '.join('?' * len(chunk)),
+                                     LIVE))
+                result.update(conn.execute(query, chunk).fetchall())
+        except sqlite3.Error:
+            self.logger.exception("Error fetching %i keys", len(keys))
+            raise CSStoreError('Error occurred while trying to get keys')
+        return result
+
+    def set_many(self, items, replace=False):
+        items = list(items)
+        self.logger.debug("Setting %i keys (replace=%s)", len(items),
+                          replace)
+        for key, _ in items:
+            if key.endswith('/'):
+                raise ValueError('Invalid Key name, cannot end in "/"')
+        now = time.time()
+        try:
+            conn = self._connect()
+            # a single transaction, all or nothing
+            with conn:
+                c = conn.cursor()
+                if replace:
+                    for key, value in items:
+                        self._write(c, key, value, True, now)
+                else:
+                    for key, _ in items:
+                        self._purge(c, key)
+                    c.executemany(
+                        "INSERT into %s (key, value, version, modified) "
+                        "VALUES (?, ?, 1, ?)" % self.table,
+                        [(key, value, now) for key, value in items])
+        except sqlite3.IntegrityError as err:
+            raise CSStoreExists(str(err))
+        except sqlite3.Error:
+            self.logger.exception("Error storing %i keys", len(items))
+            raise CSStoreError('Error occurred while trying to store keys')
+
+    def cut_many(self, keys):
+        keys = list(keys)
+        self.logger.debug("Removing %i keys", len(keys))
+        query = "DELETE from %s WHERE key=?" % self.table
+        history = "DELETE from %s WHERE key=?" % self.history_table
+        result = {}
+        try:
+            conn = self._connect()
+            with conn:
+                c = conn.cursor()
+                for key in keys:
+                    self._purge(c, key)
+                    r = c.execute(query, (key,))
+                    # a key listed twice counts as removed
+                    result[key] = result.get(key, False) or r.rowcount > 0
+                    c.execute(history, (key,))
+        except sqlite3.Error:
+            self.logger.error("Error removing %i keys", len(keys))
+            raise CSStoreError('Error occurred while trying to cut keys')
+        return result
+
+    def versions(self, key):
+        self.logger.debug("Listing versions of key %s", key)
+        current = ("SELECT version, modified, length(CAST(value AS BLOB)) "
+                   "FROM %s WHERE key=? AND NOT (value IS NULL OR value = '') "
+                   "AND %s" % (self.table, LIVE))
+        history = ("SELECT version, modified, length(CAST(value AS BLOB)) "
+                   "FROM %s WHERE key=? ORDER BY version DESC"
+                   % self.history_table)
+        try:
+            conn = self._connect()
+            rows = conn.execute(current, (key,)).fetchall()
+            if rows:
+                rows.extend(conn.execute(history, (key,)).fetchall())
+        except sqlite3.Error:
+            self.logger.exception("Error listing versions of key %s", key)
+            raise CSStoreError('Error occurred while trying to list versions')
+        if not rows:
+            return None
+        return [{'version': version, 'modified': modified, 'size': size}
+                for version, modified, size in rows]
+
+    def get_version(self, key, version):
+        self.logger.debug("Fetching version %i of key %s", version, key)
+        # the history of removed keys is removed, too, versions of
+        # expired keys are hidden until they are purged
+        query = ("SELECT value FROM {0} WHERE key=? AND version=? "
+                 "AND NOT (value IS NULL OR value = '') AND {2} UNION ALL "
+                 "SELECT value FROM {1} WHERE key=? AND version=? AND "
+                 "EXISTS (SELECT 1 FROM {0} WHERE key=? AND {2})").format(
+                     self.table, self.history_table, LIVE)
+        try:
+            conn = self._connect()
+            r = conn.execute(query, (key, version, key, version, key))
+            value = r.fetchall()
+        except sqlite3.Error:
+            self.logger.exception("Error fetching key %s", key)
+            raise CSStoreError('Error occurred while trying to get key')
+        if value:
+            return value[0][0]
+        return None
+
+    def restore(self, key, version):
+        self.logger.debug("Restoring version %i of key %s", version, key)
+        current = ("SELECT version FROM %s WHERE key=? AND NOT "
+                   "(value IS NULL OR value = '') AND %s" % (self.table, LIVE))
+        query = ("SELECT value FROM %s WHERE key=? AND version=?"
+                 % self.history_table)
+        try:
+            conn = self._connect()
+            with conn:
+                c = conn.cursor()
+                r = c.execute(current, (key,)).fetchall()
+                if not r:
+                    return False
+                if r[0][0] == version:
+                    # the current version
+                    return True
+                r = c.execute(query, (key, version)).fetchall()
+                if not r:
+                    return False
+                # a new version with the stored, maybe encrypted, value
+                self._write(c, key, r[0][0], True, time.time())
+        except sqlite3.Error:
+            self.logger.exception("Error restoring key %s", key)
+            raise CSStoreError('Error occurred while trying to restore key')
+        return True
+
+    def reap(self):
+        self.logger.debug("Removing expired keys")
+        # the partial index holds the expiring keys, ordered by expiry
+        search = ("SELECT key FROM %s WHERE expires IS NOT NULL AND "
+                  "expires <= %s ORDER BY expires LIMIT ?" % (self.table, NOW))
+        removed = []
+        try:
+            conn = self._connect()
+            while True:
+                # a transaction per chunk, writers are not blocked for long
+                with conn:
+                    c = conn.cursor()
+                    c.execute("BEGIN IMMEDIATE")
+                    keys = [r[0] for r in c.execute(search, (BATCH_SIZE,))]
+                    if keys:
+                        args = ', '.join('?' * len(keys))
+                        c.execute("DELETE FROM %s WHERE key IN (%s)"
+                                  % (self.table, args), keys)
+                        c.execute("DELETE FROM %s WHERE key IN (%s)"
+                                  % (self.history_table, args), keys)
+                removed.extend(keys)
+                if len(keys) < BATCH_SIZE:
+                    break
+        except sqlite3.Error:
+            self.logger.exception("Error removing expired keys")
+            raise CSStoreError('Error occurred while trying to reap keys')
+        self.logger.debug("Removed %i expired keys", len(removed))
+        return removed
@@ -0,0 +1,167 @@
+# Copyright (C) 2026  Custodia Project Contributors - see LICENSE file
+"""Change notifications for long-poll requests
+
+Every write to a store increments change counters in shared memory (see
+custodia.cache). A request handler, that waits for a change of a key or
+container, watches the counter of its name.
+
+A waiting request occupies a thread of the asyncio engine or a pre-forked
+worker. The number of concurrent waiters is capped below the size of the
+pool, a request that exceeds the cap doesn't wait.
+"""
+from __future__ import absolute_import
+
+import functools
+import hashlib
+import multiprocessing
+import time
+
+WRITE_METHODS = ('set', 'span', 'cut', 'set_many', 'cut_many', 'restore',
+                 'set_expiring', 'reap')
+
+
+class ChangeNotifier(object):
+    """Change counters in shared memory
+
+    A change of a key increments the counters of the key and of all its
+    parent containers, container names end in '/'. Names are hashed to
+    'slots' counters, a collision only causes a spurious wakeup. Waiters
+    poll their counter every 'poll_interval' seconds, a read of shared
+    memory that does not touch the store.
+
+    At most 'max_waiters' requests wait at the same time, None is
+    unlimited.
+    """
+    poll_interval = 0.05
+
+    def __init__(self, slots=4096, max_waiters=None):
+        if slots < 1:
+            raise ValueError('Invalid number of slots')
+        self._counters = multiprocessing.RawArray('Q', slots)
+        self._waiters = None
+        if max_waiters is not None:
+            self._waiters = multiprocessing.BoundedSemaphore(
+                max(max_waiters, 0))
+
+    def _index(self, name):
+        if not isinstance(name, bytes):
+            name = name.encode('utf-8')
+        digest = hashlib.sha256(name).hexdigest()[:8]
+        return int(digest, 16) % len(self._counters)
+
+    def _names(self, key):
+        name = key.rstrip('/')
+        names = [name, name + '/']
+        while '/' in name:
+            name = name.rsplit('/', 1)[0]
+            names.append(name + '/')
+        return names
+
+    def changed(self, key):
+        """Signal a change of a key or container
+        """
+        for name in self._names(key):
+            # increments may race, the counter changes nevertheless
+            self._counters[self._index(name)] += 1
+
+    def counter(self, name):
+        return self._counters[self._index(name)]
+
+    def acquire_waiter(self):
+        """Take a waiter slot, False when all slots are taken
+        """
+        if self._waiters is None:
+            return True
+        return self._waiters.acquire(False)
+
+    def release_waiter(self):
+        if self._waiters is not None:
+            self._waiters.release()
+
+    def wait(self, name, counter, timeout):
+        """Wait until the counter of 'name' differs from 'counter'
+
+        Returns False when the timeout expired first.
+        """
+        index = self._index(name)
+        deadline = time.monotonic() + timeout
+        while self._counters[index] == counter:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_interval, remaining))
+        return True
+
+
+def _keys(method, args, result):
+    if method == 'set_many':
+        return [key for key, _ in args[0]]
+    if method == 'cut_many':
+        return args[0]
+    if method == 'reap':
+        # the removed keys
+        return result or []
+    return args[:1]
+
+
+def _notifying_method(notifier, name, method):
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if name in ('set_many', 'cut_many'):
+            # may be an iterator, it's consumed twice
+            args = (list(args[0]),) + args[1:]
+        result = None
+        try:
+            result = method(*args, **kwargs)
+            return result
+        finally:
+            # failed writes may have changed something, too
+            for key in _keys(name, args, result):
+                notifier.changed(key)
+    wrapper.watch_wrapped = True
+    return wrapper
+
+
+def configured_max_waiters(config):
+    """Cap of concurrent waiters for the server engine of 'config'
+
+    'server_max_waiters' overrides the default, half of the threads of
+    the asyncio engine or of the pre-forked workers. A process per
+    connection is not capped.
+    """
+    value = config.get('server_max_waiters')
+    if value is not None:
+        return int(value)
+    if config.get('server_engine', 'fork') == 'asyncio':
+        return int(config.get('server_threads', 8)) // 2
+    workers = int(config.get('server_workers', 0))
+    if workers:
+        return workers // 2
+    return None
+
+
+_notifier = None
+
+
+def get_notifier():
+    return _notifier
+
+
+def install_notifier(config, slots=4096):
+    """Create the notifier and hook it into the stores of the server
+
+    The write methods of every store in config['stores'] signal their
+    changes. Overlays call the methods of their backing stores, changes
+    are signaled no matter which store of a stack is written to.
+    """
+    # pylint: disable=global-statement
+    global _notifier
+    if _notifier is None:
+        _notifier = ChangeNotifier(slots, configured_max_waiters(config))
+    for store in config['stores'].values():
+        for method in WRITE_METHODS:
+            func = getattr(store, method, None)
+            if func is None or getattr(func, 'watch_wrapped', False):
+                continue
+            setattr(store, method, _notifying_method(_notifier, method, func))
+    return _notifier
@@ -1,12 +1,14 @@
 # Copyright (C) 2015  Custodia Project Contributors - see LICENSE file
 from __future__ import absolute_import
 
+import json
 import os
 import shlex
 import shutil
 import socket
 import subprocess
 import sys
+import threading
 import time
 import unittest
 from string import Template
@@ -61,6 +63,7 @@ tls_keyfile = tests/ca/custodia-server.key
 tls_cafile = tests/ca/custodia-ca.pem
 tls_verify_client = ${VERIFY_CLIENT}
 umask = 027
+${EXTRA_GLOBALS}
 
 [auth:header]
 handler = SimpleHeaderAuth
@@ -71,7 +74,7 @@ handler = SimpleClientCertAuth
 
 [authz:paths]
 handler = custodia.httpd.authorizers.SimplePathAuthz
-paths = /. /secrets
+paths = /. /secrets /metrics
 
 [authz:namespaces]
 handler = custodia.httpd.authorizers.UserNameSpace
@@ -83,6 +86,8 @@ handler = custodia.store.sqlite.SqliteStore
 dburi = ${TEST_DIR}/test_secrets.db
 table = secrets
 filemode = 640
+journal_mode = WAL
+synchronous = NORMAL
 
 [/]
 handler = Root
@@ -95,6 +100,9 @@ store = simple
 handler = custodia.secrets.Secrets
 store = simple
 
+[/metrics]
+handler = custodia.metrics.Metrics
+
 # Forward
 [auth:forwarder]
 handler = custodia.httpd.authenticators.SimpleAuthKeys
@@ -142,10 +150,14 @@ server_keys = srvkid
 store = simple
 paths = /enc/kem
 
+[store:enccached]
+handler = custodia.store.cached.CachedOverlay
+backing_store = encgen
+
 [/enc]
 handler = Secrets
 allowed_keytypes = simple kem
-store = encgen
+store = enccached
 """
 
 
@@ -188,6 +200,7 @@ class CustodiaTests(unittest.TestCase):
     test_auth_id = "test_user"
     test_auth_key = "cd54b735-e756-4f12-aa18-d85509baef36"
     verify_client = 'False'
+    extra_globals = ''
     test_dir = 'tests/tmp'
 
     maxDiff = None
@@ -209,7 +222,8 @@ class CustodiaTests(unittest.TestCase):
                                  'TEST_DIR': cls.test_dir,
                                  'TEST_AUTH_ID': cls.test_auth_id,
                                  'TEST_AUTH_KEY': cls.test_auth_key,
-                                 'VERIFY_CLIENT': cls.verify_client})
+                                 'VERIFY_CLIENT': cls.verify_client,
+                                 'EXTRA_GLOBALS': cls.extra_globals})
             conffile.write(conf)
 
         srvkeys, clikeys = generate_all_keys(custodia_conf)
@@ -361,6 +375,74 @@ class CustodiaTests(unittest.TestCase):
         key = self.client.get_secret('test/http%3A%2F%2Flocalhost%3A5000')
         self.assertEqual(key, 'path with /')
 
+    def test_2_batch(self):
+        items = [{'method': 'GET', 'name': 'key'},
+                 {'method': 'GET', 'name': 'missing'}]
+        r = self.client.post('test/_batch', json=items)
+        r.raise_for_status()
+        self.assertEqual(r.json(), [
+            {'name': 'key', 'code': 200,
+             'output': {'type': 'simple', 'value': 'VmVycnlTZWNyZXQK'}},
+            {'name': 'missing', 'code': 404}])
+        # the items are authorized on their own
+        items = [{'method': 'GET', 'name': 'uns/test/key'}]
+        r = self.admin.post('_batch', json=items)
+        r.raise_for_status()
+        self.assertEqual(r.json()[0]['code'], 403)
+
+    def test_2_head(self):
+        r = self.client.head('test/key')
+        r.raise_for_status()
+        self.assertEqual(r.content, b'')
+        self.assertEqual(r.headers['X-Custodia-Size'], '16')
+        self.assertEqual(r.headers['X-Custodia-Version'], '1')
+        self.assertIn('ETag', r.headers)
+        self.assertIn('Last-Modified', r.headers)
+        r = self.client.head('test/')
+        self.assertEqual(r.status_code, 200)
+        r = self.client.head('test/missing')
+        self.assertEqual(r.status_code, 404)
+        # consumers without HEAD answer like GET without the body
+        r = self.root.head('')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.content, b'')
+
+    def test_2_get_conditional(self):
+        r = self.client.get('test/key')
+        r.raise_for_status()
+        etag = r.headers['ETag']
+        r = self.client.get('test/key', headers={'If-None-Match': etag})
+        self.assertEqual(r.status_code, 304)
+        self.assertEqual(r.content, b'')
+
+    def test_2_get_wait(self):
+        r = self.client.get('test/key')
+        r.raise_for_status()
+        start = time.time()
+        r = self.client.get('test/key', params={'wait': '0.2'},
+                            headers={'If-None-Match': r.headers['ETag']})
+        self.assertEqual(r.status_code, 304)
+        self.assertGreaterEqual(time.time() - start, 0.2)
+
+        r = self.client.get('test/')
+        r.raise_for_status()
+        writer = self.create_client('/secrets/uns', 'test')
+
+        def change():
+            time.sleep(0.3)
+            writer.set_secret('test/watch', 'changed')
+
+        thread = threading.Thread(target=change)
+        thread.start()
+        try:
+            r = self.client.get('test/', params={'wait': '10'},
+                                headers={'If-None-Match': r.headers['ETag']})
+        finally:
+            thread.join()
+        self.assertEqual(r.status_code, 200)
+        self.assertIn('watch', r.json())
+        self.client.del_secret('test/watch')
+
     def test_2_get_simple_key_cli(self):
         key = self._custoda_cli('get', 'test/key')
         self.assertEqual(key, 'VmVycnlTZWNyZXQK')
@@ -371,6 +453,38 @@ class CustodiaTests(unittest.TestCase):
         cl = self.client.list_container('test')
         self.assertEqual(cl, ["cli", "http://localhost:5000", "key"])
 
+    def test_3_list_container_paged(self):
+        names = []
+        params = {'limit': '2'}
+        while True:
+            r = self.client.get('test/', params=params)
+            r.raise_for_status()
+            self.assertLessEqual(len(r.json()), 2)
+            names.extend(r.json())
+            if 'X-Custodia-Cursor' not in r.headers:
+                break
+            params['cursor'] = r.headers['X-Custodia-Cursor']
+        self.assertEqual(sorted(names),
+                         ["cli", "http://localhost:5000", "key"])
+
+    def test_3_list_container_stream(self):
+        r = self.client.get('test/',
+                            headers={'Accept': 'application/x-ndjson'})
+        r.raise_for_status()
+        self.assertEqual(r.headers['Content-Type'], 'application/x-ndjson')
+        names = [json.loads(line) for line in r.text.splitlines()]
+        self.assertEqual(sorted(names),
+                         ["cli", "http://localhost:5000", "key"])
+
+    def test_3_chunked_body_rejected(self):
+        # requests sends an iterator with Transfer-Encoding: chunked
+        r = self.client.put('test/chunked', data=iter([b'{"type": "simple"',
+                                                       b', "value": "v"}']))
+        self.assertEqual(r.status_code, 501)
+        self.assertEqual(r.headers['Connection'], 'close')
+        with self.assertRaises(requests.exceptions.HTTPError):
+            self.client.get_secret('test/chunked')
+
     def test_3_list_container_cli(self):
         cl = self._custoda_cli('ls', 'test', split=True)
         self.assertEqual(cl, ["cli", "http://localhost:5000", "key"])
@@ -404,6 +518,9 @@ class CustodiaTests(unittest.TestCase):
         self.fwd.create_container('dir')
         cl = self.admin.list_container('fwd/dir')
         self.assertEqual(cl, [])
+        r = self.fwd.head('dir/')
+        r.raise_for_status()
+        self.assertIn('ETag', r.headers)
 
     def test_7_delete_forwarded_container(self):
         self.fwd.delete_container('dir')
@@ -435,6 +552,12 @@ class CustodiaTests(unittest.TestCase):
         self.assertNotEqual(key, 'simple')
         key = self.enc.get_secret('enc/key')
         self.assertEqual(key, 'simple')
+        r = self.enc.head('enc/key')
+        r.raise_for_status()
+        self.assertEqual(r.headers['X-Custodia-Version'], '1')
+        r = self.enc.get('enc/key',
+                         headers={'If-None-Match': r.headers['ETag']})
+        self.assertEqual(r.status_code, 304)
 
     def test_B_1_kem_create_container(self):
         self.kem.create_container('kem')
@@ -476,10 +599,50 @@ class CustodiaTests(unittest.TestCase):
         except requests.exceptions.HTTPError:
             self.assertEqual(self.kem.last_response.status_code, 404)
 
+    def test_C_metrics(self):
+        r = self.root.get('metrics')
+        r.raise_for_status()
+        self.assertTrue(r.headers['Content-Type'].startswith('text/plain'))
+        metrics = {}
+        for line in r.text.splitlines():
+            if not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                metrics[name] = float(value)
+        # requests are served by forked processes, nothing is lost
+        self.assertGreater(metrics['custodia_requests_total{code="2xx"}'], 10)
+        self.assertGreater(metrics['custodia_requests_total{code="4xx"}'], 0)
+        for labels in ['stage="authenticator",plugin="header"',
+                       'stage="authorizer",plugin="paths"',
+                       'stage="consumer",plugin="/"',
+                       'stage="store_get",plugin="simple"',
+                       'stage="store_set",plugin="simple"']:
+            name = 'custodia_stage_duration_seconds'
+            count = metrics['%s_count{%s}' % (name, labels)]
+            self.assertGreater(count, 0)
+            inf = metrics['%s_bucket{%s,le="+Inf"}' % (name, labels)]
+            self.assertEqual(inf, count)
+
+
+class CustodiaPreforkTests(CustodiaTests):
+    extra_globals = u"""
+server_workers = 2
+server_worker_max_requests = 5
+"""
+
+
+class CustodiaAsyncioTests(CustodiaTests):
+    extra_globals = u"""
+server_engine = asyncio
+server_keepalive_timeout = 2
+"""
+
 
 class CustodiaHTTPSTests(CustodiaTests):
     socket_url = 'https://localhost:{}'.format(find_port())
     verify_client = 'True'
+    extra_globals = u"""
+server_keepalive_timeout = 2
+"""
 
     ca_cert = os.path.join(HERE, 'ca/custodia-ca.pem')
     client_cert = os.path.join(HERE, 'ca/custodia-client.pem')
@@ -533,8 +696,13 @@ class CustodiaHTTPSTests(CustodiaTests):
         # XXX workaround for requests bug with urllib3 v1.22
         with self.assertRaises(RequestsConnSSLErrors) as e:
             client.list_container('test')
+        # TLS 1.3 clients see the rejection after their side of the
+        # handshake has completed.
         self.assert_ssl_error_msg(["Connection reset by peer",
-                                   "SSLV3_ALERT_HANDSHAKE_FAILURE"],
+                                   "SSLV3_ALERT_HANDSHAKE_FAILURE",
+                                   "TLSV13_ALERT_CERTIFICATE_REQUIRED",
+                                   "EOF occurred in violation of protocol",
+                                   "Remote end closed connection"],
                                   e.exception)
 
     def test_C_client_cert_auth(self):
@@ -550,6 +718,13 @@ class CustodiaHTTPSTests(CustodiaTests):
         self.client.del_secret('test/key')
 
 
+class CustodiaAsyncioHTTPSTests(CustodiaHTTPSTests):
+    socket_url = 'https://localhost:{}'.format(find_port())
+    extra_globals = u"""
+server_engine = asyncio
+"""
+
+
 @pytest.mark.skipif(
     requests_gssapi is None,
     reason="requests_gssapi not available"
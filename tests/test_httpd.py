@@ -1,12 +1,21 @@
 # Copyright (C) 2017  Custodia Project Contributors - see LICENSE file
 from __future__ import absolute_import
 
+import asyncio
+import io
 import socket
 import ssl
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 
+import six
+
+from custodia.httpd import aioserver
 from custodia.httpd import server
+from custodia.httpd.router import Router
 
 CONFIG = {
     'consumers': {
@@ -50,3 +59,289 @@ def test_tlserver():
         config,
         bind_and_activate=False
     )
+
+
+class KeepAliveServer(object):
+    # minimal stand-in for ForkingHTTPServer
+    server_string = 'Custodia/test'
+    config = CONFIG
+    keepalive_timeout = 0.5
+    keepalive_requests = 2
+    requests_handled = 0
+
+
+class KeepAliveHandler(server.HTTPRequestHandler):
+    lookups = 0
+
+    def _get_loginuid(self, pid):
+        KeepAliveHandler.lookups += 1
+        return None
+
+    def pipeline(self, config, request):
+        output = request['path'].encode('utf-8')
+        return {'headers': {'Content-Length': str(len(output))},
+                'output': output}
+
+
+def test_keepalive():
+    srv_sock, cli_sock = socket.socketpair(socket.AF_UNIX)
+    cli_sock.settimeout(5)
+    request = b'GET /%s HTTP/1.1\r\nHost: localhost\r\n\r\n'
+    cli_sock.sendall(request % b'first' + request % b'second')
+    srv = KeepAliveServer()
+    try:
+        KeepAliveHandler(srv_sock, None, srv)
+        srv_sock.close()
+        reply = cli_sock.makefile('rb').read()
+    finally:
+        srv_sock.close()
+        cli_sock.close()
+    # both requests are served on one connection, the second one hits
+    # keepalive_requests and closes the connection.
+    assert reply.count(b'HTTP/1.1 200 OK') == 2
+    assert reply.endswith(b'/second')
+    assert reply.count(b'Connection: close') == 1
+    assert srv.requests_handled == 2
+    assert KeepAliveHandler.lookups == 1
+
+
+class Allow(object):
+    def handle(self, request):
+        return True
+
+
+class LegacyConsumer(object):
+    """Third-party consumer with its own handle(request)
+    """
+    def GET(self, request, response):
+        raise AssertionError('handle() is overridden')
+
+    def handle(self, request):
+        return {'output': request['handler'].__name__.encode('utf-8')}
+
+
+def test_pipeline_legacy_handle():
+    handler = object.__new__(server.HTTPRequestHandler)
+    handler.server = KeepAliveServer()
+    handler.server.router = Router({('', 'legacy'): LegacyConsumer()})
+    config = {'authenticators': {'allow': Allow()},
+              'authorizers': {'allow': Allow()}}
+    request = {'path_chain': ('', 'legacy'), 'command': 'GET',
+               'client_id': 'test'}
+    # the resolved handler is passed in the request
+    assert handler.pipeline(config, request) == {'output': b'GET'}
+
+
+class PingHandler(six.moves.socketserver.StreamRequestHandler):
+    def handle(self):
+        self.rfile.readline()
+        self.wfile.write(b'pong\n')
+
+
+def test_tls_handshake_in_worker():
+    srv = server.ForkingTLSServer(LOCALADDR, PingHandler, CONFIG.copy())
+    # serve connections in-process
+    srv.forking = False
+    client_ctx = ssl.create_default_context(cafile=CONFIG['tls_cafile'])
+
+    def connect(session=None):
+        thread = threading.Thread(target=srv.handle_request)
+        thread.start()
+        sock = socket.create_connection(srv.server_address)
+        conn = client_ctx.wrap_socket(sock, server_hostname='localhost',
+                                      session=session)
+        conn.sendall(b'ping\n')
+        assert conn.makefile('rb').readline() == b'pong\n'
+        thread.join()
+        result = conn.session, conn.session_reused
+        conn.close()
+        return result
+
+    try:
+        # get_request() returns before the handshake
+        sock = socket.create_connection(srv.server_address)
+        conn, _ = srv.get_request()
+        with pytest.raises(ValueError):
+            # handshake not done yet
+            conn.getpeercert()
+        conn.close()
+        sock.close()
+
+        session, reused = connect()
+        assert not reused
+        session, reused = connect(session)
+        assert reused
+    finally:
+        srv.server_close()
+
+
+class CountingPingHandler(PingHandler):
+    def handle(self):
+        PingHandler.handle(self)
+        self.server.requests_handled += 1
+
+
+class PingHTTPServer(server.HTTPServer):
+    handler = CountingPingHandler
+
+
+def test_multiple_listeners(tmpdir):
+    path = str(tmpdir.join('custodia.sock'))
+    urls = 'http+unix://{}, http://127.0.0.1:0'.format(
+        six.moves.urllib.parse.quote(path, safe=''))
+    srv = PingHTTPServer(urls, CONFIG.copy())
+    assert len(srv.servers) == 2
+    unix_srv, tcp_srv = srv.servers
+    assert unix_srv.socket.family == socket.AF_UNIX
+    assert tcp_srv.socket.family == socket.AF_INET
+    for httpd in srv.servers:
+        httpd.forking = False
+
+    # one dispatch loop serves both listeners
+    thread = threading.Thread(
+        target=srv._dispatch,  # pylint: disable=protected-access
+        args=(lambda: srv.requests_handled >= 2,))
+    thread.start()
+    try:
+        for family, address in ((socket.AF_UNIX, path),
+                                (socket.AF_INET, tcp_srv.server_address)):
+            sock = socket.socket(family, socket.SOCK_STREAM)
+            sock.settimeout(5)
+            sock.connect(address)
+            sock.sendall(b'ping\n')
+            assert sock.makefile('rb').readline() == b'pong\n'
+            sock.close()
+    finally:
+        thread.join(5)
+        for httpd in srv.servers:
+            httpd.server_close()
+    assert not thread.is_alive()
+
+
+def test_reuseport():
+    config = CONFIG.copy()
+    config['server_reuseport'] = True
+    with pytest.raises(ValueError):
+        # SO_REUSEPORT needs pre-forked workers
+        PingHTTPServer('http://127.0.0.1:0', config)
+
+    config['server_workers'] = 2
+    srv = PingHTTPServer('http://127.0.0.1:0', config).httpd
+    assert srv.reuse_port
+    address = srv.server_address
+    # the reserved address does not accept connections
+    pytest.raises(socket.error, socket.create_connection, address)
+
+    members = [srv]
+    try:
+        # every member listens on a socket of its own
+        srv.reuse_port_rebind()
+        other = PingHTTPServer('http://127.0.0.1:%i' % address[1], config)
+        members.append(other.httpd)
+        other.httpd.reuse_port_rebind()
+        assert other.httpd.server_address == address
+        sock = socket.create_connection(address)
+        sock.close()
+    finally:
+        for httpd in members:
+            httpd.server_close()
+
+
+def test_reuseport_drain():
+    config = CONFIG.copy()
+    config['server_reuseport'] = True
+    config['server_workers'] = 2
+    srv = PingHTTPServer('http://127.0.0.1:0', config).httpd
+    try:
+        srv.reuse_port_rebind()
+        srv.forking = False
+        srv.socket.setblocking(False)
+        # queued, but not accepted yet
+        socks = []
+        for _ in range(2):
+            sock = socket.create_connection(srv.server_address, 5)
+            sock.sendall(b'ping\n')
+            socks.append(sock)
+        srv.drain()
+        assert srv.requests_handled == 2
+        for sock in socks:
+            assert sock.makefile('rb').readline() == b'pong\n'
+            sock.close()
+        # nothing left to drain
+        srv.drain()
+    finally:
+        srv.server_close()
+
+
+class StreamHandler(KeepAliveHandler):
+    def pipeline(self, config, request):
+        body = request['body']
+        tmp = tempfile.TemporaryFile()
+        for chunk in body:
+            tmp.write(chunk)
+        tmp.seek(0)
+        return {'headers': {'Content-Length': str(body.length)},
+                'output': tmp}
+
+
+def test_streaming():
+    srv_sock, cli_sock = socket.socketpair(socket.AF_UNIX)
+    cli_sock.settimeout(5)
+    value = b'x' * (3 * server.STREAM_CHUNK_SIZE + 1)
+    cli_sock.sendall(b'PUT /stream HTTP/1.1\r\nContent-Length: %i\r\n\r\n'
+                     % len(value) + value)
+    srv = KeepAliveServer()
+    try:
+        StreamHandler(srv_sock, None, srv)
+        srv_sock.close()
+        reply = cli_sock.makefile('rb').read()
+    finally:
+        srv_sock.close()
+        cli_sock.close()
+    # the temporary file was sent with sendfile()
+    headers, body = reply.split(b'\r\n\r\n', 1)
+    assert headers.startswith(b'HTTP/1.1 200 OK')
+    assert body == value
+
+
+def test_aio_header_too_long():
+    async def exchange(request):
+        executor = ThreadPoolExecutor(max_workers=1)
+
+        async def client_connected(reader, writer):
+            handler = aioserver.AsyncHTTPRequestHandler(
+                reader, writer, KeepAliveServer(), executor)
+            await handler.handle_connection()
+
+        srv = await asyncio.start_server(
+            client_connected, '127.0.0.1', 0, limit=aioserver.MAX_LINE + 1)
+        try:
+            reader, writer = await asyncio.open_connection(
+                *srv.sockets[0].getsockname())
+            writer.write(request)
+            reply = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+        finally:
+            srv.close()
+            await srv.wait_closed()
+            executor.shutdown()
+        return reply
+
+    request = (b'GET /key HTTP/1.1\r\nX-Long: %s\r\n\r\n'
+               % (b'x' * (aioserver.MAX_LINE + 1)))
+    reply = asyncio.run(exchange(request))
+    # answered before the connection is closed
+    assert reply.startswith(b'HTTP/1.1 431 ')
+
+
+def test_request_body():
+    rfile = io.BytesIO(b'0123456789next request')
+    body = server.RequestBody(rfile, 10)
+    assert len(body) == 10
+    assert body.read(4) == b'0123'
+    assert body.read() == b'456789'
+    assert body.read() == b''
+    assert rfile.read() == b'next request'
+
+    body = server.RequestBody(io.BytesIO(b'short'), 10)
+    pytest.raises(socket.error, body.read)
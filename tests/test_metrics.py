@@ -0,0 +1,68 @@
+# Copyright (C) 2026  Custodia Project Contributors - see LICENSE file
+from __future__ import absolute_import
+
+import os
+
+import pytest
+
+from custodia import metrics
+from custodia.plugin import HTTPError
+
+
+def test_registry():
+    registry = metrics.Registry(
+        [('authenticator', 'header'), ('store_get', 'simple')], [0.1, 1.0])
+    with registry.timed('authenticator', 'header'):
+        pass
+    # unknown series are ignored
+    with registry.timed('authorizer', 'unknown'):
+        pass
+    registry.count_request(200)
+    registry.count_request(404)
+    registry.count_request(999)
+
+    # observations of forked children are not lost
+    pid = os.fork()
+    if not pid:
+        try:
+            registry._observe(1, 0.5)  # pylint: disable=protected-access
+            registry._observe(1, 5.0)  # pylint: disable=protected-access
+            registry.count_request(200)
+        finally:
+            os._exit(0)  # pylint: disable=protected-access
+    os.waitpid(pid, 0)
+
+    lines = registry.render().splitlines()
+    assert 'custodia_requests_total{code="2xx"} 2' in lines
+    assert 'custodia_requests_total{code="4xx"} 1' in lines
+    labels = 'stage="authenticator",plugin="header"'
+    assert ('custodia_stage_duration_seconds_bucket{%s,le="0.1"} 1'
+            % labels) in lines
+    assert 'custodia_stage_duration_seconds_count{%s} 1' % labels in lines
+    labels = 'stage="store_get",plugin="simple"'
+    assert ('custodia_stage_duration_seconds_bucket{%s,le="0.1"} 0'
+            % labels) in lines
+    assert ('custodia_stage_duration_seconds_bucket{%s,le="1.0"} 1'
+            % labels) in lines
+    assert ('custodia_stage_duration_seconds_bucket{%s,le="+Inf"} 2'
+            % labels) in lines
+    assert 'custodia_stage_duration_seconds_sum{%s} 5.5' % labels in lines
+
+
+def test_registry_stuck_lock():
+    registry = metrics.Registry([('authenticator', 'header')], [0.1])
+    registry.lock_timeout = 0.01
+    # held by a child, that was killed
+    registry._lock.acquire()  # pylint: disable=protected-access
+    registry.count_request(200)
+    with pytest.raises(HTTPError) as e:
+        registry.render()
+    assert e.value.code == 503
+
+
+def test_null_registry():
+    registry = metrics.NullRegistry()
+    with registry.timed('authenticator', 'header'):
+        pass
+    registry.count_request(200)
+    assert registry.render() == ''
@@ -0,0 +1,100 @@
+# Copyright (C) 2026  Custodia Project Contributors - see LICENSE file
+from __future__ import absolute_import
+
+import os
+import shutil
+import signal
+import tempfile
+import time
+
+from custodia import reaper
+from custodia.compat import configparser
+from custodia.store.cached import CachedOverlay
+from custodia.store.sqlite import SqliteStore
+
+CONFIG = u"""
+[store:sqlite]
+dburi = ${tmpdir}/reaper.sqlite
+
+[store:cached]
+backing_store = sqlite
+"""
+
+
+def _stores(tmpdir):
+    parser = configparser.ConfigParser(
+        interpolation=configparser.ExtendedInterpolation(),
+        defaults={'tmpdir': tmpdir}
+    )
+    parser.read_string(CONFIG)
+    sqlite = SqliteStore(parser, 'store:sqlite')
+    cached = CachedOverlay(parser, 'store:cached')
+    cached.store = sqlite
+    return {'sqlite': sqlite, 'cached': cached}
+
+
+def _wait_reaped(conn):
+    for _ in range(50):
+        rows = conn.execute("SELECT key FROM CustodiaSecrets "
+                            "ORDER BY key").fetchall()
+        if rows == [('live',)]:
+            break
+        time.sleep(0.1)
+    return rows
+
+
+def _children(pid):
+    path = '/proc/{0}/task/{0}/children'.format(pid)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return [int(child) for child in f.read().split()]
+
+
+def test_top_stores():
+    # pylint: disable=protected-access
+    tmpdir = tempfile.mkdtemp()
+    try:
+        stores = _stores(tmpdir)
+        # the backing store is reaped through the overlay
+        assert reaper._top_stores(stores) == [stores['cached']]
+        assert reaper.start_reaper({'stores': stores,
+                                    'reap_interval': 0}) is None
+        stores['sqlite'].expiring_keys = False
+        assert reaper._top_stores(stores) == []
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def test_reaper():
+    # pylint: disable=protected-access
+    tmpdir = tempfile.mkdtemp()
+    try:
+        stores = _stores(tmpdir)
+        store = stores['cached']
+        store.set_expiring('expired', 'value', time.time() - 1)
+        store.set_expiring('live', 'value', time.time() + 60)
+        assert reaper.Reaper([store], 60).reap() == 1
+
+        store.set_expiring('expired', 'value', time.time() - 1)
+        proc = reaper.start_reaper({'stores': stores,
+                                    'reap_interval': 0.1})
+        try:
+            assert proc.pid != os.getpid()
+            # removed by the forked reaper
+            conn = stores['sqlite']._connect()
+            assert _wait_reaped(conn) == [('live',)]
+
+            # the supervisor restarts a reaper that dies
+            children = _children(proc.pid)
+            if children is not None:
+                assert len(children) == 1
+                os.kill(children[0], signal.SIGKILL)
+                store.set_expiring('expired', 'value', time.time() - 1)
+                assert _wait_reaped(conn) == [('live',)]
+                assert _children(proc.pid) not in ([], children)
+        finally:
+            proc.stop()
+        assert proc.pid is None
+    finally:
+        shutil.rmtree(tmpdir)
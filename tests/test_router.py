@@ -0,0 +1,75 @@
+# Copyright (C) 2026  Custodia Project Contributors - see LICENSE file
+from __future__ import absolute_import
+
+import pytest
+
+from custodia.httpd.router import Router
+from custodia.plugin import HTTPError
+
+
+class Consumer(object):
+    def __init__(self, name, **subs):
+        self.name = name
+        self.subs = subs
+
+    def GET(self, request, response):
+        return self.name
+
+
+class ReadOnly(object):
+    subs = {}
+
+    def GET(self, request, response):
+        pass
+
+
+ROOT = Consumer('root', secrets=Consumer('secrets', sub=Consumer('sub')))
+FWD = Consumer('fwd')
+DEEP = Consumer('deep')
+READONLY = ReadOnly()
+
+ROUTER = Router({
+    ('',): ROOT,
+    ('', 'forwarder'): FWD,
+    ('', 'forwarder', 'a', 'b'): DEEP,
+    ('', 'readonly'): READONLY,
+})
+
+
+@pytest.mark.parametrize('path,consumer,base,trail', [
+    ('/', ROOT, 'root', ['']),
+    ('/other/key', ROOT, 'root', ['other', 'key']),
+    ('/secrets', ROOT, 'secrets', []),
+    ('/secrets/', ROOT, 'secrets', ['']),
+    ('/secrets/key', ROOT, 'secrets', ['key']),
+    ('/secrets/sub/key', ROOT, 'sub', ['key']),
+    ('/forwarder', FWD, 'fwd', None),
+    ('/forwarder/a', FWD, 'fwd', ['a']),
+    ('/forwarder/a/c', FWD, 'fwd', ['a', 'c']),
+    ('/forwarder/a/b', DEEP, 'deep', None),
+    ('/forwarder/a/b/', DEEP, 'deep', ['']),
+])
+def test_route(path, consumer, base, trail):
+    con, handler, result = ROUTER.route(tuple(path.split('/')), 'GET')
+    assert con is consumer
+    assert handler(None, None) == base
+    assert result == trail
+
+
+def test_route_head():
+    # HEAD falls back to GET
+    con, handler, _ = ROUTER.route(('', 'forwarder'), 'HEAD')
+    assert con is FWD
+    assert handler(None, None) == 'fwd'
+
+
+def test_route_errors():
+    with pytest.raises(HTTPError) as e:
+        Router({('', 'secrets'): FWD}).route(('', 'other'), 'GET')
+    assert e.value.code == 404
+    with pytest.raises(HTTPError) as e:
+        ROUTER.route(('', 'secrets'), 'PATCH')
+    assert e.value.code == 501
+    with pytest.raises(HTTPError) as e:
+        ROUTER.route(('', 'readonly'), 'PUT')
+    assert e.value.code == 405
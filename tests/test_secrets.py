@@ -1,15 +1,21 @@
 # Copyright (C) 2015  Custodia Project Contributors - see LICENSE file
 from __future__ import absolute_import
 
+import io
+import json
 import logging
 import os
+import threading
+import time
 import unittest
 from base64 import b64encode
 
 from custodia import log
+from custodia import watch
 from custodia.compat import configparser
 from custodia.httpd.authorizers import UserNameSpace
-from custodia.plugin import HTTPError
+from custodia.httpd.server import RequestBody
+from custodia.plugin import CSStore, HTTPError
 from custodia.secrets import Secrets
 from custodia.store.sqlite import SqliteStore
 
@@ -23,6 +29,22 @@ dburi = testdb.sqlite
 """
 
 
+class UnversionedStore(SqliteStore):
+    """Counts get(), stat() is the fallback of CSStore
+    """
+    versioned_keys = False
+    expiring_keys = False
+    stat = CSStore.stat
+
+    def __init__(self, config, section):
+        super(UnversionedStore, self).__init__(config, section)
+        self.gets = 0
+
+    def get(self, key):
+        self.gets += 1
+        return super(UnversionedStore, self).get(key)
+
+
 class SecretsTests(unittest.TestCase):
 
     @classmethod
@@ -45,6 +67,23 @@ class SecretsTests(unittest.TestCase):
         except OSError:
             pass
 
+    def install_notifier(self, store):
+        """Hook a change notifier into the store until the test ends
+        """
+        # pylint: disable=protected-access
+        methods = dict((name, vars(store)[name])
+                       for name in watch.WRITE_METHODS if name in vars(store))
+
+        def restore(notifier):
+            for name in watch.WRITE_METHODS:
+                vars(store).pop(name, None)
+            vars(store).update(methods)
+            watch._notifier = notifier
+
+        self.addCleanup(restore, watch._notifier)
+        watch._notifier = None
+        return watch.install_notifier({'stores': {'sqlite': store}})
+
     def check_authz(self, req):
         req['client_id'] = 'test'
         req['path'] = '/'.join([''] + req.get('trail', []))
@@ -339,6 +378,28 @@ class SecretsTests(unittest.TestCase):
                          {"type": "simple", "value":
                           b64encode(b'1234').decode('utf-8')})
 
+    def test_9_3_PUTRawKeyStream(self):
+        # not a multiple of the base64 chunk size
+        value = os.urandom(100001)
+        body = RequestBody(io.BytesIO(value), len(value))
+        req = {'headers': {'Content-Type': 'application/octet-stream'},
+               'remote_user': 'test',
+               'trail': ['test', 'rawstream'],
+               'body': body}
+        rep = {'headers': {}}
+        self.PUT(req, rep)
+        self.assertEqual(body.remaining, 0)
+        # stored without any encoding
+        key = self.secrets._db_key(['test', 'rawstream'])
+        self.assertEqual(self.secrets.root.store.get(key), value)
+
+        req = {'headers': {'Accept': 'application/octet-stream'},
+               'remote_user': 'test',
+               'trail': ['test', 'rawstream']}
+        rep = {'headers': {}}
+        self.GET(req, rep)
+        self.assertEqual(rep['output'], value)
+
     def test_10_LIST_subcontainer_and_keys(self):
         # Create a container
         req = {'remote_user': 'test',
@@ -411,3 +472,535 @@ class SecretsTests(unittest.TestCase):
                'trail': ['test', 'container_a', '']}
         self.DELETE(req, rep)
         self.assertEqual(rep['code'], 204)
+
+    def test_12_batch(self):
+        req = {'remote_user': 'test',
+               'trail': ['test', 'batch', '']}
+        rep = {'headers': {}}
+        self.POST(req, rep)
+        self.assertEqual(rep['code'], 201)
+
+        items = [
+            {'method': 'PUT', 'name': 'batch/key1',
+             'value': {'type': 'simple', 'value': 'value1'}},
+            {'method': 'PUT', 'name': 'batch/key1',
+             'value': {'type': 'simple', 'value': 'value1'}},
+            {'method': 'GET', 'name': 'batch/key1'},
+            {'method': 'GET', 'name': 'batch/missing'},
+            {'method': 'GET', 'name': '../other/key'},
+            {'method': 'PATCH', 'name': 'batch/key1'},
+            {'method': 'PUT', 'name': 'batch/key2', 'value': {'type': 'x'}},
+            {'method': 'DELETE', 'name': 'batch/key1'},
+            {'method': 'GET', 'name': 'batch/key1'},
+        ]
+        req = {'remote_user': 'test',
+               'trail': ['test', '_batch'],
+               'body': json.dumps(items).encode('utf-8')}
+        rep = {'headers': {}}
+        self.secrets.authorizers = {'user': self.authz}
+        try:
+            self.POST(req, rep)
+        finally:
+            self.secrets.authorizers = None
+        self.assertEqual(rep['code'], 200)
+        codes = [r['code'] for r in rep['output']]
+        self.assertEqual(codes, [201, 409, 200, 404, 400, 400, 400, 204, 404])
+        self.assertEqual(rep['output'][2],
+                         {'name': 'batch/key1', 'code': 200,
+                          'output': {'type': 'simple', 'value': 'value1'}})
+
+    def test_12_batch_authz(self):
+        items = [
+            {'method': 'PUT', 'name': 'test/batch/key3',
+             'value': {'type': 'simple', 'value': 'value3'}},
+            {'method': 'PUT', 'name': 'other/key',
+             'value': {'type': 'simple', 'value': 'value'}},
+        ]
+        req = {'remote_user': 'test',
+               'client_id': 'test',
+               'trail': ['_batch'],
+               'body': json.dumps(items).encode('utf-8')}
+        rep = {'headers': {}}
+        # items are checked by the authorizers on their own
+        self.secrets.authorizers = {'user': self.authz}
+        try:
+            self.secrets.POST(req, rep)
+        finally:
+            self.secrets.authorizers = None
+        codes = [r['code'] for r in rep['output']]
+        self.assertEqual(codes, [201, 403])
+
+        # no authorizers, nothing is allowed
+        rep = {'headers': {}}
+        self.secrets.POST(req, rep)
+        codes = [r['code'] for r in rep['output']]
+        self.assertEqual(codes, [403, 403])
+
+        req['body'] = json.dumps(items * 51).encode('utf-8')
+        with self.assertRaises(HTTPError) as err:
+            self.secrets.POST(req, rep)
+        self.assertEqual(err.exception.code, 413)
+
+        req = {'remote_user': 'test',
+               'trail': ['test', 'batch', 'key3']}
+        self.DELETE(req, rep)
+        req = {'remote_user': 'test',
+               'trail': ['test', 'batch', '']}
+        self.DELETE(req, rep)
+        self.assertEqual(rep['code'], 204)
+
+    def test_13_HEAD(self):
+        req = {'remote_user': 'test',
+               'trail': ['test', 'head']}
+        rep = {'headers': {}}
+        with self.assertRaises(HTTPError) as err:
+            self.secrets.HEAD(req, rep)
+        self.assertEqual(err.exception.code, 404)
+
+        req = {'headers': {'Content-Type': 'application/json'},
+               'remote_user': 'test',
+               'trail': ['test', 'head'],
+               'body': b'{"type":"simple","value":"1234"}'}
+        self.PUT(req, rep)
+
+        req = {'remote_user': 'test',
+               'trail': ['test', 'head']}
+        rep = {'headers': {}}
+        self.secrets.HEAD(req, rep)
+        self.assertNotIn('output', rep)
+        headers = rep['headers']
+        self.assertEqual(headers['X-Custodia-Size'], '4')
+        self.assertEqual(headers['X-Custodia-Version'], '1')
+        self.assertTrue(headers['ETag'].startswith('"1-'))
+        self.assertTrue(headers['Last-Modified'].endswith(' GMT'))
+
+        req = {'remote_user': 'test',
+               'trail': ['test', '']}
+        rep = {'headers': {}}
+        self.secrets.HEAD(req, rep)
+        self.assertNotIn('X-Custodia-Size', rep['headers'])
+
+        req = {'remote_user': 'test',
+               'trail': ['test', 'head']}
+        self.DELETE(req, rep)
+
+    def test_14_GET_conditional(self):
+        req = {'headers': {'Content-Type': 'application/json'},
+               'remote_user': 'test',
+               'trail': ['test', 'etag'],
+               'body': b'{"type":"simple","value":"1234"}'}
+        rep = {'headers': {}}
+        self.PUT(req, rep)
+
+        req = {'remote_user': 'test',
+               'trail': ['test', 'etag']}
+        rep = {'headers': {}}
+        self.GET(req, rep)
+        etag = rep['headers']['ETag']
+
+        # not modified, the value is not read
+        store = self.secrets.root.store
+        get = store.get
+        store.get = None
+        try:
+            for value in [etag, 'W/' + etag, '"other", ' + etag, '*']:
+                req = {'headers': {'If-None-Match': value},
+                       'remote_user': 'test',
+                       'trail': ['test', 'etag']}
+                rep = {'headers': {}}
+                self.GET(req, rep)
+                self.assertEqual(rep['code'], 304)
+                self.assertNotIn('output', rep)
+        finally:
+            store.get = get
+
+        req = {'headers': {'Content-Type': 'application/json'},
+               'remote_user': 'test',
+               'trail': ['test', 'etag'],
+               'body': b'{"type":"simple","value":"5678"}'}
+        store.set(self.secrets._db_key(req['trail']), '5678', replace=True)
+        req = {'headers': {'If-None-Match': etag},
+               'remote_user': 'test',
+               'trail': ['test', 'etag']}
+        rep = {'headers': {}}
+        self.GET(req, rep)
+        self.assertNotIn('code', rep)
+        self.assertEqual(rep['output'], {'type': 'simple', 'value': '5678'})
+        self.assertNotEqual(rep['headers']['ETag'], etag)
+
+        req = {'remote_user': 'test',
+               'trail': ['test', 'etag']}
+        self.DELETE(req, rep)
+
+    def test_15_GET_wait(self):
+        store = self.secrets.root.store
+        self.install_notifier(store)
+        key = self.secrets._db_key(['test', 'wait'])
+        req = {'headers': {'Content-Type': 'application/json'},
+               'remote_user': 'test',
+               'trail': ['test', 'wait'],
+               'body': b'{"type":"simple","value":"1234"}'}
+        rep = {'headers': {}}
+        self.PUT(req, rep)
+        req = {'remote_user': 'test',
+               'trail': ['test', 'wait']}
+        rep = {'headers': {}}
+        self.GET(req, rep)
+        etag = rep['headers']['ETag']
+        req = {'remote_user': 'test',
+               'trail': ['test', '']}
+        rep = {'headers': {}}
+        self.GET(req, rep)
+        list_etag = rep['headers']['ETag']
+
+        # nothing changes until the timeout
+        req = {'headers': {'If-None-Match': etag},
+               'remote_user': 'test',
+               'query': {'wait': ['0.1']},
+               'trail': ['test', 'wait']}
+        rep = {'headers': {}}
+        start = time.time()
+        self.GET(req, rep)
+        self.assertGreaterEqual(time.time() - start, 0.1)
+        self.assertEqual(rep['code'], 304)
+        self.assertEqual(rep['headers']['ETag'], etag)
+
+        def change(*args):
+            time.sleep(0.2)
+            store.set(*args)
+
+        thread = threading.Thread(target=change,
+                                  args=(key, '5678', True))
+        thread.start()
+        req['query'] = {'wait': ['10']}
+        rep = {'headers': {}}
+        start = time.time()
+        try:
+            self.GET(req, rep)
+        finally:
+            thread.join()
+        self.assertLess(time.time() - start, 5)
+        self.assertNotIn('code', rep)
+        self.assertEqual(rep['output'], {'type': 'simple', 'value': '5678'})
+        self.assertNotEqual(rep['headers']['ETag'], etag)
+
+        # a value change does not change the list
+        req = {'headers': {'If-None-Match': list_etag},
+               'remote_user': 'test',
+               'query': {'wait': ['0.1']},
+               'trail': ['test', '']}
+        rep = {'headers': {}}
+        self.GET(req, rep)
+        self.assertEqual(rep['code'], 304)
+
+        thread = threading.Thread(target=change,
+                                  args=(key + '2', '1234', False))
+        thread.start()
+        req['query'] = {'wait': ['10']}
+        rep = {'headers': {}}
+        try:
+            self.GET(req, rep)
+        finally:
+            thread.join()
+        self.assertNotIn('code', rep)
+        self.assertEqual(sorted(rep['output']),
+                         ['wait', 'wait2'])
+
+        # no free waiter slot, 304 right away
+        notifier = watch.get_notifier()
+        watch._notifier = watch.ChangeNotifier(max_waiters=0)
+        try:
+            req = {'headers': {'If-None-Match': rep['headers']['ETag']},
+                   'remote_user': 'test',
+                   'query': {'wait': ['10']},
+                   'trail': ['test', '']}
+            rep = {'headers': {}}
+            start = time.time()
+            self.GET(req, rep)
+            self.assertLess(time.time() - start, 5)
+            self.assertEqual(rep['code'], 304)
+        finally:
+            watch._notifier = notifier
+
+        for value in ['invalid', 'nan']:
+            req = {'headers': {'If-None-Match': etag},
+                   'remote_user': 'test',
+                   'query': {'wait': [value]},
+                   'trail': ['test', 'wait']}
+            with self.assertRaises(HTTPError) as err:
+                self.GET(req, {'headers': {}})
+            self.assertEqual(err.exception.code, 400)
+
+        for name in ['wait', 'wait2']:
+            req = {'remote_user': 'test',
+                   'trail': ['test', name]}
+            self.DELETE(req, {})
+
+    def test_16_LIST_paged(self):
+        names = ['page%i' % i for i in range(5)]
+        for name in names:
+            req = {'headers': {'Content-Type': 'application/json'},
+                   'remote_user': 'test',
+                   'trail': ['test', name],
+                   'body': b'{"type":"simple","value":"1234"}'}
+            self.PUT(req, {'headers': {}})
+
+        listed = []
+        query = {'limit': ['2']}
+        pages = 0
+        while True:
+            req = {'remote_user': 'test',
+                   'query': query,
+                   'trail': ['test', '']}
+            rep = {'headers': {}}
+            self.GET(req, rep)
+            pages += 1
+            self.assertLessEqual(len(rep['output']), 2)
+            listed.extend(rep['output'])
+            cursor = rep['headers'].get('X-Custodia-Cursor')
+            if cursor is None:
+                break
+            query = {'limit': ['2'], 'cursor': [cursor]}
+        self.assertEqual(pages, 3)
+        self.assertEqual([n for n in listed if n.startswith('page')], names)
+
+        for query in [{'limit': ['0']}, {'limit': ['x']},
+                      {'cursor': ['!']}, {'limit': ['1', '2']}]:
+            req = {'remote_user': 'test',
+                   'query': query,
+                   'trail': ['test', '']}
+            with self.assertRaises(HTTPError) as err:
+                self.GET(req, {'headers': {}})
+            self.assertEqual(err.exception.code, 400)
+
+        for name in names:
+            req = {'remote_user': 'test',
+                   'trail': ['test', name]}
+            self.DELETE(req, {})
+
+    def test_17_LIST_stream(self):
+        req = {'remote_user': 'test',
+               'trail': ['test', 'stream', '']}
+        self.POST(req, {'headers': {}})
+        names = ['a', 'b', 'c']
+        for name in names:
+            req = {'headers': {'Content-Type': 'application/json'},
+                   'remote_user': 'test',
+                   'trail': ['test', 'stream', name],
+                   'body': b'{"type":"simple","value":"1234"}'}
+            self.PUT(req, {'headers': {}})
+
+        def stream(query):
+            req = {'headers': {'Accept': 'application/x-ndjson'},
+                   'remote_user': 'test',
+                   'query': query,
+                   'trail': ['test', '']}
+            rep = {'headers': {}}
+            self.GET(req, rep)
+            self.assertEqual(rep['headers']['Content-Type'],
+                             'application/x-ndjson')
+            output = b''.join(rep['output']).decode('utf-8')
+            return [json.loads(line) for line in output.splitlines()]
+
+        max_page_size = self.secrets.max_page_size
+        # several pages are fetched from the store
+        self.secrets.max_page_size = 2
+        try:
+            listed = stream({})
+            self.assertEqual(
+                sorted(n for n in listed if n.startswith('stream')),
+                ['stream/', 'stream/a', 'stream/b', 'stream/c'])
+            self.assertEqual(stream({'recursive': ['false']}),
+                             [n for n in listed if '/' not in n[:-1]])
+        finally:
+            self.secrets.max_page_size = max_page_size
+
+        req = {'remote_user': 'test',
+               'query': {'recursive': ['false']},
+               'trail': ['test', 'stream', '']}
+        rep = {'headers': {}}
+        self.GET(req, rep)
+        self.assertEqual(rep['output'], names)
+        req['query'] = {'recursive': ['maybe']}
+        with self.assertRaises(HTTPError) as err:
+            self.GET(req, {'headers': {}})
+        self.assertEqual(err.exception.code, 400)
+
+        req = {'headers': {'Accept': 'application/x-ndjson'},
+               'remote_user': 'test',
+               'trail': ['test', 'missing', '']}
+        with self.assertRaises(HTTPError) as err:
+            self.GET(req, {'headers': {}})
+        self.assertEqual(err.exception.code, 404)
+
+        for name in names:
+            req = {'remote_user': 'test',
+                   'trail': ['test', 'stream', name]}
+            self.DELETE(req, {})
+        req = {'remote_user': 'test',
+               'trail': ['test', 'stream', '']}
+        self.DELETE(req, {})
+
+    def test_18_versions(self):
+        store = self.secrets.root.store
+        store.history = 2
+        try:
+            req = {'headers': {'Content-Type': 'application/json'},
+                   'remote_user': 'test',
+                   'trail': ['test', 'versioned'],
+                   'body': b'{"type":"simple","value":"v1"}'}
+            self.PUT(req, {'headers': {}})
+            key = self.secrets._db_key(['test', 'versioned'])
+            store.set(key, 'v2', replace=True)
+            store.set(key, 'v3', replace=True)
+
+            req = {'remote_user': 'test',
+                   'query': {'history': ['true']},
+                   'trail': ['test', 'versioned']}
+            rep = {'headers': {}}
+            self.GET(req, rep)
+            self.assertEqual([v['version'] for v in rep['output']],
+                             [3, 2, 1])
+
+            req = {'remote_user': 'test',
+                   'query': {'version': ['1']},
+                   'trail': ['test', 'versioned']}
+            rep = {'headers': {}}
+            self.GET(req, rep)
+            self.assertEqual(rep['output'],
+                             {'type': 'simple', 'value': 'v1'})
+
+            # rollback
+            rep = {'headers': {}}
+            self.POST(req, rep)
+            self.assertEqual(rep['headers']['X-Custodia-Version'], '4')
+            req = {'remote_user': 'test',
+                   'trail': ['test', 'versioned']}
+            rep = {'headers': {}}
+            self.GET(req, rep)
+            self.assertEqual(rep['output'],
+                             {'type': 'simple', 'value': 'v1'})
+
+            for query, code in [({'version': ['9']}, 404),
+                                ({'version': ['x']}, 400),
+                                ({'version': ['0']}, 400),
+                                ({'history': ['maybe']}, 400)]:
+                req = {'remote_user': 'test',
+                       'query': query,
+                       'trail': ['test', 'versioned']}
+                with self.assertRaises(HTTPError) as err:
+                    self.GET(req, {'headers': {}})
+                self.assertEqual(err.exception.code, code)
+            req = {'remote_user': 'test',
+                   'query': {'version': ['1']},
+                   'trail': ['test', 'versioned']}
+            with self.assertRaises(HTTPError) as err:
+                self.POST(req, {'headers': {}})
+            self.assertEqual(err.exception.code, 404)
+        finally:
+            store.history = 0
+            req = {'remote_user': 'test',
+                   'trail': ['test', 'versioned']}
+            self.DELETE(req, {})
+
+    def test_19_PUT_expiring(self):
+        req = {'headers': {'Content-Type': 'application/json'},
+               'remote_user': 'test',
+               'query': {'ttl': ['0.2']},
+               'trail': ['test', 'expiring'],
+               'body': b'{"type":"simple","value":"temporary"}'}
+        rep = {'headers': {}}
+        self.PUT(req, rep)
+        self.assertEqual(rep['code'], 201)
+        req = {'remote_user': 'test',
+               'trail': ['test', 'expiring']}
+        rep = {'headers': {}}
+        self.secrets.HEAD(req, rep)
+        self.assertIn('X-Custodia-Expires', rep['headers'])
+        expires = rep['headers']['X-Custodia-Expires']
+        rep = {'headers': {}}
+        self.GET(req, rep)
+        self.assertEqual(rep['headers']['X-Custodia-Expires'], expires)
+
+        # gone right away, the reaper only frees the space
+        time.sleep(0.3)
+        with self.assertRaises(HTTPError) as err:
+            self.GET(req, {'headers': {}})
+        self.assertEqual(err.exception.code, 404)
+        key = self.secrets._db_key(['test', 'expiring'])
+        self.assertEqual(self.secrets.root.store.reap(), [key])
+
+        for query in [{'ttl': ['x']}, {'ttl': ['-1']}, {'ttl': ['nan']},
+                      {'expires': ['1']}, {'ttl': ['1'], 'expires': ['1']}]:
+            req = {'headers': {'Content-Type': 'application/json'},
+                   'remote_user': 'test',
+                   'query': query,
+                   'trail': ['test', 'expiring'],
+                   'body': b'{"type":"simple","value":"temporary"}'}
+            with self.assertRaises(HTTPError) as err:
+                self.PUT(req, {'headers': {}})
+            self.assertEqual(err.exception.code, 400)
+
+        expires = time.time() + 60
+        req['query'] = {'expires': [str(expires)]}
+        self.PUT(req, {'headers': {}})
+        stat = self.secrets.root.store.stat(key)
+        self.assertAlmostEqual(stat['expires'], expires, places=3)
+        self.DELETE({'remote_user': 'test',
+                     'trail': ['test', 'expiring']}, {})
+
+    def test_20_GET_unversioned(self):
+        store = self.secrets.root.store
+        self.secrets.root.store = UnversionedStore(self.parser,
+                                                   'store:sqlite')
+        try:
+            req = {'headers': {'Content-Type': 'application/json'},
+                   'remote_user': 'test',
+                   'trail': ['test', 'plain'],
+                   'body': b'{"type":"simple","value":"1234"}'}
+            self.PUT(req, {'headers': {}})
+            gets = self.secrets.root.store.gets
+            req = {'remote_user': 'test',
+                   'trail': ['test', 'plain']}
+            rep = {'headers': {}}
+            self.GET(req, rep)
+            # no stat() before the value is read
+            self.assertEqual(self.secrets.root.store.gets, gets + 1)
+            self.assertNotIn('ETag', rep['headers'])
+            self.assertEqual(rep['output'],
+                             {'type': 'simple', 'value': '1234'})
+            self.DELETE({'remote_user': 'test',
+                         'trail': ['test', 'plain']}, {})
+        finally:
+            self.secrets.root.store = store
+
+    def test_21_LIST_paged_children(self):
+        req = {'remote_user': 'test',
+               'trail': ['test', 'paged', '']}
+        self.POST(req, {'headers': {}})
+        store = self.secrets.root.store
+        base = self.secrets._db_key(['test', 'paged', ''])
+        # the first store pages only hold keys of a sub-container
+        nested = ['a/%i' % i for i in range(5)]
+        for name in nested:
+            store.set(base + name, 'value')
+        store.set(base + 'z', 'value')
+        try:
+            req = {'remote_user': 'test',
+                   'query': {'limit': ['2'], 'recursive': ['false']},
+                   'trail': ['test', 'paged', '']}
+            rep = {'headers': {}}
+            self.GET(req, rep)
+            self.assertEqual(rep['output'], ['z'])
+            self.assertNotIn('X-Custodia-Cursor', rep['headers'])
+
+            req['query'] = {'limit': ['2']}
+            rep = {'headers': {}}
+            self.GET(req, rep)
+            self.assertEqual(rep['output'], nested[:2])
+            self.assertIn('X-Custodia-Cursor', rep['headers'])
+        finally:
+            for name in nested + ['z']:
+                store.cut(base + name)
+            self.DELETE({'remote_user': 'test',
+                         'trail': ['test', 'paged', '']}, {})
@@ -60,10 +60,22 @@ def test_parse_config(args):
         'libdir': u'/var/lib/custodia',
         'logdir': u'/var/log/custodia',
         'makedirs': False,
+        'reap_interval': 60.0,
         'rundir': u'/var/run/custodia',
+        'server_engine': 'fork',
+        'server_keepalive_requests': 100,
+        'server_keepalive_timeout': 0.0,
+        'server_max_waiters': None,
+        'server_reuseport': False,
+        'server_threads': 8,
         'server_url': 'http+unix://%2Fvar%2Frun%2Fcustodia%2Fcustodia.sock/',
+        'server_worker_max_memory': 0,
+        'server_worker_max_requests': 0,
+        'server_workers': 0,
         'socketdir': u'/var/run/custodia',
         'stores': {},
+        'tls_handshake_timeout': 10.0,
+        'tls_session_tickets': True,
         'tls_verify_client': False,
         'umask': 23
     }
@@ -92,10 +104,22 @@ def test_parse_config_instance(args_instance):
         'libdir': u'/var/lib/custodia/testing',
         'logdir': u'/var/log/custodia/testing',
         'makedirs': False,
+        'reap_interval': 60.0,
         'rundir': u'/var/run/custodia/testing',
+        'server_engine': 'fork',
+        'server_keepalive_requests': 100,
+        'server_keepalive_timeout': 0.0,
+        'server_max_waiters': None,
+        'server_reuseport': False,
+        'server_threads': 8,
         'server_url': 'http+unix://%2Fvar%2Frun%2Fcustodia%2Ftesting.sock/',
+        'server_worker_max_memory': 0,
+        'server_worker_max_requests': 0,
+        'server_workers': 0,
         'socketdir': u'/var/run/custodia',
         'stores': {},
+        'tls_handshake_timeout': 10.0,
+        'tls_session_tickets': True,
         'tls_verify_client': False,
         'umask': 23
     }
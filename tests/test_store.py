@@ -4,11 +4,14 @@ from __future__ import absolute_import, print_function
 import os
 import shutil
 import tempfile
+import time
 import unittest
 
+from custodia.cache import SharedCache
 from custodia.compat import configparser
 from custodia.plugin import CSStoreError
-from custodia.store.encgen import EncryptedOverlay
+from custodia.store.cached import CachedOverlay
+from custodia.store.encgen import BINARY_CTY, EncryptedOverlay
 from custodia.store.sqlite import SqliteStore
 
 
@@ -36,6 +39,11 @@ backing_store = teststore
 master_key = ${tmpdir}/master.key
 autogen_master_key = true
 secret_protection = pinning
+
+[store:cached]
+backing_store = teststore
+cache_slots = 4
+cache_slot_size = 16
 """
 
 
@@ -100,3 +108,199 @@ class EncryptedOverlayTests(unittest.TestCase):
         self.assertEqual(enc.protected_header['custodia.key'], key)
         self.assertEqual(enc.secret_protection, 'pinning')
         self.assertEqual(enc.get(key), 'value2')
+
+    def test_batch(self):
+        enc = EncryptedOverlay(self.parser, 'store:enc_pinning')
+        enc.store = self.backing_store
+        enc.set_many([('batch1', 'value1'), ('batch2', 'value2')])
+        self.assertEqual(enc.get('batch2'), 'value2')
+        self.assertEqual(enc.get_many(['batch1', 'batch2', 'missing']),
+                         {'batch1': 'value1', 'batch2': 'value2',
+                          'missing': None})
+        # values are pinned to their own key
+        self.backing_store.set('batch1', self.backing_store.get('batch2'),
+                               replace=True)
+        with self.assertRaises(CSStoreError):
+            enc.get_many(['batch1'])
+        self.assertEqual(enc.cut_many(['batch1', 'batch2']),
+                         {'batch1': True, 'batch2': True})
+
+    def test_binary(self):
+        enc = EncryptedOverlay(self.parser, 'store:enc_pinning')
+        enc.store = self.backing_store
+        self.assertTrue(enc.binary_values)
+        value = b'\x00\xffbinary'
+        enc.set('binary', value)
+        self.assertEqual(enc.protected_header['cty'], BINARY_CTY)
+        self.assertEqual(enc.get('binary'), value)
+        enc.set('binary', 'text', replace=True)
+        self.assertNotIn('cty', enc.protected_header)
+        self.assertEqual(enc.get('binary'), 'text')
+        enc.cut('binary')
+
+    def test_history(self):
+        enc = EncryptedOverlay(self.parser, 'store:enc_pinning')
+        enc.store = self.backing_store
+        self.backing_store.history = 2
+        try:
+            enc.set('history', 'v1')
+            enc.set('history', 'v2', replace=True)
+            self.assertEqual(enc.get_version('history', 1), 'v1')
+            self.assertEqual([v['version'] for v in enc.versions('history')],
+                             [2, 1])
+            # the pinned JWE is copied, it still decrypts
+            self.assertTrue(enc.restore('history', 1))
+            self.assertEqual(enc.get('history'), 'v1')
+        finally:
+            self.backing_store.history = 0
+        enc.cut('history')
+
+
+class CachedOverlayTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.parser = configparser.ConfigParser(
+            interpolation=configparser.ExtendedInterpolation(),
+            defaults={'tmpdir': cls.tmpdir}
+        )
+        cls.parser.read_string(CONFIG)
+        cls.backing_store = SqliteStore(cls.parser, 'store:teststore')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def setUp(self):
+        self.cached = CachedOverlay(self.parser, 'store:cached')
+        self.cached.store = self.backing_store
+
+    def test_get_cached(self):
+        self.cached.set('cached/key', 'value')
+        self.assertEqual(self.cached.get('cached/key'), 'value')
+        # served from the cache
+        self.backing_store.set('cached/key', 'other', replace=True)
+        self.assertEqual(self.cached.get('cached/key'), 'value')
+        # set and cut invalidate the key
+        self.cached.set('cached/key', 'new', replace=True)
+        self.assertEqual(self.cached.get('cached/key'), 'new')
+        self.cached.cut('cached/key')
+        self.assertIsNone(self.cached.get('cached/key'))
+        # too large for the cache
+        value = 'x' * 17
+        self.cached.set('cached/large', value)
+        self.assertEqual(self.cached.get('cached/large'), value)
+        self.assertIsNone(self.cached.cache.get('cached/large'))
+
+    def test_binary(self):
+        self.assertTrue(self.cached.binary_values)
+        self.cached.set('cached/binary', b'\x00bytes')
+        self.cached.set('cached/text', 'text')
+        for _ in range(2):
+            # read from the store, then from the cache
+            self.assertEqual(self.cached.get('cached/binary'), b'\x00bytes')
+            self.assertEqual(self.cached.get('cached/text'), 'text')
+        self.assertEqual(self.backing_store.get('cached/binary'),
+                         b'\x00bytes')
+
+    def test_restore(self):
+        self.backing_store.history = 1
+        try:
+            self.cached.set('cached/restore', 'v1')
+            self.cached.set('cached/restore', 'v2', replace=True)
+            self.assertEqual(self.cached.get('cached/restore'), 'v2')
+            self.assertTrue(self.cached.restore('cached/restore', 1))
+            # invalidated
+            self.assertEqual(self.cached.get('cached/restore'), 'v1')
+        finally:
+            self.backing_store.history = 0
+        self.cached.cut('cached/restore')
+
+    def test_expiring(self):
+        self.assertTrue(self.cached.expiring_keys)
+        self.cached.set_expiring('cached/expiring', 'value',
+                                 time.time() + 0.2)
+        self.assertEqual(self.cached.get('cached/expiring'), 'value')
+        self.assertIsNotNone(self.cached.cache.get('cached/expiring'))
+        time.sleep(0.3)
+        # not served from the cache after the key expired
+        self.assertIsNone(self.cached.get('cached/expiring'))
+        self.assertIsNone(self.cached.stat('cached/expiring'))
+        self.cached.set_expiring('cached/expiring', 'value', time.time() - 1)
+        self.assertEqual(self.cached.reap(), ['cached/expiring'])
+
+    def test_get_many(self):
+        self.cached.set_many([('cached/m1', 'value1'), ('cached/m2', 'x')])
+        self.assertEqual(self.cached.get('cached/m1'), 'value1')
+        self.backing_store.set('cached/m1', 'other', replace=True)
+        value = self.cached.get_many(['cached/m1', 'cached/m2', 'cached/m3'])
+        self.assertEqual(value, {'cached/m1': 'value1', 'cached/m2': 'x',
+                                 'cached/m3': None})
+        self.assertEqual(self.cached.cache.get('cached/m2'), b'tx')
+        self.cached.cut_many(['cached/m1', 'cached/m2'])
+        self.assertIsNone(self.cached.cache.get('cached/m2'))
+        self.assertEqual(self.cached.get_many(['cached/m1']),
+                         {'cached/m1': None})
+
+    def test_stat_cached(self):
+        self.cached.cache = SharedCache(slots=4, slot_size=128)
+        self.cached.set('cached/stat', 'value')
+        stat = self.cached.stat('cached/stat')
+        self.assertEqual(stat['version'], 1)
+        # served from the cache
+        self.backing_store.set('cached/stat', 'other', replace=True)
+        self.assertEqual(self.cached.stat('cached/stat'), stat)
+        # writes invalidate the stat
+        self.cached.set('cached/stat', 'new', replace=True)
+        self.assertEqual(self.cached.stat('cached/stat')['version'], 3)
+        self.cached.cut('cached/stat')
+        self.assertIsNone(self.cached.stat('cached/stat'))
+
+    def test_shared_with_children(self):
+        self.cached.set('cached/child', 'value')
+        pid = os.fork()
+        if not pid:
+            try:
+                self.cached.get('cached/child')
+            finally:
+                os._exit(0)  # pylint: disable=protected-access
+        os.waitpid(pid, 0)
+        # the value was cached by the child
+        self.assertEqual(self.cached.cache.get('cached/child'), b'tvalue')
+
+
+class SharedCacheTests(unittest.TestCase):
+    def test_lru(self):
+        cache = SharedCache(slots=2, slot_size=8, ways=2)
+        cache.put('a', b'1')
+        cache.put('b', b'2')
+        self.assertEqual(cache.get('a'), b'1')
+        # 'b' is the least recently used entry
+        cache.put('c', b'3')
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), b'1')
+        self.assertEqual(cache.get('c'), b'3')
+
+    def test_ttl(self):
+        cache = SharedCache(ttl=-1)
+        self.assertTrue(cache.put('a', b'1'))
+        self.assertIsNone(cache.get('a'))
+        # an entry may expire before the ttl of the cache
+        cache = SharedCache()
+        self.assertTrue(cache.put('a', b'1', ttl=0.01))
+        time.sleep(0.02)
+        self.assertIsNone(cache.get('a'))
+        # already expired
+        self.assertFalse(cache.put('a', b'1', ttl=0))
+
+    def test_generation(self):
+        cache = SharedCache()
+        generation = cache.generation('a')
+        cache.invalidate('a')
+        # a concurrent write invalidated the value
+        self.assertFalse(cache.put('a', b'old', generation))
+        self.assertIsNone(cache.get('a'))
+        self.assertTrue(cache.put('a', b'new', cache.generation('a')))
+        self.assertEqual(cache.get('a'), b'new')
+        cache.clear()
+        self.assertIsNone(cache.get('a'))
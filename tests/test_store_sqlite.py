@@ -1,17 +1,40 @@
 # Copyright (C) 2015  Custodia Project Contributors - see LICENSE file
 from __future__ import absolute_import, print_function
 
+import os
 import shutil
+import sqlite3
 import tempfile
+import threading
+import time
 import unittest
 
 from custodia.compat import configparser
-from custodia.plugin import CSStoreExists
+from custodia.plugin import CSStore, CSStoreError, CSStoreExists
 from custodia.store.sqlite import SqliteStore
 
 CONFIG = u"""
 [store:teststore]
 dburi = ${tmpdir}/teststore.sqlite
+
+[store:walstore]
+dburi = ${tmpdir}/walstore.sqlite
+journal_mode = WAL
+synchronous = normal
+mmap_size = 1048576
+cache_size = -1024
+busy_timeout = 0.5
+
+[store:history]
+dburi = ${tmpdir}/teststore.sqlite
+history = 2
+
+[store:legacy]
+dburi = ${tmpdir}/legacy.sqlite
+
+[store:invalid]
+dburi = ${tmpdir}/invalid.sqlite
+journal_mode = fast
 """
 
 
@@ -125,3 +148,333 @@ class SqliteStoreTests(unittest.TestCase):
     def test_8_cut_span(self):
         ret = self.store.cut('/span/2')
         self.assertEqual(ret, True)
+
+    def test_8_list_range(self):
+        # keys that share a prefix with the container are not listed
+        self.store.set('/range/key', 'value')
+        self.store.set('/range0', 'value')
+        self.store.set('/range-x/key', 'value')
+        self.store.set('/rangex', 'value')
+        value = self.store.list('/range')
+        self.assertEqual(value, ['key'])
+
+        # the scan is answered by the primary key index
+        conn = self.store._connect()  # pylint: disable=protected-access
+        plan = conn.execute(
+            "EXPLAIN QUERY PLAN SELECT key FROM %s "
+            "WHERE key >= ? AND key < ?" % self.store.table,
+            ('/range/', '/range0')).fetchall()
+        self.assertIn('(key>? AND key<?)', str(plan[0][-1]))
+        for key in ('/range/key', '/range0', '/range-x/key', '/rangex'):
+            self.store.cut(key)
+
+    def test_8_list_page(self):
+        self.store.span('/page/sub')
+        for name in ('a', 'b', 'c', 'sub/d', 'sub-e'):
+            self.store.set('/page/' + name, 'value')
+        self.store.set('/page0', 'value')
+        names = []
+        after = None
+        while True:
+            page, after = self.store.list_page('/page', 2, after)
+            self.assertLessEqual(len(page), 2)
+            names.extend(page)
+            if after is None:
+                break
+        self.assertEqual(sorted(names), self.store.list('/page'))
+        # pages follow the order of the keys, not the sorted list
+        self.assertEqual(names, ['a', 'b', 'c', 'sub/', 'sub-e', 'sub/d'])
+
+        self.assertEqual(self.store.list_page('/page/', 10), (
+            ['a', 'b', 'c', 'sub/', 'sub-e', 'sub/d'], None))
+        self.assertEqual(self.store.list_page('/page/sub', 10),
+                         (['d'], None))
+        self.assertEqual(self.store.list_page('/page', 10, 'sub/d'),
+                         ([], None))
+        self.assertIsNone(self.store.list_page('/missing', 10))
+        self.assertEqual(list(self.store.list_iter('/page', 2)), names)
+        self.assertIsNone(self.store.list_iter('/missing'))
+        # same result as the generic implementation
+        self.assertEqual(CSStore.list_page(self.store, '/page', 4, 'a'),
+                         (['b', 'c', 'sub-e', 'sub/'], 'sub/'))
+
+        for key in ('/page/a', '/page/b', '/page/c', '/page/sub/d',
+                    '/page/sub-e', '/page/sub', '/page0'):
+            self.store.cut(key)
+
+    def test_8_history(self):
+        store = SqliteStore(self.parser, 'store:history')
+        # the default store keeps no history
+        self.store.set('/history/none', 'v1')
+        self.store.set('/history/none', 'v2', replace=True)
+        self.assertEqual([v['version'] for v in store.versions(
+            '/history/none')], [2])
+
+        store.set('/history/key', 'v1')
+        for value in ('v2', 'v3', 'v4'):
+            store.set('/history/key', value, replace=True)
+        versions = store.versions('/history/key')
+        self.assertEqual([v['version'] for v in versions], [4, 3, 2])
+        self.assertEqual(versions[0]['size'], 2)
+        self.assertIsNone(store.get_version('/history/key', 1))
+        self.assertEqual(store.get_version('/history/key', 2), 'v2')
+        self.assertEqual(store.get_version('/history/key', 4), 'v4')
+
+        # the old value becomes a new version
+        self.assertTrue(store.restore('/history/key', 2))
+        self.assertEqual(store.get('/history/key'), 'v2')
+        self.assertEqual([v['version'] for v in store.versions(
+            '/history/key')], [5, 4, 3])
+        self.assertTrue(store.restore('/history/key', 5))
+        self.assertFalse(store.restore('/history/key', 2))
+        self.assertFalse(store.restore('/history/missing', 1))
+
+        # same result as the generic implementation
+        self.assertEqual(CSStore.get_version(store, '/history/key', 5), 'v2')
+        self.assertIsNone(CSStore.get_version(store, '/history/key', 4))
+
+        store.span('/history/container')
+        self.assertIsNone(store.versions('/history/container'))
+        self.assertIsNone(store.get_version('/history/container', 1))
+
+        # removed keys start over
+        store.cut('/history/key')
+        self.assertIsNone(store.versions('/history/key'))
+        store.set('/history/key', 'new')
+        self.assertEqual(store.get_version('/history/key', 1), 'new')
+        self.assertIsNone(store.get_version('/history/key', 4))
+        for key in ('/history/key', '/history/none', '/history/container'):
+            store.cut(key)
+
+    def test_8_batch(self):
+        items = [('/batch/key%i' % i, 'value%i' % i) for i in range(600)]
+        self.store.set_many(items)
+        keys = [key for key, _ in items] + ['/batch/missing']
+        value = self.store.get_many(keys)
+        self.assertEqual(value, dict(items, **{'/batch/missing': None}))
+
+        # all or nothing
+        with self.assertRaises(CSStoreExists):
+            self.store.set_many([('/batch/new', 'x'), ('/batch/key0', 'x')])
+        self.assertIsNone(self.store.get('/batch/new'))
+        self.store.set_many([('/batch/new', 'x'), ('/batch/key0', 'x')],
+                            replace=True)
+        self.assertEqual(self.store.get('/batch/key0'), 'x')
+        with self.assertRaises(ValueError):
+            self.store.set_many([('/batch/', 'x')])
+
+        value = self.store.cut_many(['/batch/new', '/batch/missing'])
+        self.assertEqual(value, {'/batch/new': True, '/batch/missing': False})
+        self.store.cut_many(keys)
+        self.assertEqual(self.store.list('/batch'), None)
+
+    def test_8_stat(self):
+        self.store.span('/stat')
+        self.store.set('/stat/key', 'value')
+        self.store.set('/statx', 'value')
+        self.store.set('/implicit/key', 'value')
+        self.store.span('/stat/empty')
+        cases = {
+            '/stat': {'container': True, 'empty': False},
+            '/stat/': {'container': True, 'empty': False},
+            '/stat/key': {'container': False},
+            '/stat/empty/': {'container': True, 'empty': True},
+            '/stat/empty': {'container': True, 'empty': True},
+            # containers exist implicitly when keys below them exist
+            '/implicit/': {'container': True, 'empty': False},
+            '/implicit': None,
+            '/stat/missing': None,
+            '/stat/missing/': None,
+            '/sta/': None,
+        }
+
+        def kind(stat):
+            if stat is None:
+                return None
+            return dict((k, stat[k]) for k in ('container', 'empty')
+                        if k in stat)
+
+        for key, expected in cases.items():
+            self.assertEqual(kind(self.store.stat(key)), expected, key)
+            self.assertEqual(self.store.exists(key), expected is not None,
+                             key)
+            # same result as the generic implementation
+            generic = CSStore.stat(self.store, key)
+            self.assertEqual(kind(generic), expected, key)
+            if expected is not None and not expected['container']:
+                self.assertEqual(self.store.stat(key)['size'],
+                                 generic['size'], key)
+
+        stat = self.store.stat('/stat/key')
+        self.assertEqual((stat['size'], stat['version']), (5, 1))
+        self.store.set('/stat/key', u'v\xe4lue', replace=True)
+        new = self.store.stat('/stat/key')
+        self.assertEqual((new['size'], new['version']), (6, 2))
+        self.assertGreaterEqual(new['modified'], stat['modified'])
+        self.assertEqual(self.store.stat('/stat')['version'], 1)
+        self.store.cut_many(['/stat/key', '/statx', '/implicit/key',
+                             '/stat/empty', '/stat'])
+
+    def test_8_expiry(self):
+        store = SqliteStore(self.parser, 'store:history')
+        past, future = time.time() - 1, time.time() + 60
+        store.span('/expiry')
+        store.set_expiring('/expiry/live', 'value', future)
+        store.set_expiring('/expiry/gone', 'value', past)
+        store.set('/expiry/gone/key', 'value')
+        self.assertEqual(store.stat('/expiry/live')['expires'], future)
+        self.assertNotIn('expires', store.stat('/expiry/gone/key'))
+
+        # expired keys are hidden right away
+        self.assertIsNone(store.get('/expiry/gone'))
+        self.assertIsNone(store.stat('/expiry/gone'))
+        self.assertFalse(store.exists('/expiry/gone'))
+        self.assertEqual(store.get_many(['/expiry/live', '/expiry/gone']),
+                         {'/expiry/live': 'value', '/expiry/gone': None})
+        self.assertEqual(store.list('/expiry'), ['gone/key', 'live'])
+        self.assertEqual(store.list_page('/expiry', 10),
+                         (['gone/key', 'live'], None))
+
+        # a replace keeps the expiry time, versions expire with the key
+        store.set('/expiry/live', 'new', replace=True)
+        self.assertEqual(store.stat('/expiry/live')['expires'], future)
+        self.assertEqual(store.get_version('/expiry/live', 1), 'value')
+        store.set_expiring('/expiry/live', 'old', past, replace=True)
+        self.assertIsNone(store.versions('/expiry/live'))
+        self.assertIsNone(store.get_version('/expiry/live', 1))
+        self.assertFalse(store.restore('/expiry/live', 1))
+
+        # written like a missing key
+        store.set('/expiry/gone', 'again')
+        self.assertEqual(store.stat('/expiry/gone')['version'], 1)
+        self.assertFalse(store.cut('/expiry/live'))
+        store.set_expiring('/expiry/reaped', 'value', past)
+        self.assertEqual(store.reap(), ['/expiry/reaped'])
+        self.assertEqual(store.reap(), [])
+        # nothing is left in the history either
+        store.set('/expiry/reaped', 'value')
+        self.assertEqual(len(store.versions('/expiry/reaped')), 1)
+        store.cut_many(['/expiry/gone', '/expiry/gone/key',
+                        '/expiry/reaped', '/expiry'])
+
+    def test_9_connection(self):
+        # pylint: disable=protected-access
+        conn = self.store._connect()
+        # the connection is kept open and reused
+        self.assertIs(self.store._connect(), conn)
+
+        # threads and forked children use connections of their own
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(self.store._connect()))
+        thread.start()
+        thread.join()
+        self.assertIsNot(result[0], conn)
+
+        pid = os.fork()
+        if not pid:
+            status = 1
+            try:
+                if self.store._connect() is not conn:
+                    self.store.set('forked', 'child')
+                    status = 0
+            finally:
+                os._exit(status)  # pylint: disable=protected-access
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(status, 0)
+        self.assertEqual(self.store.get('forked'), 'child')
+        self.assertIs(self.store._connect(), conn)
+
+
+class SqliteStorePragmaTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.parser = configparser.ConfigParser(
+            interpolation=configparser.ExtendedInterpolation(),
+            defaults={'tmpdir': cls.tmpdir}
+        )
+        cls.parser.read_string(CONFIG)
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def test_pragmas(self):
+        store = SqliteStore(self.parser, 'store:walstore')
+        conn = store._connect()  # pylint: disable=protected-access
+        pragmas = {}
+        for name in ['journal_mode', 'synchronous', 'mmap_size',
+                     'cache_size']:
+            pragmas[name] = conn.execute('PRAGMA ' + name).fetchone()[0]
+        self.assertEqual(pragmas, {'journal_mode': 'wal',
+                                   'synchronous': 1,
+                                   'mmap_size': 1048576,
+                                   'cache_size': -1024})
+        store.set('key', 'value')
+        self.assertEqual(store.get('key'), 'value')
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            SqliteStore(self.parser, 'store:invalid')
+
+
+class SqliteStoreSchemaTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tmpdir = tempfile.mkdtemp()
+        cls.parser = configparser.ConfigParser(
+            interpolation=configparser.ExtendedInterpolation(),
+            defaults={'tmpdir': cls.tmpdir}
+        )
+        cls.parser.read_string(CONFIG)
+        cls.dburi = os.path.join(cls.tmpdir, 'legacy.sqlite')
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.tmpdir)
+
+    def _query(self, query, *args):
+        conn = sqlite3.connect(self.dburi)
+        try:
+            return conn.execute(query, args).fetchall()
+        finally:
+            conn.close()
+
+    def test_1_upgrade(self):
+        # table layout of releases without schema version
+        conn = sqlite3.connect(self.dburi)
+        with conn:
+            conn.execute("CREATE TABLE CustodiaSecrets "
+                         "(key PRIMARY KEY UNIQUE, value)")
+            conn.executemany("INSERT INTO CustodiaSecrets VALUES (?, ?)",
+                             [('/sub', ''), ('/sub/key', 'value')])
+        conn.close()
+
+        store = SqliteStore(self.parser, 'store:legacy')
+        self.assertEqual(store.get('/sub/key'), 'value')
+        self.assertEqual(store.list('/sub'), ['key'])
+        self.assertEqual(
+            self._query("SELECT version FROM CustodiaSchema WHERE name=?",
+                        'CustodiaSecrets'),
+            [(store.schema_version,)])
+        sql = self._query("SELECT sql FROM sqlite_master WHERE name=?",
+                          'CustodiaSecrets')[0][0]
+        self.assertIn('WITHOUT ROWID', sql)
+        # no index on the key besides the primary key
+        self.assertEqual(
+            self._query("SELECT name FROM sqlite_master WHERE type='index' "
+                        "AND tbl_name='CustodiaSecrets'"),
+            [('CustodiaSecretsExpires',)])
+
+        # initializing again leaves the data alone
+        store = SqliteStore(self.parser, 'store:legacy')
+        self.assertEqual(store.get('/sub/key'), 'value')
+
+    def test_2_newer_schema(self):
+        conn = sqlite3.connect(self.dburi)
+        with conn:
+            conn.execute("UPDATE CustodiaSchema SET version=version + 1")
+        conn.close()
+        with self.assertRaises(CSStoreError):
+            SqliteStore(self.parser, 'store:legacy')
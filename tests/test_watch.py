@@ -0,0 +1,79 @@
+# Copyright (C) 2026  Custodia Project Contributors - see LICENSE file
+from __future__ import absolute_import
+
+import os
+
+from custodia import watch
+
+
+def test_notifier():
+    notifier = watch.ChangeNotifier(slots=64)
+    names = ['keys/', 'keys/test/', 'keys/test/key', 'keys/test/key/']
+    counters = [notifier.counter(name) for name in names]
+    assert not notifier.wait('keys/test/key', counters[2], 0.01)
+
+    # changes of forked children wake up the parent
+    pid = os.fork()
+    if not pid:
+        try:
+            notifier.changed('keys/test/key')
+        finally:
+            os._exit(0)  # pylint: disable=protected-access
+    os.waitpid(pid, 0)
+    for name, counter in zip(names, counters):
+        assert notifier.wait(name, counter, 0.01)
+
+    # a container notifies itself and its parents
+    counter = notifier.counter('keys/test/')
+    notifier.changed('keys/test')
+    assert notifier.counter('keys/test/') != counter
+
+
+def test_max_waiters():
+    notifier = watch.ChangeNotifier(slots=64, max_waiters=1)
+    assert notifier.acquire_waiter()
+    # the slot is taken
+    assert not notifier.acquire_waiter()
+    notifier.release_waiter()
+    assert notifier.acquire_waiter()
+    notifier.release_waiter()
+    assert watch.ChangeNotifier(slots=64).acquire_waiter()
+
+    configured = watch.configured_max_waiters
+    assert configured({}) is None
+    assert configured({'server_engine': 'asyncio'}) == 4
+    assert configured({'server_engine': 'asyncio',
+                       'server_threads': 1}) == 0
+    assert configured({'server_workers': 6}) == 3
+    assert configured({'server_workers': 6,
+                       'server_max_waiters': 5}) == 5
+
+
+def test_install_notifier(monkeypatch):
+    monkeypatch.setattr(watch, '_notifier', None)
+
+    class Store(object):
+        def __init__(self):
+            self.keys = []
+
+        def set(self, key, value, replace=False):
+            self.keys.append(key)
+
+        def set_many(self, items, replace=False):
+            self.keys.extend(key for key, _ in items)
+
+    store = Store()
+    notifier = watch.install_notifier({'stores': {'store': store}})
+    assert watch.get_notifier() is notifier
+    method = store.set
+    # installed once
+    assert watch.install_notifier({'stores': {'store': store}}) is notifier
+    assert store.set is method
+
+    counter = notifier.counter('keys/')
+    store.set('keys/a', 'a')
+    assert notifier.counter('keys/') != counter
+    counter = notifier.counter('keys/b')
+    store.set_many(iter([('keys/b', 'b')]))
+    assert notifier.counter('keys/b') != counter
+    assert store.keys == ['keys/a', 'keys/b']